@@ -0,0 +1,337 @@
+import base64
+import json
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config_loader import load_config
+from ttl_cache import TTLCache
+from upstream import CircuitBreaker, fan_out
+
+
+# ---------------------------------------------------------------------------
+# 121 API access with one shared service-account token.
+#
+# The token from POST /api/users/login is cached until shortly before it
+# expires and shared by every request in the process. Under concurrency only
+# one thread logs in; the others wait for it and reuse its token. A request
+# answered with 401 refreshes the token (once, however many requests saw the
+# same 401) and is retried.
+#
+# offline_sync.py subprocesses are handed the web app's token, and the
+# permissions from its login, through the environment (see export_token),
+# so a sync does not need its own login.
+# ---------------------------------------------------------------------------
+
+# Refresh this long before the token's expiry
+TOKEN_REFRESH_MARGIN_SECONDS = int(os.getenv("TOKEN_121_REFRESH_MARGIN_SECONDS", "300"))
+
+# Assumed lifetime when neither the login response nor the token says
+DEFAULT_TOKEN_LIFETIME_SECONDS = int(os.getenv("TOKEN_121_DEFAULT_LIFETIME_SECONDS", "3600"))
+
+TOKEN_ENV = "ACCESS_TOKEN_121"
+TOKEN_EXPIRES_ENV = "ACCESS_TOKEN_121_EXPIRES"
+TOKEN_PERMISSIONS_ENV = "ACCESS_TOKEN_121_PERMISSIONS"
+
+
+class LoginError(Exception):
+    """Logging in to 121 with the service account failed."""
+
+
+def pooled_session(maxsize=16, headers=None):
+    """A requests.Session with a connection pool of `maxsize` per host."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=maxsize)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if headers:
+        session.headers.update(headers)
+    return session
+
+
+SESSION = pooled_session(int(os.getenv("HTTP_POOL_SIZE", "16")))
+
+
+def _probe():
+    """121 is reachable again when its API answers without a 5xx."""
+    url121 = load_config().get("url121", "").rstrip("/")
+    return SESSION.get(f"{url121}/api", timeout=5).status_code < 500
+
+
+# Opens when 121 keeps failing, so callers fall back instead of waiting
+# for timeouts (see upstream.CircuitBreaker)
+breaker = CircuitBreaker("121", _probe)
+
+
+def _parse_expiry(payload, token):
+    """Expiry (epoch seconds) from the login response, else the JWT exp."""
+    expires = payload.get("expires")
+    if expires:
+        for fmt in ("%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%SZ"):
+            try:
+                return datetime.strptime(expires, fmt).replace(tzinfo=timezone.utc).timestamp()
+            except (TypeError, ValueError):
+                continue
+    try:
+        claims = token.split(".")[1]
+        claims += "=" * (-len(claims) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(claims)).get("exp")
+        if exp:
+            return float(exp)
+    except (IndexError, ValueError, AttributeError):
+        pass
+    return time.time() + DEFAULT_TOKEN_LIFETIME_SECONDS
+
+
+def _account(config):
+    return (config.get("url121"), config.get("username121"))
+
+
+class TokenProvider:
+    """Thread-safe cache of the 121 service-account token."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires_at = 0
+        self._account = None
+        self._login = {}
+
+    def _valid(self, account):
+        return (
+            self._token is not None
+            and self._account == account
+            and time.time() < self._expires_at - TOKEN_REFRESH_MARGIN_SECONDS
+        )
+
+    def get(self, refresh_if=None):
+        """
+        Return a valid token, logging in if needed. Pass the token a request
+        was rejected with as refresh_if to force a refresh, unless another
+        thread has already replaced it. Raises LoginError.
+        """
+        config = load_config()
+        account = _account(config)
+        with self._lock:
+            if refresh_if is not None and refresh_if != self._token and self._valid(account):
+                return self._token
+            if refresh_if is None and self._valid(account):
+                return self._token
+            self._do_login(config, account)
+            return self._token
+
+    def _do_login(self, config, account):
+        url121, username = account
+        if not url121 or not username or not config.get("password121"):
+            raise LoginError("Missing 121 credentials")
+        resp = breaker.call(
+            SESSION.post,
+            f"{url121}/api/users/login",
+            json={"username": username, "password": config.get("password121")},
+            timeout=10,
+        )
+        if resp.status_code != 201:
+            raise LoginError(f"Login failed ({resp.status_code}): {resp.text[:200]}")
+        payload = resp.json()
+        token = payload.get("access_token_general")
+        if not token:
+            raise LoginError("Login succeeded but no token returned")
+        self._token = token
+        self._expires_at = _parse_expiry(payload, token)
+        self._account = account
+        self._login = payload
+
+    def permissions(self):
+        """The permissions map from the last login ({programId: [...]})."""
+        self.get()
+        with self._lock:
+            if "permissions" not in self._login:
+                # Seeded without the login payload: log in for it
+                self._do_login(load_config(), self._account)
+            return dict(self._login.get("permissions") or {})
+
+    def seed(self, token, expires_at, permissions=None):
+        """
+        Adopt a token obtained elsewhere (e.g. by the parent process), with
+        the permissions of the login that produced it if known.
+        """
+        with self._lock:
+            self._token = token
+            self._expires_at = float(expires_at)
+            self._account = _account(load_config())
+            self._login = {} if permissions is None else {"permissions": permissions}
+
+    def export(self):
+        """(token, expires_at, permissions) for handing to another process."""
+        token = self.get()
+        with self._lock:
+            return token, self._expires_at, self._login.get("permissions")
+
+
+token_provider = TokenProvider()
+
+
+def _seed_from_env():
+    token = os.getenv(TOKEN_ENV)
+    expires_at = os.getenv(TOKEN_EXPIRES_ENV)
+    if token and expires_at:
+        try:
+            permissions = json.loads(os.getenv(TOKEN_PERMISSIONS_ENV) or "null")
+            token_provider.seed(token, expires_at, permissions)
+        except ValueError:
+            pass
+
+
+_seed_from_env()
+
+
+def export_token(env):
+    """Put the current token into a subprocess env dict (best effort)."""
+    try:
+        token, expires_at, permissions = token_provider.export()
+    except Exception as e:
+        print(f"[api121] Could not share 121 token with subprocess: {e}")
+        return env
+    env[TOKEN_ENV] = token
+    env[TOKEN_EXPIRES_ENV] = str(expires_at)
+    if permissions is not None:
+        env[TOKEN_PERMISSIONS_ENV] = json.dumps(permissions)
+    return env
+
+
+def get_token():
+    """The shared 121 token, or None if login fails."""
+    try:
+        return token_provider.get()
+    except Exception as e:
+        print(f"❌ 121 login error: {e}")
+        return None
+
+
+def _call_direct(fn, *args, **kwargs):
+    return fn(*args, **kwargs)
+
+
+def request(method, url, session=None, use_breaker=True, **kwargs):
+    """
+    Send a request to 121 with the shared token, retrying once with a fresh
+    token on 401. `url` is absolute or a path ("/api/programs/10") relative
+    to url121. Raises LoginError if no token can be obtained, and
+    CircuitOpen (a requests.ConnectionError) while 121 is considered down,
+    unless use_breaker=False.
+    """
+    if not url.startswith(("http://", "https://")):
+        url = load_config().get("url121", "").rstrip("/") + url
+    session = session or SESSION
+    send = breaker.call if use_breaker else _call_direct
+    extra_cookies = kwargs.pop("cookies", None) or {}
+
+    token = token_provider.get()
+    resp = send(
+        session.request, method, url,
+        cookies={**extra_cookies, "access_token_general": token}, **kwargs
+    )
+    if resp.status_code == 401:
+        token = token_provider.get(refresh_if=token)
+        resp = send(
+            session.request, method, url,
+            cookies={**extra_cookies, "access_token_general": token}, **kwargs
+        )
+    return resp
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+# ---------------------------------------------------------------------------
+# Programme metadata cache
+#
+# GET /api/programs/{id} (titles, registration attributes) and
+# /fsp-configurations rarely change, but pages used to re-fetch them for
+# every programme on every render. They are cached per 121 instance for
+# METADATA_CACHE_TTL_SECONDS, served stale for METADATA_CACHE_STALE_SECONDS
+# more while a background refresh runs, and persisted across restarts. The
+# admin config pages invalidate them on save.
+# ---------------------------------------------------------------------------
+
+METADATA_CACHE_TTL_SECONDS = float(os.getenv("METADATA_CACHE_TTL_SECONDS", "600"))
+METADATA_CACHE_STALE_SECONDS = float(os.getenv("METADATA_CACHE_STALE_SECONDS", "3600"))
+METADATA_CACHE_PATH = os.path.join(
+    os.getenv("METADATA_CACHE_DIR", "metadata-cache"), "programs-121.json"
+)
+
+metadata_cache = TTLCache(
+    METADATA_CACHE_TTL_SECONDS,
+    stale_ttl=METADATA_CACHE_STALE_SECONDS,
+    persist_path=METADATA_CACHE_PATH,
+)
+
+
+def _metadata_key(url121, program_id, kind):
+    return f"{url121}|{program_id}|{kind}"
+
+
+def _cached_json(program_id, kind, path):
+    url121 = load_config().get("url121", "").rstrip("/")
+
+    def load():
+        r = get(f"{url121}/api/programs/{program_id}{path}", timeout=10)
+        r.raise_for_status()
+        return r.json()
+
+    return metadata_cache.get(_metadata_key(url121, program_id, kind), load)
+
+
+def get_program(program_id):
+    """GET /api/programs/{id} (titles, registration attributes), cached."""
+    return _cached_json(program_id, "program", "")
+
+
+def get_fsp_configurations(program_id):
+    """GET /api/programs/{id}/fsp-configurations, cached."""
+    return _cached_json(program_id, "fsp-configurations", "/fsp-configurations")
+
+
+def column_to_match(program_id):
+    """The columnToMatch property from the programme's fsp-configurations, or None."""
+    for fsp in get_fsp_configurations(program_id):
+        for prop in fsp.get("properties", []):
+            if prop.get("name") == "columnToMatch":
+                return prop.get("value")
+    return None
+
+
+def program_title(program_id, lang="en", default=None):
+    """The programme's portal title in lang (else any language), or default."""
+    titles = get_program(program_id).get("titlePortal", {}) or {}
+    return titles.get(lang) or next(iter(titles.values()), default)
+
+
+def program_titles(program_ids, lang="en", default=None, deadline=None):
+    """
+    {str(programId): title} for several programmes, looked up concurrently
+    (upstream.fan_out). Programmes without a title get default; those 121
+    did not answer for in time get None.
+    """
+    return fan_out(
+        {str(pid): (lambda pid=pid: program_title(pid, lang, default)) for pid in program_ids},
+        deadline=deadline,
+    )
+
+
+def invalidate_program_metadata(program_id=None):
+    """Forget cached metadata for one programme, or for all of them."""
+    if program_id is None:
+        metadata_cache.invalidate()
+    else:
+        url121 = load_config().get("url121", "").rstrip("/")
+        metadata_cache.invalidate(prefix=f"{url121}|{program_id}|")
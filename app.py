@@ -8,29 +8,81 @@ from config import ADMIN_USERNAME, ADMIN_PASSWORD, FSP_USERNAME, FSP_PASSWORD
 from urllib.parse import quote
 import subprocess
 import zipfile
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import A5, landscape
-from reportlab.lib.units import cm
-from reportlab.lib.utils import ImageReader
-import qrcode
 import csv
-from flask_session import Session
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-from openpyxl import load_workbook
-from config_loader import load_display_config, save_display_config
+import threading
+from config_loader import load_display_config, save_display_config, update_lock
+import api121
+import batch_scope
+import kobo_api
+import match_index
+import outbox
+import paid_feed
+import photo_store
+import verify_index
+import voucher_signing
+from upstream import fan_out
+import warmup
+from sync_runner import sync_program, find_fresh_batch, latest_recent_batch, parse_schedule, start_scheduler
+
+
+# ReportLab, qrcode/Pillow and openpyxl are only needed for vouchers and
+# spreadsheet uploads, so they are imported where they are used rather than
+# here: most requests (scanning, /ping, offline pages) never load them.
+# flask_session is only needed once, by create_app().
+
+app = Flask(__name__)
+
+_init_lock = threading.Lock()
+_initialised = False
 
 
+def create_app():
+    """
+    Configure the app and start its background work: server-side sessions,
+    the sync scheduler and the cache warm-up. Safe to call more than once;
+    returns the app.
+    """
+    global _initialised
+    with _init_lock:
+        if _initialised:
+            return app
 
-# Register a Unicode-safe font
-pdfmetrics.registerFont(TTFont("DejaVu", os.path.join("static", "fonts", "DejaVuSans.ttf")))
+        app.secret_key = 'your_secret_key'
+        app.config["SESSION_TYPE"] = "filesystem"
+        app.config["SESSION_PERMANENT"] = False
+        from flask_session import Session
+        Session(app)
 
+        # Pre-build offline batches for programmes that have a syncSchedule
+        start_scheduler()
+
+        # Log in to 121 and fill the metadata caches in the background (see /ready)
+        warmup.start_on_boot()
+
+        # Deliver queued payment submissions to 121 (and resume any left
+        # over from before a restart)
+        outbox.start_dispatcher()
+
+        _initialised = True
+    return app
+
+
+_fonts_lock = threading.Lock()
+_fonts_registered = False
+
+
+def _register_fonts():
+    """Register the Unicode-safe voucher font with ReportLab (once)."""
+    global _fonts_registered
+    with _fonts_lock:
+        if _fonts_registered:
+            return
+        from reportlab.pdfbase import pdfmetrics
+        from reportlab.pdfbase.ttfonts import TTFont
+
+        pdfmetrics.registerFont(TTFont("DejaVu", os.path.join("static", "fonts", "DejaVuSans.ttf")))
+        _fonts_registered = True
 
-app = Flask(__name__)
-app.secret_key = 'your_secret_key'
-app.config["SESSION_TYPE"] = "filesystem"
-app.config["SESSION_PERMANENT"] = False
-Session(app)
 
 @app.context_processor
 def inject_national_society():
@@ -39,6 +91,8 @@ def inject_national_society():
 
 def _make_qr_image(data, box_cm=3.0):
     """Return a Pillow image for the QR sized to box_cm × box_cm at 300dpi."""
+    import qrcode
+
     qr = qrcode.QRCode(
         version=None, error_correction=qrcode.constants.ERROR_CORRECT_M,
         box_size=10, border=4
@@ -85,11 +139,16 @@ def _resolve_logo_path(filename, static_folder=None):
     return None
 
 
-def _draw_voucher(c, item, static_folder, design=None):
+def _draw_voucher(c, item, static_folder, design=None, qr_data=None):
     """
     Draw one voucher on an A5 LANDSCAPE page matching the provided layout.
-    Supports dynamic CSV fields.
+    Supports dynamic CSV fields. qr_data replaces the reference id in the
+    QR (signed vouchers).
     """
+    from reportlab.lib.pagesizes import A5, landscape
+    from reportlab.lib.units import cm
+    from reportlab.lib.utils import ImageReader
+
     width, height = landscape(A5)
 
     margin = 1.0 * cm
@@ -198,7 +257,7 @@ def _draw_voucher(c, item, static_folder, design=None):
 
     # QR image
     refid = item.get("referenceid", "").strip()
-    qr_img = _make_qr_image(refid, box_cm=3.0)
+    qr_img = _make_qr_image(qr_data or refid, box_cm=3.0)
     c.drawInlineImage(qr_img, qr_x, qr_y, width=qr_box_size, height=qr_box_size)
 
     # *** Removed “Reference ID below QR” (as you requested) ***
@@ -248,20 +307,31 @@ def _draw_voucher(c, item, static_folder, design=None):
         )
 
 
-def generate_vouchers_pdf(rows, static_folder, design=None):
+def generate_vouchers_pdf(rows, static_folder, design=None, program_id=None):
     """
     rows: list of dicts with keys: referenceId, name
     design: optional per-program voucher design (title/subtitle/logos)
+    program_id: needed for signed QR payloads (design "signed_qr")
     returns BytesIO of PDF
     """
     from io import BytesIO
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.pagesizes import A5, landscape
+
+    _register_fonts()
     pdf_io = BytesIO()
 
     # Create a landscape A5 page
     c = canvas.Canvas(pdf_io, pagesize=landscape(A5))
 
+    signed = bool(design and design.get("signed_qr") and program_id)
+
     for r in rows:
-        _draw_voucher(c, r, static_folder, design=design)
+        qr_data = None
+        if signed and r.get("referenceid"):
+            payment_id = r.get("paymentid") or r.get("payment id") or r.get("payment_id")
+            qr_data = voucher_signing.sign_voucher(program_id, r["referenceid"], payment_id)
+        _draw_voucher(c, r, static_folder, design=design, qr_data=qr_data)
         c.showPage()
 
     c.save()
@@ -291,44 +361,15 @@ def resolve_programs(system_config=None):
     programs, lookup = [], {}
     url121 = system_config.get("url121")
 
+    titles = {}
     if url121 and programs_raw:
-        try:
-            login_resp = requests.post(
-                f"{url121}/api/users/login",
-                json={
-                    "username": system_config.get("username121", ""),
-                    "password": system_config.get("password121", ""),
-                },
-                timeout=10,
-            )
-            if login_resp.status_code == 201:
-                token = login_resp.json().get("access_token_general")
-                cookies = {"access_token_general": token}
-                for p in programs_raw:
-                    pid = p.get("programId")
-                    title = str(pid)
-                    try:
-                        r = requests.get(
-                            f"{url121}/api/programs/{pid}",
-                            cookies=cookies,
-                            timeout=10,
-                        )
-                        if r.status_code == 200:
-                            titles = r.json().get("titlePortal", {}) or {}
-                            title = titles.get("en") or next(iter(titles.values()), title)
-                    except Exception:
-                        pass
-                    programs.append({"id": str(pid), "title": title})
-                    lookup[str(pid)] = p
-        except Exception as e:
-            print("Program title lookup failed:", e)
+        titles = api121.program_titles([p.get("programId") for p in programs_raw], "en")
 
-    # Fallback: ids only
-    if not programs:
-        for p in programs_raw:
-            pid = str(p.get("programId"))
-            programs.append({"id": pid, "title": pid})
-            lookup[pid] = p
+    # Fallback: ids as titles
+    for p in programs_raw:
+        pid = str(p.get("programId"))
+        programs.append({"id": pid, "title": titles.get(pid) or pid})
+        lookup[pid] = p
 
     return programs, lookup
 
@@ -365,10 +406,11 @@ def get_voucher_design(program_id):
 
 
 def save_voucher_design(program_id, design):
-    cfg = load_display_config() or {}
-    cfg.setdefault("voucher_designs", {})
-    cfg["voucher_designs"][str(program_id)] = design
-    save_display_config(cfg)
+    with update_lock():
+        cfg = load_display_config() or {}
+        cfg.setdefault("voucher_designs", {})
+        cfg["voucher_designs"][str(program_id)] = design
+        save_display_config(cfg)
 
 
 def _save_logo_file(file_storage, program_id, slot):
@@ -413,6 +455,7 @@ def _design_for_client(design):
         "logo2_url": _logo_url(design.get("logo2")),
         "logo1_size": _clean_size(design.get("logo1_size")),
         "logo2_size": _clean_size(design.get("logo2_size")),
+        "signed_qr": bool(design.get("signed_qr")),
     }
 
 
@@ -522,6 +565,7 @@ translations = {
     "scan_next": "Scan next beneficiary",
     "go_home": "Go to homepage",
     "reason_used": "This QR code has already been used.",
+    "reason_revoked": "This voucher has been cancelled.",
     "reason_invalid": "The QR code is invalid or unrecognized.",
     "reason_no_record": "This QR code does not match any stored beneficiary.",
     "reason_database": "There was a problem reading offline data. Please try again.",
@@ -572,6 +616,8 @@ translations = {
     "voucher_no_logo": "No logo",
     "voucher_live_preview": "Live preview",
     "voucher_preview_desc": "A5 landscape, matching the printed voucher layout.",
+    "voucher_signed_qr_label": "Signed QR codes",
+    "voucher_signed_qr_desc": "Print a signed code that scanning devices can verify without the full beneficiary list.",
     "voucher_save_design": "Save design",
     "voucher_design_saved": "Design saved",
     "voucher_design_save_failed": "Could not save design",
@@ -583,6 +629,16 @@ translations = {
     "voucher_size_medium": "Medium",
     "voucher_size_large": "Large",
     "program": "Program",
+    "sync_schedule": "Sync schedule",
+    "sync_schedule_placeholder": "every 6h or 0 5 * * *",
+    "sync_freshness": "Reuse pre-built batches younger than (minutes)",
+    "photo_mode": "Photos",
+    "photo_mode_batch": "In the offline batch",
+    "photo_mode_lazy": "On demand (when online)",
+    "scope_attribute": "Site attribute",
+    "scope_attribute_placeholder": "e.g. village",
+    "invalid_sync_schedule": "Invalid sync schedule for program {program_id}: {error}. The previous schedule was kept.",
+    "invalid_sync_freshness": "Batch freshness must be a whole number of minutes. The previous value was kept.",
 }
 ,
 "fr": {
@@ -690,6 +746,7 @@ translations = {
     "scan_next": "Scanner le bénéficiaire suivant",
     "go_home": "Aller à l'accueil",
     "reason_used": "Ce code QR a déjà été utilisé.",
+    "reason_revoked": "Ce bon a été annulé.",
     "reason_invalid": "Le code QR est invalide ou non reconnu.",
     "reason_no_record": "Aucun bénéficiaire correspondant n’a été trouvé.",
     "reason_database": "Problème de lecture des données hors ligne. Veuillez réessayer.",
@@ -725,6 +782,16 @@ translations = {
     "no_form_connected": "Impossible de charger les détails du formulaire",
     "kobo_connection": "Connexion Kobo",
     "payment_amount": "Montant du paiement",
+    "sync_schedule": "Synchronisation planifiée",
+    "sync_schedule_placeholder": "every 6h ou 0 5 * * *",
+    "sync_freshness": "Réutiliser les lots préparés depuis moins de (minutes)",
+    "photo_mode": "Photos",
+    "photo_mode_batch": "Dans le lot hors ligne",
+    "photo_mode_lazy": "À la demande (en ligne)",
+    "scope_attribute": "Attribut de site",
+    "scope_attribute_placeholder": "p. ex. village",
+    "invalid_sync_schedule": "Planification invalide pour le programme {program_id} : {error}. La planification précédente a été conservée.",
+    "invalid_sync_freshness": "La fraîcheur des lots doit être un nombre entier de minutes. La valeur précédente a été conservée.",
 }
 ,
 "ar": {
@@ -831,6 +898,7 @@ translations = {
     "scan_next": "مسح المستفيد التالي",
     "go_home": "العودة إلى الصفحة الرئيسية",
     "reason_used": "تم استخدام رمز QR هذا سابقًا.",
+    "reason_revoked": "تم إلغاء هذه القسيمة.",
     "reason_invalid": "رمز QR غير صالح أو غير معروف.",
     "reason_no_record": "لا يوجد أي مستفيد مطابق لهذا الرمز.",
     "reason_database": "حدثت مشكلة في قراءة البيانات دون اتصال. حاول مرة أخرى.",
@@ -867,6 +935,16 @@ translations = {
     "no_form_connected": "تعذّر تحميل تفاصيل النموذج",
     "kobo_connection": "اتصال كوبا",
     "payment_amount": "مبلغ الدفع",
+    "sync_schedule": "جدول المزامنة",
+    "sync_schedule_placeholder": "every 6h أو 0 5 * * *",
+    "sync_freshness": "إعادة استخدام الدفعات المعدّة منذ أقل من (دقائق)",
+    "photo_mode": "الصور",
+    "photo_mode_batch": "ضمن الدفعة دون اتصال",
+    "photo_mode_lazy": "عند الطلب (عند الاتصال)",
+    "scope_attribute": "سمة الموقع",
+    "scope_attribute_placeholder": "مثال: village",
+    "invalid_sync_schedule": "جدول مزامنة غير صالح للبرنامج {program_id}: {error}. تم الإبقاء على الجدول السابق.",
+    "invalid_sync_freshness": "يجب أن تكون مدة صلاحية الدفعات عددًا صحيحًا من الدقائق. تم الإبقاء على القيمة السابقة.",
     }
 }
 
@@ -916,7 +994,8 @@ def admin_login():
     login_payload = {"username": username, "password": password}
 
     try:
-        res = requests.post(login_url, json=login_payload, timeout=10)
+        # Fails fast while 121 is known to be down
+        res = api121.breaker.call(requests.post, login_url, json=login_payload, timeout=10)
 
     except Exception:
         # API unreachable
@@ -1011,10 +1090,17 @@ def system_config():
         program_ids = request.form.getlist("PROGRAMS[][programId]")
         asset_ids = request.form.getlist("PROGRAMS[][koboAssetId]")
 
+        sync_schedules = request.form.getlist("PROGRAMS[][syncSchedule]")
+        photo_modes = request.form.getlist("PROGRAMS[][photoMode]")
+        scope_attributes = request.form.getlist("PROGRAMS[][scopeAttribute]")
+
         kobo_server = updated.get("KOBO_SERVER")
         kobo_token = updated.get("KOBO_TOKEN")
 
-        for pid, asset_id in zip(program_ids, asset_ids):
+        previous_programs = {str(p.get("programId")): p for p in config.get("PROGRAMS", [])}
+        errors = []
+
+        for i, (pid, asset_id) in enumerate(zip(program_ids, asset_ids)):
             if not pid or not asset_id:
                 continue
 
@@ -1023,17 +1109,34 @@ def system_config():
                 "koboAssetId": asset_id.strip()
             }
 
-            # ---- Validate Kobo asset ----
+            # ---- Background sync schedule (interval or cron) ----
+            schedule = sync_schedules[i].strip() if i < len(sync_schedules) else ""
+            if schedule:
+                try:
+                    parse_schedule(schedule)
+                    entry["syncSchedule"] = schedule
+                except ValueError as e:
+                    errors.append(t["invalid_sync_schedule"].format(program_id=pid, error=e))
+                    previous = previous_programs.get(str(pid), {}).get("syncSchedule")
+                    if previous:
+                        entry["syncSchedule"] = previous
+
+            # ---- Photos with the batch, or fetched on demand ----
+            if i < len(photo_modes) and photo_modes[i] == photo_store.LAZY:
+                entry["photoMode"] = photo_store.LAZY
+
+            # ---- Registration attribute for per-site batches ----
+            scope_attribute = scope_attributes[i].strip() if i < len(scope_attributes) else ""
+            if scope_attribute:
+                entry["scopeAttribute"] = scope_attribute
+
+            # ---- Validate Kobo asset (also refreshes its cached schema) ----
             try:
-                r = requests.get(
-                    f"{kobo_server}/api/v2/assets/{asset_id}/?format=json",
-                    headers={"Authorization": f"Token {kobo_token}"},
-                    timeout=10
+                schema = kobo_api.get_asset_schema(
+                    asset_id.strip(), kobo_server, kobo_token, refresh=True
                 )
-                if r.status_code == 200:
-                    j = r.json()
-                    entry["koboFormName"] = j.get("name")
-                    entry["koboFormOwner"] = j.get("owner__username")
+                entry["koboFormName"] = schema.get("name")
+                entry["koboFormOwner"] = schema.get("owner")
             except Exception as e:
                 print("Kobo validation error:", e)
 
@@ -1041,13 +1144,28 @@ def system_config():
 
         updated["PROGRAMS"] = programs
 
+        freshness = request.form.get("SYNC_FRESHNESS_MINUTES", "").strip()
+        if freshness:
+            try:
+                updated["SYNC_FRESHNESS_MINUTES"] = max(0, int(freshness))
+            except ValueError:
+                errors.append(t["invalid_sync_freshness"])
+
         save_config(updated)
+        # Programme mappings may have changed: drop cached 121 metadata
+        api121.invalidate_program_metadata()
+        if errors:
+            # Everything else was saved; the page shows what was not
+            return jsonify({"errors": errors}), 400
         flash(t["saved_successfully"])
         return redirect(url_for("system_config", lang=lang))
 
     # ============================================================
     # GET: LOAD DATA FOR UI
     # ============================================================
+    if request.args.get("refresh") == "1":
+        api121.invalidate_program_metadata()
+
     url121 = config.get("url121")
     username121 = config.get("username121")
     password121 = config.get("password121")
@@ -1059,32 +1177,18 @@ def system_config():
     # ---- Login to 121 ----
     if url121 and username121 and password121:
         try:
-            r = requests.post(
-                f"{url121}/api/users/login",
-                json={"username": username121, "password": password121}
-            )
-            if r.status_code == 201:
-                j = r.json()
-                token = j.get("access_token_general")
-                program_ids = [int(pid) for pid in j.get("permissions", {}).keys()]
+            token = api121.token_provider.get()
+            program_ids = [int(pid) for pid in api121.token_provider.permissions().keys()]
         except Exception as e:
             print("121 login failed:", e)
 
     # ---- Load program titles ----
     if token:
+        titles = api121.program_titles(program_ids, lang, default="")
         for pid in program_ids:
-            try:
-                r = requests.get(
-                    f"{url121}/api/programs/{pid}",
-                    cookies={"access_token_general": token}
-                )
-                if r.status_code == 200:
-                    pdata = r.json()
-                    titles = pdata.get("titlePortal", {})
-                    title = titles.get(lang) or next(iter(titles.values()), f"Program {pid}")
-                    program_options.append({"id": pid, "title": title})
-            except Exception as e:
-                print(f"Program load failed ({pid}):", e)
+            title = titles.get(str(pid))
+            if title is not None:
+                program_options.append({"id": pid, "title": title or f"Program {pid}"})
 
     # Existing mappings for UI
     program_mappings = config.get("PROGRAMS", [])
@@ -1113,73 +1217,32 @@ def api_program_attributes(program_id):
         return jsonify({"attributes": [], "kobo_image_fields": []})
 
     attributes = []
-    kobo_image_fields = []
 
-    try:
-        login_resp = requests.post(
-            f"{url121}/api/users/login",
-            json={
-                "username": system_config.get("username121", ""),
-                "password": system_config.get("password121", "")
-            },
-            timeout=10
-        )
+    # 121 program + Kobo image fields for this program, concurrently
+    calls = {"program": lambda: api121.get_program(program_id)}
 
-        if login_resp.status_code == 201:
-            token = login_resp.json().get("access_token_general")
-            cookies = {"access_token_general": token}
+    programs = system_config.get("PROGRAMS", [])
+    program = next((p for p in programs if str(p.get("programId")) == str(program_id)), None)
+    if program:
+        asset_id = program.get("koboAssetId")
+        kobo_token = system_config.get("KOBO_TOKEN")
+        kobo_server = system_config.get("KOBO_SERVER", "https://kobo.ifrc.org")
 
-            # Registration attributes
-            r = requests.get(
-                f"{url121}/api/programs/{program_id}",
-                cookies=cookies,
-                timeout=10
-            )
-            if r.status_code == 200:
-                for attr in r.json().get("programRegistrationAttributes", []):
-                    name = attr.get("name")
-                    if not name:
-                        continue
-                    labels = attr.get("label") or {}
-                    label = labels.get("en") or next(iter(labels.values()), name)
-                    attributes.append({"name": name, "label": label})
+        if asset_id and kobo_token:
+            calls["kobo-image-fields"] = lambda: kobo_api.get_image_fields(asset_id, kobo_server, kobo_token)
 
-    except Exception as e:
-        print(f"[api_program_attributes] Error: {e}")
+    upstream = fan_out(calls)
 
-    # Kobo image fields for this program
-    try:
-        programs = system_config.get("PROGRAMS", [])
-        program = next((p for p in programs if str(p.get("programId")) == str(program_id)), None)
-        if program:
-            asset_id = program.get("koboAssetId")
-            kobo_token = system_config.get("KOBO_TOKEN")
-            kobo_server = system_config.get("KOBO_SERVER", "https://kobo.ifrc.org")
-
-            if asset_id and kobo_token:
-                r = requests.get(
-                    f"{kobo_server}/api/v2/assets/{asset_id}/?format=json",
-                    headers={"Authorization": f"Token {kobo_token}"},
-                    timeout=10
-                )
-                if r.status_code == 200:
-                    survey = r.json().get("content", {}).get("survey", [])
-                    for item in survey:
-                        if not isinstance(item, dict) or item.get("type") != "image":
-                            continue
-                        raw_label = item.get("label")
-                        if isinstance(raw_label, list) and raw_label:
-                            label = raw_label[0] if isinstance(raw_label[0], str) else next(iter(raw_label[0].values()), "")
-                        elif isinstance(raw_label, dict):
-                            label = raw_label.get("en") or next(iter(raw_label.values()), "")
-                        else:
-                            label = str(raw_label or "")
-                        xpath = item.get("$xpath", "").replace("/data/", "").replace("data/", "").strip("/")
-                        name = xpath or item.get("name", "")
-                        if name:
-                            kobo_image_fields.append({"name": name, "label": label})
-    except Exception as e:
-        print(f"[api_program_attributes] Kobo error: {e}")
+    # Registration attributes
+    for attr in (upstream.get("program") or {}).get("programRegistrationAttributes", []):
+        name = attr.get("name")
+        if not name:
+            continue
+        labels = attr.get("label") or {}
+        label = labels.get("en") or next(iter(labels.values()), name)
+        attributes.append({"name": name, "label": label})
+
+    kobo_image_fields = upstream.get("kobo-image-fields") or []
 
     return jsonify({"attributes": attributes, "kobo_image_fields": kobo_image_fields})
 
@@ -1201,12 +1264,16 @@ def config_page():
         config_data.pop("COLUMN_TO_MATCH", None)
 
         try:
-            full_config = load_display_config()
-            if "programs" not in full_config:
-                full_config["programs"] = {}
+            with update_lock():
+                full_config = load_display_config()
+                if "programs" not in full_config:
+                    full_config["programs"] = {}
 
-            full_config["programs"][program_id] = config_data
-            save_display_config(full_config)
+                full_config["programs"][program_id] = config_data
+                save_display_config(full_config)
+
+            # Re-read attributes / fsp-configurations from 121 next time
+            api121.invalidate_program_metadata(program_id)
 
             return jsonify({"success": True})
         except Exception as e:
@@ -1216,6 +1283,11 @@ def config_page():
     # GET (LOAD PAGE)
     # ------------------------------------------------------
 
+    # ?refresh=1 drops cached 121 programme metadata before loading
+    if request.args.get("refresh") == "1":
+        api121.invalidate_program_metadata()
+        kobo_api.invalidate_asset_schema()
+
     # Load display config
     try:
         config_data = load_display_config()
@@ -1235,61 +1307,54 @@ def config_page():
     url121 = system_config.get("url121")
 
     # ------------------------------------------------------
-    # Resolve program titles from 121
+    # Active program selection
     # ------------------------------------------------------
-    if url121 and programs_raw:
-        try:
-            login_resp = requests.post(
-                f"{url121}/api/users/login",
-                json={
-                    "username": system_config.get("username121", ""),
-                    "password": system_config.get("password121", "")
-                }
-            )
-
-            if login_resp.status_code == 201:
-                token = login_resp.json().get("access_token_general")
-                cookies = {"access_token_general": token}
+    active_program_id = request.args.get("programId")
+    if not active_program_id and programs_raw:
+        active_program_id = programs_raw[0].get("programId")
+    active_program_id = str(active_program_id) if active_program_id else None
 
-                for p in programs_raw:
-                    pid = p.get("programId")
-                    title = str(pid)
+    program_id = None
+    asset_id = None
 
-                    try:
-                        r = requests.get(
-                            f"{url121}/api/programs/{pid}",
-                            cookies=cookies,
-                            timeout=10
-                        )
-                        if r.status_code == 200:
-                            titles = r.json().get("titlePortal", {})
-                            title = titles.get("en") or next(iter(titles.values()), title)
-                    except Exception:
-                        pass
-
-                    programs.append({
-                        "id": str(pid),
-                        "title": title
-                    })
-                    program_lookup[str(pid)] = p
+    for prog in programs_raw:
+        if str(prog.get("programId")) == str(active_program_id):
+            program_id = prog.get("programId")
+            asset_id = prog.get("koboAssetId")
+            break
 
-        except Exception as e:
-            print("Program title lookup failed:", e)
+    # ------------------------------------------------------
+    # 121 + Kobo lookups, concurrently: every program title, plus the
+    # active program's fsp-configurations, attributes and Kobo image fields
+    # ------------------------------------------------------
+    kobo_token = system_config.get("KOBO_TOKEN")
+    kobo_server = system_config.get("KOBO_SERVER", "https://kobo.ifrc.org")
 
-    # Safety fallback
-    if not programs:
+    calls = {}
+    if url121:
         for p in programs_raw:
-            pid = str(p.get("programId"))
-            programs.append({"id": pid, "title": pid})
-            program_lookup[pid] = p
+            calls[f"title:{p.get('programId')}"] = (
+                lambda pid=p.get("programId"): api121.program_title(pid, "en")
+            )
+        if program_id:
+            calls["fsp-configurations"] = lambda: api121.get_fsp_configurations(program_id)
+            calls["program"] = lambda: api121.get_program(program_id)
+    if kobo_token and asset_id:
+        # Cached per asset version; revalidated with a conditional request
+        calls["kobo-image-fields"] = lambda: kobo_api.get_image_fields(asset_id, kobo_server, kobo_token)
+
+    upstream = fan_out(calls)
 
     # ------------------------------------------------------
-    # Active program selection
+    # Program titles (fallback: the program id)
     # ------------------------------------------------------
-    active_program_id = request.args.get("programId")
-    if not active_program_id and programs:
-        active_program_id = programs[0]["id"]
-    active_program_id = str(active_program_id) if active_program_id else None
+    for p in programs_raw:
+        pid = str(p.get("programId"))
+        programs.append({
+            "id": pid,
+            "title": upstream.get(f"title:{pid}") or pid
+        })
+        program_lookup[pid] = p
 
     # ------------------------------------------------------
     # Backward compatibility (single → multi)
@@ -1311,18 +1376,6 @@ def config_page():
             }
         }
 
-    # ------------------------------------------------------
-    # Resolve active program Kobo + 121 config
-    # ------------------------------------------------------
-    program_id = None
-    asset_id = None
-
-    for prog in system_config.get("PROGRAMS", []):
-        if str(prog.get("programId")) == str(active_program_id):
-            program_id = prog.get("programId")
-            asset_id = prog.get("koboAssetId")
-            break
-
     program_title = system_config.get("programTitle", "")
     column_to_match_121 = None
     allowed_attributes = []
@@ -1331,61 +1384,26 @@ def config_page():
     # ------------------------------------------------------
     # 121 PROGRAM ATTRIBUTES
     # ------------------------------------------------------
-    if url121 and program_id:
-        try:
-            login_resp = requests.post(
-                f"{url121}/api/users/login",
-                json={
-                    "username": system_config.get("username121", ""),
-                    "password": system_config.get("password121", "")
-                }
-            )
+    # Column to match
+    for fsp in upstream.get("fsp-configurations") or []:
+        for prop in fsp.get("properties", []):
+            if prop.get("name") == "columnToMatch":
+                column_to_match_121 = prop.get("value")
+                break
 
-            if login_resp.status_code == 201:
-                token = login_resp.json().get("access_token_general")
-                cookies = {"access_token_general": token}
+    # Registration attributes
+    for attr in (upstream.get("program") or {}).get("programRegistrationAttributes", []):
+        name = attr.get("name")
+        if not name:
+            continue
 
-                # Column to match
-                try:
-                    r = requests.get(
-                        f"{url121}/api/programs/{program_id}/fsp-configurations",
-                        cookies=cookies,
-                        timeout=10
-                    )
-                    if r.status_code == 200:
-                        for fsp in r.json():
-                            for prop in fsp.get("properties", []):
-                                if prop.get("name") == "columnToMatch":
-                                    column_to_match_121 = prop.get("value")
-                                    break
-                except Exception:
-                    pass
-
-                # Registration attributes
-                try:
-                    r = requests.get(
-                        f"{url121}/api/programs/{program_id}",
-                        cookies=cookies,
-                        timeout=10
-                    )
-                    if r.status_code == 200:
-                        for attr in r.json().get("programRegistrationAttributes", []):
-                            name = attr.get("name")
-                            if not name:
-                                continue
-
-                            labels = attr.get("label") or {}
-                            label = labels.get("en") or next(iter(labels.values()), name)
-
-                            allowed_attributes.append({
-                                "name": name,
-                                "label": label
-                            })
-                except Exception:
-                    pass
+        labels = attr.get("label") or {}
+        label = labels.get("en") or next(iter(labels.values()), name)
 
-        except Exception as e:
-            print("121 lookup failed:", e)
+        allowed_attributes.append({
+            "name": name,
+            "label": label
+        })
 
     # ------------------------------------------------------
     # Strict mode – drop invalid fields per program
@@ -1401,71 +1419,7 @@ def config_page():
     # ------------------------------------------------------
     # Kobo image fields
     # ------------------------------------------------------
-    def get_full_kobo_path(item):
-        if not isinstance(item, dict):
-            return None
-
-        if "$xpath" in item:
-            return item["$xpath"].replace("/data/", "").replace("data/", "").strip("/")
-
-        parts = []
-        current = item
-        while isinstance(current, dict):
-            if current.get("name"):
-                parts.append(current["name"])
-            current = current.get("parent")
-
-        return "/".join(reversed(parts)) if parts else None
-
-    try:
-        token = system_config.get("KOBO_TOKEN")
-        kobo_server = system_config.get("KOBO_SERVER", "https://kobo.ifrc.org")
-
-        if token and asset_id:
-            r = requests.get(
-                f"{kobo_server}/api/v2/assets/{asset_id}/?format=json",
-                headers={"Authorization": f"Token {token}"},
-                timeout=10
-            )
-
-            if r.status_code == 200:
-                survey = r.json().get("content", {}).get("survey", [])
-                for item in survey:
-                    if not isinstance(item, dict):
-                        continue
-
-                    if item.get("type") == "image":
-                        raw_label = item.get("label")
-
-                        if isinstance(raw_label, dict):
-                            label = (
-                                raw_label.get("English")
-                                or raw_label.get("en")
-                                or next(iter(raw_label.values()), get_full_kobo_path(item))
-                            )
-
-                        elif isinstance(raw_label, list) and raw_label:
-                            first = raw_label[0]
-                            if isinstance(first, dict):
-                                label = (
-                                    first.get("English")
-                                    or first.get("en")
-                                    or next(iter(first.values()), get_full_kobo_path(item))
-                                )
-                            else:
-                                label = str(first)
-
-                        else:
-                            label = get_full_kobo_path(item)
-
-                        path = get_full_kobo_path(item)
-                        if path:
-                            kobo_image_fields.append({
-                                "name": path,
-                                "label": label
-                            })
-    except Exception as e:
-        print("Kobo lookup failed:", e)
+    kobo_image_fields = upstream.get("kobo-image-fields") or []
 
     # ------------------------------------------------------
     # Strict mode – image field per program
@@ -1531,7 +1485,8 @@ def fsp_login():
         password = request.form.get("password")
 
         try:
-            res = requests.post(
+            res = api121.breaker.call(
+                requests.post,
                 login_url,
                 json={"username": username, "password": password},
                 timeout=8
@@ -1586,57 +1541,20 @@ def fsp_program_selector():
 
     # ------------------------------------------------------
     # Resolve program titles from 121
-    # ------------------------------------------------------
-    if url121 and programs_raw:
-        try:
-            login_resp = requests.post(
-                f"{url121}/api/users/login",
-                json={
-                    "username": system_config.get("username121", ""),
-                    "password": system_config.get("password121", "")
-                },
-                timeout=10
-            )
-
-            if login_resp.status_code == 201:
-                token = login_resp.json().get("access_token_general")
-                cookies = {"access_token_general": token}
-
-                for p in programs_raw:
-                    pid = p.get("programId")
-                    title = str(pid)
-
-                    try:
-                        r = requests.get(
-                            f"{url121}/api/programs/{pid}",
-                            cookies=cookies,
-                            timeout=10
-                        )
-                        if r.status_code == 200:
-                            titles = r.json().get("titlePortal", {})
-                            title = titles.get("en") or next(iter(titles.values()), title)
-                    except Exception:
-                        pass
-
-                    programs.append({
-                        "id": str(pid),
-                        "title": title
-                    })
-
-        except Exception as e:
-            print("Program lookup failed:", e)
-
     # ------------------------------------------------------
     # Fallback: titles = program IDs
     # ------------------------------------------------------
-    if not programs:
-        programs = [
-            {
-                "id": str(p.get("programId")),
-                "title": str(p.get("programId"))
-            }
-            for p in programs_raw
-        ]
+    titles = {}
+    if url121 and programs_raw:
+        titles = api121.program_titles([p.get("programId") for p in programs_raw], "en")
+
+    programs = [
+        {
+            "id": str(p.get("programId")),
+            "title": titles.get(str(p.get("programId"))) or str(p.get("programId"))
+        }
+        for p in programs_raw
+    ]
 
     # ------------------------------------------------------
     # Render selector page
@@ -1686,7 +1604,6 @@ def fsp_admin():
     # Pass full display config to template so it can be stored in IndexedDB
     display_config = _full_display
 
-    column_to_match = get_column_to_match(program_id) or system_config.get("COLUMN_TO_MATCH")
     programs = system_config.get("PROGRAMS", [])
 
     # --- resolve program ---
@@ -1698,31 +1615,14 @@ def fsp_admin():
     if not program:
         return redirect(url_for("fsp_program_selector", lang=lang))
 
-    # --- fetch 121 program title ---
-    program_title = f"Program {program_id}"
-    url121 = system_config.get("url121")
-    if url121:
-        try:
-            login_resp = requests.post(
-                f"{url121}/api/users/login",
-                json={
-                    "username": system_config.get("username121", ""),
-                    "password": system_config.get("password121", "")
-                },
-                timeout=8
-            )
-            if login_resp.status_code == 201:
-                token = login_resp.json().get("access_token_general")
-                r = requests.get(
-                    f"{url121}/api/programs/{program_id}",
-                    cookies={"access_token_general": token},
-                    timeout=8
-                )
-                if r.status_code == 200:
-                    titles = r.json().get("titlePortal", {})
-                    program_title = titles.get(lang) or next(iter(titles.values()), program_title)
-        except Exception as e:
-            print(f"[fsp_admin] Failed to fetch 121 program title: {e}")
+    # --- column to match + 121 program title, concurrently ---
+    calls = {"column-to-match": lambda: get_column_to_match(program_id)}
+    if system_config.get("url121"):
+        calls["title"] = lambda: api121.program_title(program_id, lang)
+    upstream = fan_out(calls)
+
+    column_to_match = upstream.get("column-to-match") or system_config.get("COLUMN_TO_MATCH")
+    program_title = upstream.get("title") or f"Program {program_id}"
 
     username = session.get("fsp_username")
 
@@ -1738,15 +1638,15 @@ def fsp_admin():
         config=system_config,
         program_title=program_title,
         program_id=program_id,   # ✅ this feeds ACTIVE_PROGRAM_ID in JS
-        username=username
+        username=username,
+        # Per-site batches: the site attribute, and the user's fixed scope if any
+        scope_attribute=program.get("scopeAttribute") or "",
+        fixed_scope=batch_scope.user_scope(system_config, username, program_id),
     )
 
 
 @app.route("/sync-fsp")
 def sync_fsp():
-    import subprocess
-    import os
-
     # 🔴 get selected program from session
     program_id = session.get("fsp_program_id")
     if not program_id:
@@ -1755,18 +1655,33 @@ def sync_fsp():
             "message": "❌ No program selected"
         })
 
-    env = os.environ.copy()
-    env["PROGRAM_ID"] = str(program_id)   # 🔑 THIS IS THE FIX
+    # ?mode=repair retries only the failed/missing items of the latest batch
+    # (admins only: it rewrites the batch every device downloads)
+    mode = "repair" if request.args.get("mode") == "repair" else None
+    if mode and not session.get("admin_logged_in"):
+        return jsonify({
+            "success": False,
+            "message": "❌ Only an admin can repair a batch"
+        }), 403
+
+    # A batch pre-built by the scheduler that is still fresh is served as is
+    # (?force=1 always builds a new one)
+    if not mode and request.args.get("force") != "1":
+        fresh = find_fresh_batch(program_id)
+        if fresh:
+            _, info, age = fresh
+            # The scheduler built it in another process: make sure /api/verify has it
+            verify_index.refresh(program_id)
+            return jsonify({
+                "success": True,
+                "message": f"✅ {info.get('recordCount', 0)} beneficiaries ready "
+                           f"(prepared {int(age)} min ago)."
+            })
 
     try:
-        result = subprocess.run(
-            ["python", "offline_sync.py"],
-            capture_output=True,
-            text=True,
-            encoding="utf-8",
-            errors="replace",
-            env=env                      # 🔑 PASS ENV
-        )
+        # Joins a sync already running for this programme instead of
+        # starting another one
+        result = sync_program(program_id, mode=mode)
 
         print("\n[DEBUG] STDOUT:\n", result.stdout)
         print("\n[DEBUG] STDERR:\n", result.stderr)
@@ -1777,6 +1692,9 @@ def sync_fsp():
                 "message": f"❌ Script failed:\n{result.stderr or result.stdout}"
             })
 
+        # Pick up the new batch for /api/verify
+        verify_index.refresh(program_id)
+
         for line in result.stdout.splitlines():
             if "beneficiaries" in line.lower():
                 return jsonify({
@@ -1819,24 +1737,7 @@ def scan():
         url121 = system_config.get("url121")
         if url121:
             try:
-                login_resp = requests.post(
-                    f"{url121}/api/users/login",
-                    json={
-                        "username": system_config.get("username121", ""),
-                        "password": system_config.get("password121", "")
-                    },
-                    timeout=8
-                )
-                if login_resp.status_code == 201:
-                    token = login_resp.json().get("access_token_general")
-                    r = requests.get(
-                        f"{url121}/api/programs/{program_id}",
-                        cookies={"access_token_general": token},
-                        timeout=8
-                    )
-                    if r.status_code == 200:
-                        titles = r.json().get("titlePortal", {})
-                        program_title = titles.get(lang) or next(iter(titles.values()), "")
+                program_title = api121.program_title(program_id, lang, "")
             except Exception as e:
                 print(f"[scan] Failed to fetch 121 program title: {e}")
 
@@ -1862,43 +1763,90 @@ def manifest():
 
 from io import BytesIO
 
+
+def _download_scope(program_id):
+    """
+    The batch scope for this device: the one fixed for the FSP user in
+    FSP_SCOPES, else the one asked for with ?site= / ?payment_ids=, else
+    None (the whole programme).
+    """
+    if program_id:
+        fixed = batch_scope.user_scope(load_config(), session.get("fsp_username"), program_id)
+        if fixed:
+            return fixed
+    return batch_scope.parse_scope_args(request.args)
+
+
+def _fsp_program_id(arg="program_id"):
+    """
+    The FSP's programme: the one selected in the session, so a query
+    parameter cannot switch a scoped user onto another programme's data.
+    """
+    return session.get("fsp_program_id") or request.args.get(arg)
+
+
+def _scope_error(program_id, uuid):
+    """
+    A 404 response when the FSP user's scope (see _download_scope) leaves
+    `uuid` out of the programme's latest batch, else None.
+    """
+    scope = _download_scope(program_id)
+    latest = latest_recent_batch(program_id) if scope else None
+    if not latest:
+        return None
+    try:
+        allowed = batch_scope.uuids_in_scope(latest[0], scope, load_config()["ENCRYPTION_KEY"])
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if uuid not in allowed:
+        return jsonify({"error": "Not in this device's scope"}), 404
+    return None
+
+
 @app.route("/api/offline/latest.zip")
 def api_offline_latest_zip():
-    base_dir = "offline-cache"
-    if not os.path.isdir(base_dir):
-        return jsonify({"error": "No offline cache found"}), 404
-
-    # Filter by programId if provided
-    program_id_filter = request.args.get("programId")
+    if not session.get("fsp_logged_in"):
+        return jsonify({"error": "Not logged in"}), 401
 
-    batch_dirs = []
-    for d in os.listdir(base_dir):
-        full_path = os.path.join(base_dir, d)
-        if not os.path.isdir(full_path):
-            continue
-        # Check batch_info.json for programId match
-        if program_id_filter:
-            batch_info_path = os.path.join(full_path, "batch_info.json")
-            if os.path.exists(batch_info_path):
-                try:
-                    with open(batch_info_path) as f:
-                        batch_info = json.load(f)
-                    if str(batch_info.get("programId")) != str(program_id_filter):
-                        continue
-                except Exception:
-                    pass
-        batch_dirs.append(full_path)
+    program_id_filter = _fsp_program_id("programId")
+    if not program_id_filter:
+        return jsonify({"error": "No active program selected"}), 400
 
-    if not batch_dirs:
+    # The same batch /api/verify, the photo and scope checks and the
+    # submission mapping use
+    latest_batch = latest_recent_batch(program_id_filter)
+    if not latest_batch:
         return jsonify({"error": "No batches found for this program"}), 404
+    latest = latest_batch[0]
 
-    latest = max(batch_dirs, key=os.path.getmtime)
+    # Per-site batch: the FSP user's fixed scope, else ?site= / ?payment_ids=
+    scope = _download_scope(program_id_filter)
+    if scope:
+        try:
+            path = batch_scope.scoped_archive(latest, scope, load_config()["ENCRYPTION_KEY"])
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        return send_file(
+            path,
+            mimetype="application/zip",
+            as_attachment=True,
+            download_name="latest_offline_cache.zip",
+        )
 
     # Zip the latest batch in memory
     mem = BytesIO()
     with zipfile.ZipFile(mem, "w", zipfile.ZIP_DEFLATED) as zf:
         for root, _, files in os.walk(latest):
             for fname in files:
+                if fname in (
+                    match_index.INDEX_FILENAME,
+                    paid_feed.PAID_FILENAME,
+                    photo_store.LOCATORS_FILENAME,
+                    batch_scope.SCOPES_FILENAME,
+                    "journal.jsonl",
+                    "run_info.json",
+                ):
+                    continue  # server-side only (submission lookups, paid-set feed, lazy photos, site index, run state)
                 full_path = os.path.join(root, fname)
                 arcname = os.path.relpath(full_path, latest)  # keep paths relative to batch root
                 zf.write(full_path, arcname)
@@ -1916,6 +1864,22 @@ def ping():
     return "ok", 200
 
 
+@app.route("/ready")
+def ready():
+    """Readiness for the platform health check: 503 until warm-up has finished."""
+    state = warmup.status()
+    return jsonify(state), (200 if state["ready"] else 503)
+
+
+@app.route("/admin/warm-up", methods=["POST"])
+def admin_warm_up():
+    if not session.get("admin_logged_in"):
+        return jsonify({"error": "Unauthorized"}), 401
+
+    started = warmup.start_warm_up()
+    return jsonify({"started": started, **warmup.status()}), 202
+
+
 @app.route("/beneficiary-offline")
 def beneficiary_offline():
     # expected: /beneficiary-offline?uuid=<registrationReferenceId>&lang=en&program_id=<id>
@@ -2000,18 +1964,9 @@ def get_column_to_match(program_id):
 
     if url121 and program_id:
         try:
-            token = get_121_token()
-            if token:
-                r = requests.get(
-                    f"{url121}/api/programs/{program_id}/fsp-configurations",
-                    cookies={"access_token_general": token},
-                    timeout=10
-                )
-                if r.status_code == 200:
-                    for fsp in r.json():
-                        for prop in fsp.get("properties", []):
-                            if prop.get("name") == "columnToMatch":
-                                return prop.get("value")
+            column = api121.column_to_match(program_id)
+            if column:
+                return column
         except Exception as e:
             print(f"[get_column_to_match] API error: {e}")
 
@@ -2021,40 +1976,90 @@ def get_column_to_match(program_id):
 
 
 def get_121_token():
-    import requests
-    config = load_config()
-    username = config.get("username121")
-    password = config.get("password121")
-    base_url = config.get("url121")
-
-    if not username or not password or not base_url:
-        print("❌ Missing 121 credentials")
-        return None
-
-    login_url = f"{base_url}/api/users/login"
+    """The shared 121 service-account token (see api121), or None."""
+    return api121.get_token()
 
-    try:
-        resp = requests.post(
-            login_url,
-            json={"username": username, "password": password},
-            timeout=8
-        )
 
-        if resp.status_code != 201:
-            print(f"❌ Login failed ({resp.status_code}): {resp.text}")
-            return None
+# Reconciliation CSVs larger than this are spooled to a temp file
+SUBMIT_SPOOL_MAX_BYTES = int(os.getenv("SUBMIT_SPOOL_MAX_BYTES", str(1024 * 1024)))
 
-        # 121 API returns token in JSON (correct behaviour)
-        token = resp.json().get("access_token_general")
-        if not token:
-            print("❌ Login succeeded but no token returned")
-            return None
+# A paymentId's rows are uploaded in chunks of at most this many rows
+RECONCILIATION_CHUNK_ROWS = int(os.getenv("RECONCILIATION_CHUNK_ROWS", "5000"))
 
-        return token
+class _ReconciliationGroups:
+    """
+    Submitted rows grouped per paymentId, each group written straight into
+    reconciliation CSVs ({column_to_match},status) of at most chunk_rows
+    rows. A chunk stays in memory up to SUBMIT_SPOOL_MAX_BYTES and spills
+    to a temp file beyond that, so large submissions are never held in
+    memory whole.
+    """
 
-    except Exception as e:
-        print(f"❌ 121 API error: {e}")
-        return None
+    def __init__(self, column_to_match, chunk_rows=None):
+        import tempfile
+
+        self._tempfile = tempfile
+        self.column_to_match = column_to_match
+        self.chunk_rows = chunk_rows or RECONCILIATION_CHUNK_ROWS
+        self._chunks = {}   # paymentId -> [{"file", "writer", "rows", "refs"}]
+        self.counts = {}    # paymentId -> rows
+        self.decisions = [] # (uuid, paymentId, status) for rows with a uuid
+
+    def add(self, payment_id, value, status, ref=None):
+        """Add a row; ref (e.g. the uuid) is reported back if its chunk fails."""
+        chunks = self._chunks.setdefault(payment_id, [])
+        if not chunks or chunks[-1]["rows"] >= self.chunk_rows:
+            f = self._tempfile.SpooledTemporaryFile(
+                max_size=SUBMIT_SPOOL_MAX_BYTES, mode="w+", encoding="utf-8", newline=""
+            )
+            writer = csv.writer(f)
+            writer.writerow([self.column_to_match, "status"])
+            chunks.append({"file": f, "writer": writer, "rows": 0, "refs": []})
+        chunk = chunks[-1]
+        chunk["writer"].writerow([value, status])
+        chunk["rows"] += 1
+        if ref is not None:
+            chunk["refs"].append(ref)
+            self.decisions.append((ref, payment_id, status))
+        self.counts[payment_id] = self.counts.get(payment_id, 0) + 1
+
+    def __bool__(self):
+        return bool(self._chunks)
+
+    def payment_ids(self):
+        return list(self._chunks)
+
+    def chunks(self):
+        """(paymentId, chunk number, rows, refs, read()) for every chunk."""
+        for pid, chunks in self._chunks.items():
+            for number, chunk in enumerate(chunks, start=1):
+                def read(f=chunk["file"]):
+                    f.seek(0)
+                    return f.read()
+                yield pid, number, chunk["rows"], chunk["refs"], read
+
+    def close(self):
+        for chunks in self._chunks.values():
+            for chunk in chunks:
+                chunk["file"].close()
+        self._chunks = {}
+
+
+def _enqueue_reconciliation(program_id, groups, source):
+    """
+    Store every chunk of every paymentId group in the outbox, which
+    delivers them to 121 in the background. Returns the submission id.
+    groups: _ReconciliationGroups.
+    """
+    try:
+        return outbox.enqueue(
+            program_id,
+            ((pid, number, rows, refs, read()) for pid, number, rows, refs, read in groups.chunks()),
+            source=source,
+            decisions=groups.decisions,
+        )
+    finally:
+        groups.close()
 
 
 @app.route('/submit-payments', methods=['POST'])
@@ -2100,27 +2105,11 @@ def submit_payments():
         if file.filename == '':
             return "❌ Empty filename", 400
 
-        try:
-            csv_content = file.stream.read().decode("utf-8")
-        except Exception as e:
-            return f"❌ Failed to read CSV: {e}", 400
-
-        reader = csv.DictReader(io.StringIO(csv_content))
-        rows = list(reader)
-
-        if not rows:
-            return "❌ CSV is empty", 400
-
         # -------------------------------
         # LOAD OFFLINE CACHE FOR PAYMENT MAPPING
         # -------------------------------
         cache_base = "offline-cache"
 
-        import re
-        def extract_batch_number(name):
-            match = re.search(r"payment-recent-batch-(\d+)", name)
-            return int(match.group(1)) if match else -1
-
         # Defensive: cache_base may not exist on a fresh deployment
         if not os.path.isdir(cache_base):
             return (
@@ -2129,155 +2118,118 @@ def submit_payments():
                 400,
             )
 
-        # Filter batch dirs to only those belonging to the active program
-        all_dirs = [d for d in os.listdir(cache_base) if d.startswith("payment-recent-batch-")]
-        program_dirs = []
-        for d in all_dirs:
-            batch_info_path = os.path.join(cache_base, d, "batch_info.json")
-            if os.path.exists(batch_info_path):
-                try:
-                    with open(batch_info_path) as f:
-                        bi = json.load(f)
-                    if str(bi.get("programId")) == str(program_id):
-                        program_dirs.append(d)
-                except Exception:
-                    pass
-            else:
-                program_dirs.append(d)  # include legacy batches without batch_info
-
-        batch_dirs = sorted(program_dirs, key=extract_batch_number)
+        latest_batch = latest_recent_batch(program_id, cache_base)
 
-        if not batch_dirs:
+        if not latest_batch:
             return "❌ No recent payment batches found for this program — run sync first.", 400
+        batch_dir = latest_batch[0]
 
-        latest_batch = batch_dirs[-1]
-        print(f"[DEBUG] Using batch folder: {latest_batch}")
-
-        reg_cache_path = os.path.join(cache_base, latest_batch, "registrations_cache.json")
-        if not os.path.exists(reg_cache_path):
-            return "❌ registrations_cache.json missing — run sync again.", 400
-
-        try:
-            with open(reg_cache_path, "r", encoding="utf-8") as f:
-                reg_data = json.load(f)
-        except Exception as e:
-            return f"❌ Failed to load registrations_cache.json — {e}", 500
+        print(f"[DEBUG] Using batch folder: {batch_dir}")
 
         # -------------------------------
-        # BUILD MAP: plaintext match column → paymentId
+        # MAP: match column value → (paymentId, uuid)
         # -------------------------------
-        match_to_pid = {}
-
-        for record in reg_data:
-            uuid = record.get("uuid")
-            payment_id = record.get("paymentId")
+        # Batches carry a blind index (match_index.json), so only the
+        # submitted rows are hashed; older batches are decrypted in full.
+        index = match_index.load_index(batch_dir)
 
-            encrypted_value = record.get("data", {}).get(column_to_match, "")
-
-            if encrypted_value and payment_id:
-                try:
-                    decrypted_value = fernet.decrypt(encrypted_value.encode()).decode().strip()
-                    match_to_pid[decrypted_value] = payment_id
-                except Exception as e:
-                    print(f"[!] Failed to decrypt value for UUID {uuid}: {e}")
+        if index and index.get("column") == column_to_match:
+            index_key = match_index.index_key(fernet_key)
+            index_entries = index.get("entries", {})
 
-        # -------------------------------
-        # GROUP CSV ROWS BY paymentId
-        # -------------------------------
-        grouped = {}
+            def lookup_payment(value):
+                hit = index_entries.get(match_index.blind_index(index_key, value))
+                return (hit.get("paymentId"), hit.get("uuid")) if hit else (None, None)
+        else:
+            reg_cache_path = os.path.join(batch_dir, "registrations_cache.json")
+            if not os.path.exists(reg_cache_path):
+                return "❌ registrations_cache.json missing — run sync again.", 400
 
-        for row in rows:
-            raw_value = row.get(column_to_match, "").strip()
-            status = row.get("status", "").strip()
+            try:
+                with open(reg_cache_path, "r", encoding="utf-8") as f:
+                    reg_data = json.load(f)
+            except Exception as e:
+                return f"❌ Failed to load registrations_cache.json — {e}", 500
 
-            # If incoming value is still encrypted (rare)
-            if raw_value.startswith("gAAAA"):
-                try:
-                    raw_value = fernet.decrypt(raw_value.encode()).decode().strip()
-                except Exception as e:
-                    print(f"[!] Failed to decrypt incoming {column_to_match}: {raw_value} — {e}")
-                    continue
+            match_to_pid = {}
 
-            payment_id = match_to_pid.get(raw_value)
+            for record in reg_data:
+                uuid = record.get("uuid")
+                payment_id = record.get("paymentId")
 
-            if not payment_id:
-                print(f"[!] No paymentId found for {column_to_match}: {raw_value}")
-                continue
+                encrypted_value = record.get("data", {}).get(column_to_match, "")
 
-            grouped.setdefault(payment_id, []).append({
-                column_to_match: raw_value,
-                "status": status
-            })
+                if encrypted_value and payment_id:
+                    try:
+                        decrypted_value = fernet.decrypt(encrypted_value.encode()).decode().strip()
+                        match_to_pid[decrypted_value] = (payment_id, uuid)
+                    except Exception as e:
+                        print(f"[!] Failed to decrypt value for UUID {uuid}: {e}")
 
-        if not grouped:
-            return (
-                f"❌ No valid rows to submit. Either the CSV's '{column_to_match}' values "
-                "don't match any cached registration, or the column name in the CSV differs "
-                "from the configured matching field. Re-sync and try again.",
-                400,
-            )
+            def lookup_payment(value):
+                return match_to_pid.get(value, (None, None))
 
         # -------------------------------
-        # SUBMIT TO 121 /paymentId/excel-reconciliation
+        # STREAM CSV ROWS, GROUPED BY paymentId
         # -------------------------------
-        token = get_121_token()
-        if not token:
-            return "❌ Login to 121 failed", 401
-
-        success_count = 0
-        fail_count = 0
-        failure_details = []
-
-        for pid, items in grouped.items():
-            output_buffer = io.StringIO()
-            writer = csv.DictWriter(output_buffer, fieldnames=[column_to_match, "status"])
-            writer.writeheader()
-
-            for item in items:
-                writer.writerow({
-                    column_to_match: item[column_to_match],
-                    "status": item["status"]
-                })
+        # Rows are decoded and parsed one at a time and written straight
+        # into their paymentId's reconciliation CSV (spooled to disk when
+        # large), instead of reading the whole upload into memory first.
+        grouped = _ReconciliationGroups(column_to_match)
+        try:
+            row_count = 0
+            try:
+                reader = csv.DictReader(io.TextIOWrapper(file.stream, encoding="utf-8-sig", newline=""))
 
-            upload_url = f"{config['url121']}/api/programs/{program_id}/payments/{pid}/excel-reconciliation"
+                for row in reader:
+                    row_count += 1
+                    raw_value = (row.get(column_to_match) or "").strip()
+                    status = (row.get("status") or "").strip()
+
+                    # If incoming value is still encrypted (rare)
+                    if raw_value.startswith("gAAAA"):
+                        try:
+                            raw_value = fernet.decrypt(raw_value.encode()).decode().strip()
+                        except Exception as e:
+                            print(f"[!] Failed to decrypt incoming {column_to_match}: {raw_value} — {e}")
+                            continue
 
-            files = {"file": ("reconciliation.csv", output_buffer.getvalue(), "text/csv")}
+                    payment_id, uuid = lookup_payment(raw_value)
 
-            try:
-                upload_resp = requests.post(
-                    upload_url,
-                    files=files,
-                    cookies={"access_token_general": token},
-                    timeout=30,
-                )
-            except requests.RequestException as e:
-                fail_count += 1
-                failure_details.append(f"paymentId {pid}: network error — {e}")
-                print(f"[ERROR] Network error submitting paymentId {pid}: {e}")
-                continue
+                    if not payment_id:
+                        print(f"[!] No paymentId found for {column_to_match}: {raw_value}")
+                        continue
 
-            if upload_resp.status_code == 201:
-                success_count += 1
-                print(f"[OK] Submitted to paymentId {pid}")
-            else:
-                fail_count += 1
-                snippet = (upload_resp.text or "")[:300]
-                failure_details.append(
-                    f"paymentId {pid}: HTTP {upload_resp.status_code} — {snippet}"
+                    grouped.add(payment_id, raw_value, status, ref=uuid)
+            except (UnicodeDecodeError, csv.Error) as e:
+                return f"❌ Failed to read CSV: {e}", 400
+
+            if not row_count:
+                return "❌ CSV is empty", 400
+
+            if not grouped:
+                return (
+                    f"❌ No valid rows to submit. Either the CSV's '{column_to_match}' values "
+                    "don't match any cached registration, or the column name in the CSV differs "
+                    "from the configured matching field. Re-sync and try again.",
+                    400,
                 )
-                print(f"[ERROR] Failed to submit to paymentId {pid}: {upload_resp.status_code} — {upload_resp.text}")
 
-        # -------------------------------
-        # FINAL RESPONSE
-        # -------------------------------
-        if success_count > 0:
-            msg = f"✅ Submitted to {success_count} paymentId(s)."
-            if fail_count:
-                msg += f" ❌ {fail_count} failed: " + " | ".join(failure_details)
-            return msg, 200
-        else:
-            detail = " | ".join(failure_details) if failure_details else "no details available"
-            return f"❌ All submissions failed. {detail}", 502
+            # -------------------------------
+            # QUEUE FOR 121 /paymentId/excel-reconciliation
+            # -------------------------------
+            # Stored in the outbox and delivered in the background; poll
+            # /api/submissions/<id> for the outcome per paymentId.
+            payment_count = len(grouped.counts)
+            submission_id = _enqueue_reconciliation(program_id, grouped, source="csv")
+
+            return (
+                f"✅ Queued {sum(grouped.counts.values())} row(s) for {payment_count} paymentId(s). "
+                f"Submission id: {submission_id}",
+                202,
+            )
+        finally:
+            grouped.close()
 
     except Exception as e:
         # Last-resort handler: surface a readable message to the frontend
@@ -2290,6 +2242,286 @@ def submit_payments():
         )
 
 
+@app.route("/api/submit-decisions", methods=["POST"])
+def api_submit_decisions():
+    """
+    JSON payment submission: {"decisions": [{"uuid", "paymentId", "status"}]}.
+
+    The device already knows each beneficiary's paymentId, so decisions are
+    grouped by it directly. The match column value 121 needs is looked up
+    per submitted uuid in the batch's match index (and decrypted only for
+    those), instead of decrypting the whole offline cache. The resulting
+    chunks are queued in the outbox; the response (202) carries the
+    submission id to poll at /api/submissions/<id>.
+    """
+    import traceback
+    from cryptography.fernet import Fernet
+
+    # Accepted decisions mark vouchers paid everywhere (verify, paid-set feed)
+    if not session.get("fsp_logged_in"):
+        return jsonify({"error": "Not logged in"}), 401
+
+    try:
+        config = load_config()
+        program_id = session.get("fsp_program_id")
+        fernet_key = config.get("ENCRYPTION_KEY")
+
+        if not program_id:
+            return jsonify({"error": "No active program selected. Please go back and select a program."}), 400
+        if not fernet_key:
+            return jsonify({"error": "Missing ENCRYPTION_KEY in system configuration"}), 400
+
+        payload = request.get_json(silent=True) or {}
+        decisions = payload.get("decisions") or []
+        if not isinstance(decisions, list) or not decisions:
+            return jsonify({"error": "No decisions provided"}), 400
+
+        column_to_match = get_column_to_match(program_id)
+        if not column_to_match:
+            return jsonify({"error": f"Could not determine columnToMatch for program {program_id}."}), 400
+
+        latest_batch = latest_recent_batch(program_id)
+        if not latest_batch:
+            return jsonify({"error": "No recent payment batches found for this program — run sync first."}), 400
+        batch_dir = latest_batch[0]
+
+        # uuid → {"paymentId", "value" (encrypted match value)}
+        index = match_index.load_index(batch_dir)
+        if index and index.get("column") == column_to_match and "byUuid" in index:
+            by_uuid = index["byUuid"]
+        else:
+            # Batch synced without a uuid index: read the cache, but still
+            # only decrypt the submitted uuids below
+            with open(os.path.join(batch_dir, "registrations_cache.json"), "r", encoding="utf-8") as f:
+                by_uuid = {
+                    r.get("uuid"): {
+                        "paymentId": r.get("paymentId"),
+                        "value": (r.get("data") or {}).get(column_to_match),
+                    }
+                    for r in json.load(f)
+                }
+
+        fernet = Fernet(fernet_key.encode())
+        grouped = _ReconciliationGroups(column_to_match)
+        try:
+            rejected = []
+
+            for d in decisions:
+                if not isinstance(d, dict):
+                    rejected.append({"uuid": None, "reason": "not a decision object"})
+                    continue
+                uuid = str(d.get("uuid") or "").split(":")[-1]  # accept "programId:uuid" too
+                status = str(d.get("status") or "").strip()
+                known = by_uuid.get(uuid)
+
+                if not known or not known.get("value"):
+                    rejected.append({"uuid": uuid, "reason": "not in the latest batch"})
+                    continue
+                if d.get("paymentId") is not None and str(d["paymentId"]) != str(known["paymentId"]):
+                    rejected.append({
+                        "uuid": uuid,
+                        "reason": f"paymentId {d['paymentId']} does not match {known['paymentId']}",
+                    })
+                    continue
+
+                try:
+                    value = fernet.decrypt(known["value"].encode()).decode().strip()
+                except Exception as e:
+                    rejected.append({"uuid": uuid, "reason": f"could not decrypt {column_to_match}"})
+                    print(f"[!] Failed to decrypt {column_to_match} for UUID {uuid}: {e}")
+                    continue
+
+                grouped.add(known["paymentId"], value, status, ref=uuid)
+
+            if not grouped:
+                return jsonify({
+                    "error": "No valid decisions to submit. Re-sync and try again.",
+                    "rejected": rejected,
+                }), 400
+
+            payments = dict(grouped.counts)
+            submission_id = _enqueue_reconciliation(program_id, grouped, source="decisions")
+
+            return jsonify({
+                "submissionId": submission_id,
+                "statusUrl": url_for("api_submission_status", submission_id=submission_id),
+                "payments": payments,
+                "rejected": rejected,
+            }), 202
+        finally:
+            grouped.close()
+
+    except Exception as e:
+        tb = traceback.format_exc()
+        print(f"[FATAL] /api/submit-decisions crashed: {e}\n{tb}")
+        return jsonify({"error": f"Server error: {type(e).__name__}: {e}"}), 500
+
+
+@app.route("/api/submissions/<submission_id>")
+def api_submission_status(submission_id):
+    """
+    Delivery status of a queued submission: overall and per paymentId
+    (pending, done, failed or partial), with the uuids of failed chunks.
+    """
+    if not (session.get("fsp_logged_in") or session.get("admin_logged_in")):
+        return jsonify({"error": "Not logged in"}), 401
+
+    status = outbox.submission_status(submission_id)
+    if status is None:
+        return jsonify({"error": "Unknown submission"}), 404
+    return jsonify(status)
+
+
+@app.route("/api/verify/<uuid>")
+def api_verify(uuid):
+    """
+    Online voucher check for well-connected sites: answers from the
+    in-memory index of the latest batch plus payments already sent to the
+    outbox (verify_index.py), instead of the device syncing the programme.
+    The record's display fields stay encrypted, as in the offline cache.
+    """
+    if not session.get("fsp_logged_in"):
+        return jsonify({"error": "Not logged in"}), 401
+
+    program_id = _fsp_program_id()
+    if not program_id:
+        return jsonify({"error": "No active program selected"}), 400
+
+    uuid = uuid.split(":")[-1]  # accept "programId:uuid" too
+    scope_error = _scope_error(program_id, uuid)
+    if scope_error:
+        return scope_error
+    try:
+        result = verify_index.lookup(program_id, uuid)
+    except Exception as e:
+        print(f"[VERIFY] Lookup failed for {uuid}: {e}")
+        return jsonify({"error": f"Verification unavailable: {e}"}), 503
+
+    if result is None:
+        return jsonify({"uuid": uuid, "programId": str(program_id), "valid": False, "reason": "not_found"}), 404
+    return jsonify(result)
+
+
+@app.route("/api/photos/<uuid>")
+def api_photo(uuid):
+    """
+    A beneficiary's photo, Fernet-encrypted like photos/<uuid>.enc in a
+    batch, for programmes with lazy photos (photo_store.py).
+    """
+    if not session.get("fsp_logged_in"):
+        return jsonify({"error": "Not logged in"}), 401
+
+    program_id = _fsp_program_id()
+    if not program_id:
+        return jsonify({"error": "No active program selected"}), 400
+
+    uuid = uuid.split(":")[-1]  # accept "programId:uuid" too
+    scope_error = _scope_error(program_id, uuid)
+    if scope_error:
+        return scope_error
+    try:
+        data = photo_store.get_photo(program_id, uuid)
+    except photo_store.PhotoUnavailable as e:
+        return jsonify({"error": f"Photo unavailable: {e}"}), 404
+    except Exception as e:
+        print(f"[PHOTO] Fetch failed for {uuid}: {e}")
+        return jsonify({"error": f"Photo unavailable: {e}"}), 503
+
+    if data is None:
+        return jsonify({"error": "No photo for this beneficiary"}), 404
+
+    response = send_file(BytesIO(data), mimetype="application/octet-stream")
+    response.headers["Cache-Control"] = "private, max-age=86400"
+    return response
+
+
+@app.route("/api/photos/<uuid>/next")
+def api_photo_next(uuid):
+    """The lazy-photo uuids after this one in batch order, for the device to prefetch."""
+    if not session.get("fsp_logged_in"):
+        return jsonify({"error": "Not logged in"}), 401
+
+    program_id = _fsp_program_id()
+    if not program_id:
+        return jsonify({"error": "No active program selected"}), 400
+
+    try:
+        count = min(int(request.args.get("count", photo_store.PHOTO_PREFETCH_COUNT)), 100)
+    except ValueError:
+        return jsonify({"error": "count must be a number"}), 400
+
+    # Only prefetch within the device's scope (?site= / ?payment_ids=)
+    allowed = None
+    scope = _download_scope(program_id)
+    latest = latest_recent_batch(program_id) if scope else None
+    if latest:
+        try:
+            allowed = batch_scope.uuids_in_scope(latest[0], scope, load_config()["ENCRYPTION_KEY"])
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+    uuid = uuid.split(":")[-1]
+    return jsonify({"uuids": photo_store.next_uuids(program_id, uuid, count, allowed)})
+
+
+@app.route("/api/paid-set")
+def api_paid_set():
+    """
+    Paid uuids per paymentId added since ?since=<version> (0 = all), for
+    the scan page's cross-device "already paid" check (paid_feed.py).
+    """
+    if not session.get("fsp_logged_in"):
+        return jsonify({"error": "Not logged in"}), 401
+
+    program_id = _fsp_program_id()
+    if not program_id:
+        return jsonify({"error": "No active program selected"}), 400
+
+    try:
+        since = int(request.args.get("since", 0))
+    except ValueError:
+        return jsonify({"error": "since must be a number"}), 400
+
+    return jsonify(paid_feed.changes(program_id, since))
+
+
+@app.route("/api/vouchers/public-key")
+def api_voucher_public_key():
+    """Ed25519 public key(s) for verifying signed voucher QR codes."""
+    return jsonify({"algorithm": "Ed25519", "keys": voucher_signing.public_keys()})
+
+
+@app.route("/api/vouchers/revocations", methods=["GET", "POST"])
+def api_voucher_revocations():
+    """
+    GET: the programme's revoked voucher reference ids (FSP or admin).
+    POST (admin): {"programId", "referenceIds": [...], "restore": false}
+    revokes the given vouchers, or reinstates them with restore=true.
+    """
+    if request.method == "POST":
+        if not session.get("admin_logged_in"):
+            return jsonify({"error": "Unauthorized"}), 401
+        payload = request.get_json(silent=True) or {}
+        program_id = payload.get("programId")
+        reference_ids = payload.get("referenceIds") or []
+        if not program_id or not isinstance(reference_ids, list):
+            return jsonify({"error": "programId and a referenceIds list are required"}), 400
+        return jsonify(voucher_signing.update_revocations(
+            program_id, reference_ids, restore=bool(payload.get("restore"))
+        ))
+
+    if not (session.get("fsp_logged_in") or session.get("admin_logged_in")):
+        return jsonify({"error": "Not logged in"}), 401
+    # An admin may ask for any programme; an FSP only gets their own
+    if session.get("admin_logged_in") and request.args.get("program_id"):
+        program_id = request.args.get("program_id")
+    else:
+        program_id = _fsp_program_id()
+    if not program_id:
+        return jsonify({"error": "No active program selected"}), 400
+    return jsonify(voucher_signing.revocations(program_id))
+
+
 @app.route("/invalid-qr")
 def invalid_qr():
     # keep previously-selected language
@@ -2331,6 +2563,7 @@ def voucher_design():
             "logo2": existing.get("logo2"),
             "logo1_size": _clean_size(request.form.get("logo1_size") or existing.get("logo1_size")),
             "logo2_size": _clean_size(request.form.get("logo2_size") or existing.get("logo2_size")),
+            "signed_qr": request.form.get("signed_qr") == "1",
         }
 
         # Explicit clears
@@ -2706,6 +2939,7 @@ def vouchers_download():
         rows,
         static_folder=os.path.join(app.root_path, "static"),
         design=design,
+        program_id=program_id,
     )
 
     return send_file(
@@ -2713,4 +2947,8 @@ def vouchers_download():
         mimetype="application/pdf",
         as_attachment=True,
         download_name="vouchers.pdf"
-    )
\ No newline at end of file
+    )
+
+
+# `gunicorn app:app` and `flask run` use the module-level app directly
+create_app()
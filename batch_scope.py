@@ -0,0 +1,199 @@
+import hashlib
+import hmac
+import json
+import os
+import shutil
+import threading
+import time
+import zipfile
+
+
+# ---------------------------------------------------------------------------
+# Per-site (scoped) offline batches.
+#
+# A programme running many distribution sites does not need to ship every
+# site's beneficiaries to every device. A scope narrows a batch down to:
+#   - "sites": values of the programme's scopeAttribute (a registration
+#     attribute such as "village", set on its PROGRAMS entry), and/or
+#   - "paymentIds": an explicit list of payments.
+#
+# offline_sync.py still builds one batch per programme, and when the
+# programme has a scopeAttribute it writes scopes.json next to it
+# (server-side only): every uuid's attribute value as a keyed digest, so
+# the file holds no plaintext site names. The archive a device downloads
+# (/api/offline/latest.zip) is then cut from that batch for the device's
+# scope: records, transactions and photos of the scope only, built once
+# per batch + scope and kept under SCOPED_ARCHIVE_DIR.
+#
+# An FSP user's scope per programme can be fixed in system_config.json
+# (FSP_SCOPES); otherwise the FSP picks it on the FSP admin page.
+# ---------------------------------------------------------------------------
+
+SCOPES_FILENAME = "scopes.json"
+
+SCOPED_ARCHIVE_DIR = os.getenv("SCOPED_ARCHIVE_DIR", "offline-scoped")
+SCOPED_ARCHIVE_RETENTION_HOURS = float(os.getenv("SCOPED_ARCHIVE_RETENTION_HOURS", "24"))
+
+
+def scope_key(encryption_key):
+    """HMAC key for site digests, derived from (and distinct from) the Fernet key."""
+    return hmac.new(encryption_key.encode(), b"scandroid scope index v1", hashlib.sha256).digest()
+
+
+def scope_digest(key, value):
+    """Digest of a site value (case and surrounding whitespace ignored)."""
+    return hmac.new(key, str(value).strip().lower().encode(), hashlib.sha256).hexdigest()
+
+
+def make_scope(sites=(), payment_ids=()):
+    """
+    A normalised scope {"sites": [...], "paymentIds": [...]}, or None when
+    both are empty (the whole programme).
+    """
+    sites = sorted({str(s).strip() for s in sites if str(s).strip()})
+    payment_ids = sorted({str(p).strip() for p in payment_ids if str(p).strip()})
+    if not sites and not payment_ids:
+        return None
+    return {"sites": sites, "paymentIds": payment_ids}
+
+
+def parse_scope_args(args):
+    """The scope from ?site=a,b&payment_ids=1,2 (repeated params also work)."""
+    def values(name):
+        return [v for raw in args.getlist(name) for v in raw.split(",")]
+    return make_scope(values("site"), values("payment_ids"))
+
+
+def user_scope(config, username, program_id):
+    """The scope fixed for an FSP user in FSP_SCOPES, or None."""
+    entry = ((config.get("FSP_SCOPES") or {}).get(str(username or "")) or {}).get(str(program_id))
+    if not entry:
+        return None
+    return make_scope(entry.get("sites") or [], entry.get("paymentIds") or [])
+
+
+def scope_id(scope):
+    return hashlib.sha256(json.dumps(scope, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def _load_json(path, default=None):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+
+
+def _batch_mtime(batch_dir):
+    """Changes when the batch is replaced or repaired in place."""
+    return os.path.getmtime(os.path.join(batch_dir, "batch_info.json"))
+
+
+def _in_scope(batch_dir, scope, encryption_key):
+    """Predicate on a record / transaction (uuid, paymentId) for the scope."""
+    digests = None
+    if scope["sites"]:
+        index = _load_json(os.path.join(batch_dir, SCOPES_FILENAME))
+        if index is None:
+            raise ValueError("this programme's batches have no site attribute (scopeAttribute)")
+        key = scope_key(encryption_key)
+        wanted = {scope_digest(key, s) for s in scope["sites"]}
+        digests = index.get("byUuid", {})
+    payment_ids = set(scope["paymentIds"])
+
+    def matches(uuid, payment_id):
+        if digests is not None and digests.get(uuid) not in wanted:
+            return False
+        return not payment_ids or str(payment_id) in payment_ids
+    return matches
+
+
+_uuid_cache_lock = threading.Lock()
+_uuid_cache = {}   # (batch_dir, batch mtime, scope id) -> frozenset of uuids
+
+
+def uuids_in_scope(batch_dir, scope, encryption_key):
+    """The uuids of a batch's records that are in the scope."""
+    cache_key = (batch_dir, _batch_mtime(batch_dir), scope_id(scope))
+    with _uuid_cache_lock:
+        cached = _uuid_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    matches = _in_scope(batch_dir, scope, encryption_key)
+    records = _load_json(os.path.join(batch_dir, "registrations_cache.json"), [])
+    uuids = frozenset(r["uuid"] for r in records if matches(r.get("uuid"), r.get("paymentId")))
+    with _uuid_cache_lock:
+        if len(_uuid_cache) > 64:
+            _uuid_cache.clear()
+        _uuid_cache[cache_key] = uuids
+    return uuids
+
+
+def _write_archive(batch_dir, scope, encryption_key, path):
+    matches = _in_scope(batch_dir, scope, encryption_key)
+    records = [
+        r for r in _load_json(os.path.join(batch_dir, "registrations_cache.json"), [])
+        if matches(r.get("uuid"), r.get("paymentId"))
+    ]
+    uuids = {r["uuid"] for r in records}
+    transactions = [
+        t for t in _load_json(os.path.join(batch_dir, "transactions.json"), [])
+        if t.get("registrationReferenceId") in uuids
+    ]
+    info = _load_json(os.path.join(batch_dir, "batch_info.json"), {})
+    info.update({"scope": scope, "recordCount": len(records)})
+    info["failures"] = [f for f in info.get("failures", []) if f.get("uuid") in uuids]
+
+    photos_dir = os.path.join(batch_dir, "photos")
+    photos = [
+        f for f in (os.listdir(photos_dir) if os.path.isdir(photos_dir) else [])
+        if f.endswith(".enc") and f[:-4] in uuids
+    ]
+    if "photoCount" in info:
+        info["photoCount"] = len(photos)
+
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("registrations_cache.json", json.dumps(records, indent=2))
+        zf.writestr("transactions.json", json.dumps(transactions, indent=2))
+        zf.writestr("batch_info.json", json.dumps(info, indent=2))
+        for fname in photos:
+            zf.write(os.path.join(photos_dir, fname), f"photos/{fname}")
+    os.replace(tmp_path, path)
+    print(
+        f"[SCOPE] Built {os.path.basename(path)} for {os.path.basename(batch_dir)}: "
+        f"{len(records)} records, {len(photos)} photos"
+    )
+
+
+_build_lock = threading.Lock()
+_last_prune = 0
+
+
+def _prune():
+    """Drop archives not downloaded for SCOPED_ARCHIVE_RETENTION_HOURS."""
+    global _last_prune
+    if time.time() - _last_prune < 3600 or not os.path.isdir(SCOPED_ARCHIVE_DIR):
+        return
+    _last_prune = time.time()
+    cutoff = time.time() - SCOPED_ARCHIVE_RETENTION_HOURS * 3600
+    for d in os.listdir(SCOPED_ARCHIVE_DIR):
+        path = os.path.join(SCOPED_ARCHIVE_DIR, d)
+        if os.path.getmtime(path) < cutoff:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def scoped_archive(batch_dir, scope, encryption_key):
+    """Path of the batch's zip for the scope, building it on first use."""
+    out_dir = os.path.join(SCOPED_ARCHIVE_DIR, os.path.basename(batch_dir))
+    path = os.path.join(out_dir, f"{scope_id(scope)}.zip")
+    # A batch repaired in place gets its archives rebuilt
+    if os.path.exists(path) and os.path.getmtime(path) >= _batch_mtime(batch_dir):
+        os.utime(out_dir)
+        return path
+    with _build_lock:
+        _prune()
+        if not os.path.exists(path) or os.path.getmtime(path) < _batch_mtime(batch_dir):
+            os.makedirs(out_dir, exist_ok=True)
+            _write_archive(batch_dir, scope, encryption_key, path)
+    return path
@@ -1,5 +1,8 @@
+import copy
 import json
 import os
+import threading
+from contextlib import contextmanager
 
 # Optional: load a local .env file during development so the env-managed fields
 # below can be set without exporting them in your shell. On Azure these values
@@ -36,7 +39,30 @@ ENV_MANAGED_FIELDS = {
 }
 
 
-def _get_paths():
+# ---------------------------------------------------------------------------
+# In-process cache of the parsed JSON files.
+#
+# load_config() runs several times per request (every template render goes
+# through the context processor), and on Azure the files sit on slow network
+# storage. Each file's parsed content is kept together with its mtime and
+# size; a load only stats the file and re-reads it when either changed
+# (e.g. another worker saved it). Saves write atomically (temp file +
+# rename) and update the cache straight away. Loads return deep copies, so
+# callers can modify the result freely.
+#
+# An atomic write does not stop two load-modify-save cycles from losing one
+# another's change: callers that update a file in place hold update_lock()
+# from the load to the save.
+# ---------------------------------------------------------------------------
+_cache_lock = threading.Lock()
+_file_cache = {}      # path -> (stat key, parsed data)
+_created_dirs = set()
+
+_update_lock = threading.Lock()
+
+
+def config_dir():
+    """Folder holding the active context's config files (created if missing)."""
     env = os.getenv("SCANDROID_ENV", "local")
     context = os.getenv("SCANDROID_CONTEXT", "local")
 
@@ -45,13 +71,63 @@ def _get_paths():
     else:
         base = os.path.join(os.path.dirname(__file__), "configs", context)
 
-    os.makedirs(base, exist_ok=True)
+    if base not in _created_dirs:
+        os.makedirs(base, exist_ok=True)
+        _created_dirs.add(base)
+    return base
+
+
+def _get_paths():
+    base = config_dir()
     return (
         os.path.join(base, "system_config.json"),
         os.path.join(base, "display_config.json"),
     )
 
 
+def _stat_key(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def _read_json(path):
+    """Parsed content of a JSON file ({} if missing), cached by mtime + size."""
+    key = _stat_key(path)
+    with _cache_lock:
+        cached = _file_cache.get(path)
+    if cached is not None and cached[0] == key:
+        return copy.deepcopy(cached[1])
+
+    data = {}
+    if key is not None:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    with _cache_lock:
+        _file_cache[path] = (key, data)
+    return copy.deepcopy(data)
+
+
+def _write_json(path, data):
+    """Write atomically (temp file + rename), so readers never see half a file."""
+    tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+            st = os.fstat(f.fileno())  # a rename keeps mtime and size
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    with _cache_lock:
+        _file_cache[path] = ((st.st_mtime_ns, st.st_size), copy.deepcopy(data))
+
+
 def _apply_env_overrides(data):
     """Overlay env-managed fields onto the JSON data.
 
@@ -67,13 +143,30 @@ def _apply_env_overrides(data):
     return data
 
 
+@contextmanager
+def update_lock():
+    """
+    Exclusive lock around a load-modify-save of the config files, shared by
+    the threads of this process and (through a lock file) by every worker.
+    Not re-entrant.
+    """
+    with _update_lock:
+        try:
+            import fcntl
+        except ImportError:
+            yield  # no flock (Windows dev box): single process assumed
+            return
+        with open(os.path.join(config_dir(), ".update.lock"), "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
 def load_config():
     system_path, _ = _get_paths()
-    data = {}
-    if os.path.exists(system_path):
-        with open(system_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-    return _apply_env_overrides(data)
+    return _apply_env_overrides(_read_json(system_path))
 
 
 def save_config(data):
@@ -85,19 +178,14 @@ def save_config(data):
     """
     system_path, _ = _get_paths()
     to_save = {k: v for k, v in data.items() if k not in ENV_MANAGED_FIELDS}
-    with open(system_path, "w", encoding="utf-8") as f:
-        json.dump(to_save, f, indent=2, ensure_ascii=False)
+    _write_json(system_path, to_save)
 
 
 def load_display_config():
     _, display_path = _get_paths()
-    if not os.path.exists(display_path):
-        return {}
-    with open(display_path, "r", encoding="utf-8") as f:
-        return json.load(f)
+    return _read_json(display_path)
 
 
 def save_display_config(data):
     _, display_path = _get_paths()
-    with open(display_path, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
\ No newline at end of file
+    _write_json(display_path, data)
\ No newline at end of file
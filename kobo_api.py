@@ -0,0 +1,176 @@
+import os
+
+from api121 import pooled_session
+from config_loader import load_config
+from ttl_cache import TTLCache
+from upstream import CircuitBreaker
+
+
+# ---------------------------------------------------------------------------
+# Kobo asset schema cache.
+#
+# The admin config pages only need a few things from a Kobo asset (its image
+# questions and their paths, name and owner), but the asset JSON carries the
+# whole form. What we extract is cached per Kobo server + asset id together
+# with the asset's version_id and the response's ETag / Last-Modified.
+#
+# Within KOBO_SCHEMA_TTL_SECONDS the cached entry is used as is. After that
+# it is revalidated with a conditional request: a 304, or a 200 carrying the
+# same version_id, keeps the extracted fields, and only a new version is
+# parsed again.
+# ---------------------------------------------------------------------------
+
+KOBO_SCHEMA_TTL_SECONDS = float(os.getenv("KOBO_SCHEMA_TTL_SECONDS", "300"))
+KOBO_SCHEMA_STALE_SECONDS = float(os.getenv("KOBO_SCHEMA_STALE_SECONDS", "3600"))
+KOBO_SCHEMA_CACHE_PATH = os.path.join(
+    os.getenv("METADATA_CACHE_DIR", "metadata-cache"), "kobo-assets.json"
+)
+
+DEFAULT_KOBO_SERVER = "https://kobo.ifrc.org"
+
+SESSION = pooled_session(int(os.getenv("HTTP_POOL_SIZE", "16")))
+
+
+def _probe():
+    """Kobo is reachable again when its API answers without a 5xx."""
+    kobo_server = load_config().get("KOBO_SERVER") or DEFAULT_KOBO_SERVER
+    return SESSION.get(f"{kobo_server}/api/v2/", timeout=5).status_code < 500
+
+
+# Opens when Kobo keeps failing; a cached schema is then served as is
+breaker = CircuitBreaker("kobo", _probe)
+
+schema_cache = TTLCache(
+    KOBO_SCHEMA_TTL_SECONDS,
+    stale_ttl=KOBO_SCHEMA_STALE_SECONDS,
+    persist_path=KOBO_SCHEMA_CACHE_PATH,
+)
+
+
+def kobo_field_path(item):
+    """Full question path of a survey item ("group/photo"), or None."""
+    if not isinstance(item, dict):
+        return None
+
+    if "$xpath" in item:
+        return item["$xpath"].replace("/data/", "").replace("data/", "").strip("/")
+
+    parts = []
+    current = item
+    while isinstance(current, dict):
+        if current.get("name"):
+            parts.append(current["name"])
+        current = current.get("parent")
+
+    return "/".join(reversed(parts)) if parts else None
+
+
+def _item_label(item):
+    raw_label = item.get("label")
+
+    if isinstance(raw_label, dict):
+        return (
+            raw_label.get("English")
+            or raw_label.get("en")
+            or next(iter(raw_label.values()), kobo_field_path(item))
+        )
+
+    if isinstance(raw_label, list) and raw_label:
+        first = raw_label[0]
+        if isinstance(first, dict):
+            return (
+                first.get("English")
+                or first.get("en")
+                or next(iter(first.values()), kobo_field_path(item))
+            )
+        return str(first)
+
+    return kobo_field_path(item)
+
+
+def extract_image_fields(asset):
+    """[{"name": path, "label": label}] for every image question in an asset."""
+    fields = []
+    for item in asset.get("content", {}).get("survey", []):
+        if not isinstance(item, dict) or item.get("type") != "image":
+            continue
+        path = kobo_field_path(item)
+        if path:
+            fields.append({"name": path, "label": _item_label(item)})
+    return fields
+
+
+def _fetch_schema(kobo_server, kobo_token, asset_id, previous=None):
+    headers = {"Authorization": f"Token {kobo_token}"}
+    if previous:
+        if previous.get("etag"):
+            headers["If-None-Match"] = previous["etag"]
+        if previous.get("lastModified"):
+            headers["If-Modified-Since"] = previous["lastModified"]
+
+    r = breaker.call(
+        SESSION.get,
+        f"{kobo_server}/api/v2/assets/{asset_id}/?format=json",
+        headers=headers,
+        timeout=10,
+    )
+    if r.status_code == 304 and previous:
+        return previous
+    r.raise_for_status()
+
+    asset = r.json()
+    entry = {
+        "version": asset.get("version_id") or asset.get("date_modified"),
+        "etag": r.headers.get("ETag"),
+        "lastModified": r.headers.get("Last-Modified"),
+        "name": asset.get("name"),
+        "owner": asset.get("owner__username"),
+    }
+    if previous and entry["version"] and previous.get("version") == entry["version"]:
+        entry["imageFields"] = previous["imageFields"]
+    else:
+        entry["imageFields"] = extract_image_fields(asset)
+    return entry
+
+
+def get_asset_schema(asset_id, kobo_server=None, kobo_token=None, refresh=False):
+    """
+    Cached schema summary for a Kobo asset:
+    {"version", "etag", "lastModified", "name", "owner", "imageFields"}.
+    Server and token default to KOBO_SERVER / KOBO_TOKEN from the config;
+    refresh=True revalidates with Kobo now. Raises on upstream errors when
+    nothing is cached.
+    """
+    if not kobo_server or not kobo_token:
+        config = load_config()
+        kobo_server = kobo_server or config.get("KOBO_SERVER") or DEFAULT_KOBO_SERVER
+        kobo_token = kobo_token or config.get("KOBO_TOKEN")
+    if not kobo_token or not asset_id:
+        raise ValueError("Kobo token and asset id are required")
+
+    key = f"{kobo_server}|{asset_id}"
+    previous = schema_cache.peek(key)
+
+    def load():
+        return _fetch_schema(kobo_server, kobo_token, asset_id, previous)
+
+    if refresh:
+        entry = load()
+        schema_cache.set(key, entry)
+        return entry
+    return schema_cache.get(key, load)
+
+
+def get_image_fields(asset_id, kobo_server=None, kobo_token=None):
+    """The image questions of a Kobo asset (see extract_image_fields), cached."""
+    return get_asset_schema(asset_id, kobo_server, kobo_token)["imageFields"]
+
+
+def invalidate_asset_schema(asset_id=None):
+    """Forget one asset's cached schema, or all of them."""
+    if asset_id is None:
+        schema_cache.invalidate()
+        return
+    config = load_config()
+    kobo_server = config.get("KOBO_SERVER") or DEFAULT_KOBO_SERVER
+    schema_cache.invalidate(key=f"{kobo_server}|{asset_id}")
@@ -0,0 +1,47 @@
+import hashlib
+import hmac
+import json
+import os
+
+
+# ---------------------------------------------------------------------------
+# Blind index of match-column values (e.g. phone numbers) for a batch.
+#
+# /submit-payments has to map each submitted match value to its paymentId.
+# Instead of decrypting the match column of every cached record, the sync
+# writes match_index.json next to registrations_cache.json:
+#
+#   {"column": "phoneNumber",
+#    "entries": {HMAC-SHA256(value): {"paymentId": ..., "uuid": ...}},
+#    "byUuid":  {uuid: {"paymentId": ..., "value": <Fernet-encrypted value>}}}
+#
+# The HMAC key is derived from ENCRYPTION_KEY, so the file holds no
+# plaintext and cannot be checked against guessed values without the key.
+# CSV submission only hashes the rows it receives; JSON submission
+# (uuid + paymentId per decision) only decrypts the submitted uuids' values.
+# ---------------------------------------------------------------------------
+
+INDEX_FILENAME = "match_index.json"
+
+
+def index_key(encryption_key):
+    """HMAC key for the index, derived from (and distinct from) the Fernet key."""
+    return hmac.new(encryption_key.encode(), b"scandroid match index v1", hashlib.sha256).digest()
+
+
+def blind_index(key, value):
+    """Index digest of a match value (surrounding whitespace ignored)."""
+    return hmac.new(key, str(value).strip().encode(), hashlib.sha256).hexdigest()
+
+
+def load_index(batch_dir):
+    """The batch's match index, or None for batches synced without one."""
+    path = os.path.join(batch_dir, INDEX_FILENAME)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"[match_index] Could not read {path}: {e}")
+        return None
@@ -0,0 +1,101 @@
+import json
+import os
+from datetime import datetime, timedelta
+
+
+# ---------------------------------------------------------------------------
+# Local mirror of 121 transactions + projected registration fields.
+#
+# One JSON file per programme under MIRROR_DIR. offline_sync.py refreshes it
+# incrementally (only rows whose created/updated is past the stored
+# watermark) and batch building reads from it instead of re-pulling the whole
+# programme from 121 on every sync.
+#
+# Registration values are stored Fernet-encrypted, exactly as they end up in
+# registrations_cache.json, so the mirror never holds plaintext PII and batch
+# building can copy the values straight through.
+#
+# The mirror deliberately lives OUTSIDE offline-cache/: everything in there
+# is treated as a batch directory by /api/offline/latest.zip.
+# ---------------------------------------------------------------------------
+MIRROR_DIR = os.getenv("OFFLINE_MIRROR_DIR", "offline-mirror")
+
+# A full reconcile (re-pull everything, drop rows that disappeared upstream)
+# runs when the last one is older than this. Incremental refreshes cannot see
+# deletes, so this is what eventually catches them.
+FULL_RECONCILE_HOURS = float(os.getenv("MIRROR_FULL_RECONCILE_HOURS", "24"))
+
+
+def _mirror_path(program_id):
+    return os.path.join(MIRROR_DIR, f"program-{program_id}.json")
+
+
+def _empty_mirror(program_id):
+    return {
+        "programId": str(program_id),
+        "projection": [],
+        "watermarks": {"transactions": None, "registrations": None},
+        "lastFullReconcile": None,
+        "transactions": {},
+        "registrations": {},
+    }
+
+
+def load_mirror(program_id):
+    """Return the stored mirror for a programme, or an empty one."""
+    path = _mirror_path(program_id)
+    if not os.path.exists(path):
+        return _empty_mirror(program_id)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        # A corrupt mirror is just a cache miss: the next refresh rebuilds it.
+        return _empty_mirror(program_id)
+
+    mirror = _empty_mirror(program_id)
+    mirror.update(data)
+    return mirror
+
+
+def save_mirror(program_id, mirror):
+    """Write the mirror atomically (temp file + rename)."""
+    os.makedirs(MIRROR_DIR, exist_ok=True)
+    path = _mirror_path(program_id)
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(mirror, f)
+    os.replace(tmp_path, path)
+
+
+def row_timestamp(row):
+    """The change timestamp used for watermarks: updated, else created."""
+    return row.get("updated") or row.get("created") or ""
+
+
+def transaction_key(t):
+    """Stable key for a mirrored transaction row."""
+    if t.get("id") is not None:
+        return str(t["id"])
+    return f"{t.get('registrationReferenceId')}:{t.get('paymentId')}"
+
+
+def needs_full_reconcile(mirror, projection, now=None):
+    """True when the mirror must be rebuilt from scratch.
+
+    That is the case for a fresh mirror, when the projected field set changed
+    (e.g. an admin added a display field) or when the last full reconcile is
+    older than FULL_RECONCILE_HOURS.
+    """
+    if not mirror.get("lastFullReconcile"):
+        return True
+    if sorted(mirror.get("projection") or []) != sorted(projection):
+        return True
+
+    now = now or datetime.utcnow()
+    try:
+        last = datetime.strptime(mirror["lastFullReconcile"], "%Y-%m-%dT%H:%M:%S.%fZ")
+    except ValueError:
+        return True
+    return now - last >= timedelta(hours=FULL_RECONCILE_HOURS)
+
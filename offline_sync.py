@@ -20,13 +20,29 @@ logger = logging.getLogger(__name__)
 
 import os
 import json
-import requests
+import queue
+import shutil
+import threading
+import api121
 from datetime import datetime, timedelta
 from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
 
 from cryptography.fernet import Fernet
+from api121 import pooled_session, token_provider
 from config_loader import load_config, load_display_config
+from batch_scope import SCOPES_FILENAME, scope_digest, scope_key
+from match_index import INDEX_FILENAME, blind_index, index_key
+from paid_feed import PAID_FILENAME
+from photo_store import LAZY, LOCATORS_FILENAME
+from sync_runner import latest_recent_batch
+from mirror import (
+    load_mirror,
+    save_mirror,
+    needs_full_reconcile,
+    row_timestamp,
+    transaction_key,
+)
 
 
 # ----------------------------------------------------------------------
@@ -38,42 +54,66 @@ API_BASE = config["url121"] + "/api"
 KOBO_TOKEN = config["KOBO_TOKEN"]
 KOBO_BASE = config.get("KOBO_SERVER")
 
-program_id = os.environ.get("PROGRAM_ID")
-if not program_id:
-    raise RuntimeError("PROGRAM_ID not provided to offline_sync.py")
-
-program_id = str(program_id)
-
-programs = config.get("PROGRAMS", [])
-program = next(
-    (p for p in programs if str(p.get("programId")) == program_id),
-    None
-)
-
-if not program:
-    raise RuntimeError(f"Program not found for programId={program_id}")
-
-ASSET_ID = program["koboAssetId"]
-
-PROGRAM_ID = program_id
+PROGRAMS = config.get("PROGRAMS", [])
 
 ENCRYPTION_KEY = config["ENCRYPTION_KEY"]
 
 display_config = load_display_config()
-_prog_config = display_config.get("programs", {}).get(str(program_id), {})
-FIELD_KEYS = [field["key"] for field in _prog_config.get("fields", [])]
-PHOTO_FIELD_NAME = _prog_config.get("photo", {}).get("field_name", "photo")
-logger.info(f"[INFO] Loaded {len(FIELD_KEYS)} field keys for program {program_id}: {FIELD_KEYS}")
 
 fernet = Fernet(ENCRYPTION_KEY.encode())
+MATCH_INDEX_KEY = index_key(ENCRYPTION_KEY)
+SCOPE_KEY = scope_key(ENCRYPTION_KEY)
 
-# Thread pool size (can be overridden by env var)
+# Thread pool size (can be overridden by env var). In a multi-programme run
+# this is the budget for ALL programmes together, not per programme.
 MAX_WORKERS = int(os.getenv("OFFLINE_SYNC_WORKERS", "8"))
 
-COOKIES = None
 HEADERS_KOBO = {"Authorization": f"Token {KOBO_TOKEN}"}
 
 
+class ProgramContext:
+    """Per-programme sync settings: Kobo asset, projected fields, photo field and mode."""
+
+    def __init__(self, program_id):
+        self.program_id = str(program_id)
+        program = next(
+            (p for p in PROGRAMS if str(p.get("programId")) == self.program_id),
+            None
+        )
+        if not program:
+            raise RuntimeError(f"Program not found for programId={self.program_id}")
+
+        self.asset_id = program["koboAssetId"]
+        # "lazy": records-only batches, photos fetched on demand (photo_store.py)
+        self.photo_mode = program.get("photoMode") or "eager"
+        # Registration attribute (e.g. "village") that per-site batches are cut by
+        self.scope_attribute = program.get("scopeAttribute") or None
+
+        prog_config = display_config.get("programs", {}).get(self.program_id, {})
+        self.field_keys = [field["key"] for field in prog_config.get("fields", [])]
+        self.photo_field_name = prog_config.get("photo", {}).get("field_name", "photo")
+        self.match_key = (
+            config.get("COLUMN_TO_MATCH_PER_PROGRAM", {}).get(self.program_id)
+            or config.get("COLUMN_TO_MATCH")
+        )
+        logger.info(
+            f"[INFO] Loaded {len(self.field_keys)} field keys for program "
+            f"{self.program_id}: {self.field_keys}"
+        )
+
+
+# ----------------------------------------------------------------------
+# HTTP SESSIONS
+#
+# One pooled session per upstream, shared by every worker thread and every
+# programme in the run, so connections (and TLS handshakes) are reused
+# instead of being opened per request.
+# ----------------------------------------------------------------------
+
+HTTP_121 = pooled_session(MAX_WORKERS * 2)
+HTTP_KOBO = pooled_session(MAX_WORKERS * 2, HEADERS_KOBO)
+
+
 # ----------------------------------------------------------------------
 # ENCRYPTION HELPERS
 # ----------------------------------------------------------------------
@@ -94,35 +134,78 @@ def encrypt_photo(photo_bytes):
     return fernet.encrypt(photo_bytes)
 
 
+def _match_digest(ctx, entry):
+    """
+    Blind-index digest of an entry's match value: taken from the entry when
+    it was projected for the current match column, else decrypted once here.
+    """
+    if not ctx.match_key:
+        return None
+    stored = entry.get("matchIndex") or {}
+    if stored.get("column") == ctx.match_key:
+        return stored.get("digest")
+    encrypted = (entry.get("data") or {}).get(ctx.match_key)
+    if not encrypted:
+        return None
+    try:
+        value = fernet.decrypt(encrypted.encode()).decode().strip()
+    except Exception as e:
+        logger.warning(f"[!] Could not decrypt {ctx.match_key} for the match index: {e}")
+        return None
+    return blind_index(MATCH_INDEX_KEY, value) if value else None
+
+
+def build_match_index(ctx, cache_data, registrations_map):
+    """match_index.json content for a batch (see match_index.py)."""
+    entries, by_uuid = {}, {}
+    for record in cache_data:
+        if not record.get("paymentId"):
+            continue
+        entry = registrations_map.get(str(record.get("registrationId"))) or record
+        digest = _match_digest(ctx, entry)
+        if digest:
+            entries[digest] = {"paymentId": record["paymentId"], "uuid": record["uuid"]}
+        by_uuid[record["uuid"]] = {
+            "paymentId": record["paymentId"],
+            "value": (record.get("data") or {}).get(ctx.match_key) if ctx.match_key else None,
+        }
+    return {"column": ctx.match_key, "entries": entries, "byUuid": by_uuid}
+
+
+def build_scope_index(ctx, cache_data, registrations_map, previous=None):
+    """
+    scopes.json content for a batch (see batch_scope.py): the site digest
+    of every record. Entries projected for another attribute are skipped;
+    `previous` (an earlier scopes.json of the batch) fills those in.
+    """
+    by_uuid = dict((previous or {}).get("byUuid") or {})
+    for record in cache_data:
+        entry = registrations_map.get(str(record.get("registrationId"))) or {}
+        stored = entry.get("scopeIndex") or {}
+        if stored.get("attribute") == ctx.scope_attribute and stored.get("digest"):
+            by_uuid[record["uuid"]] = stored["digest"]
+    keep = {r["uuid"] for r in cache_data}
+    return {
+        "attribute": ctx.scope_attribute,
+        "byUuid": {u: d for u, d in by_uuid.items() if u in keep},
+    }
+
+
 # ----------------------------------------------------------------------
 # AUTH / SESSION
 # ----------------------------------------------------------------------
 
-def login_and_get_token():
+def get_121(url, **kwargs):
     """
-    Log in to 121 API and obtain access_token_general.
+    GET from 121 with the shared token (api121): the parent web app's
+    token when it passed one, else our own login; refreshed on 401.
+    No circuit breaker: the sync has its own retries and backoff.
     """
-    global COOKIES
-    login_url = f"{API_BASE}/users/login"
-    credentials = {
-        "username": config["username121"],
-        "password": config["password121"],
-    }
-    response = requests.post(
-        login_url,
-        headers={"Content-Type": "application/json"},
-        json=credentials,
-    )
-    response.raise_for_status()
-    token = response.json().get("access_token_general")
-    if not token:
-        raise Exception("Login successful but token missing.")
-    COOKIES = {"access_token_general": token}
-    return token
+    return api121.request("GET", url, session=HTTP_121, use_breaker=False, **kwargs)
 
 
-# Initialise token/cookies at import-time
-login_and_get_token()
+# Fail fast if 121 is unreachable or the credentials are wrong
+token_provider.get()
 
 
 # ----------------------------------------------------------------------
@@ -131,18 +214,23 @@ login_and_get_token()
 
 def get_transactions(program_id, payment_id):
     url = f"{API_BASE}/programs/{program_id}/payments/{payment_id}/transactions"
-    response = requests.get(url, cookies=COOKIES)
+    response = get_121(url)
     response.raise_for_status()
     return response.json()
 
 
-def get_all_transactions(program_id):
+def get_all_transactions(program_id, since=None):
     """
     Get ALL transactions for a program.
-    This is used by download_recent_payments_cache.
+    This is used by refresh_mirror.
+
+    If `since` is given, only rows changed after it are asked for. Callers
+    still filter on the returned timestamps, so an API that ignores the
+    parameter just costs bandwidth, not correctness.
     """
     url = f"{API_BASE}/programs/{program_id}/transactions"
-    response = requests.get(url, cookies=COOKIES)
+    params = {"fromDate": since} if since else None
+    response = get_121(url, params=params)
     response.raise_for_status()
     data = response.json()
 
@@ -162,87 +250,227 @@ def get_all_transactions(program_id):
 
 def get_registration(program_id, registration_id):
     url = f"{API_BASE}/programs/{program_id}/registrations/{registration_id}"
-    response = requests.get(url, cookies=COOKIES)
+    response = get_121(url)
     response.raise_for_status()
     return response.json()
 
 
-def fetch_registrations_bulk(program_id, registration_ids):
+def get_registrations_changed_since(program_id, since, fields):
     """
-    Fetch registrations in parallel for a set of registrationIds.
-    Returns dict: {registrationId: registration_json}
-    """
-    results = {}
-    unique_ids = list(set(registration_ids))
-
-    if not unique_ids:
-        return results
+    Page through the paginated registrations endpoint for rows updated after
+    `since`, selecting only the projected fields.
 
-    def worker(rid):
+    Returns a list of registration rows, or None if the endpoint/filter is
+    not available (callers then fall back to per-id fetches).
+    """
+    url = f"{API_BASE}/programs/{program_id}/registrations"
+    select = ",".join(sorted(set(fields) | {"id", "referenceId", "updated"}))
+    rows = []
+    page = 1
+    while True:
+        params = {
+            "limit": 1000,
+            "page": page,
+            "select": select,
+            "filter.updated": f"$gt:{since}",
+        }
         try:
-            reg = get_registration(program_id, rid)
-            return rid, reg
+            response = get_121(url, params=params)
+            response.raise_for_status()
+            data = response.json()
         except Exception as e:
-            logger.warning(f"[!] Failed to get registration {rid}: {e}")
-            return rid, None
+            logger.warning(f"[!] Changed-registrations query unavailable: {e}")
+            return None
 
-    max_workers = min(MAX_WORKERS, len(unique_ids)) or 1
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = [executor.submit(worker, rid) for rid in unique_ids]
-        for fut in as_completed(futures):
-            rid, reg = fut.result()
-            if reg is not None:
-                results[rid] = reg
+        if not isinstance(data, dict) or not isinstance(data.get("data"), list):
+            return None
 
-    return results
+        rows.extend(data["data"])
+        meta = data.get("meta") or {}
+        if page >= (meta.get("totalPages") or 1):
+            return rows
+        page += 1
+
+
+# ----------------------------------------------------------------------
+# MIRROR REFRESH
+# ----------------------------------------------------------------------
+
+def _project_registration(ctx, reg):
+    """Encrypted projection of a registration, as stored in the mirror."""
+    projected = {key: reg.get(key) for key in ctx.field_keys}
+    entry = {
+        "referenceId": reg.get("referenceId"),
+        "updated": row_timestamp(reg),
+    }
+    if ctx.match_key:
+        projected[ctx.match_key] = reg.get(ctx.match_key)
+        match_value = str(reg.get(ctx.match_key) or "").strip()
+        if match_value:
+            entry["matchIndex"] = {
+                "column": ctx.match_key,
+                "digest": blind_index(MATCH_INDEX_KEY, match_value),
+            }
+    if ctx.scope_attribute:
+        # Kept as a digest only: the site value itself is not needed in clear
+        scope_value = str(reg.get(ctx.scope_attribute) or "").strip()
+        if scope_value:
+            entry["scopeIndex"] = {
+                "attribute": ctx.scope_attribute,
+                "digest": scope_digest(SCOPE_KEY, scope_value),
+            }
+    entry["data"] = encrypt_data(projected)
+    return entry
+
+
+def refresh_mirror(ctx):
+    """
+    Bring the transactions in a programme's local mirror up to date and
+    return it.
+
+    - Incremental: pull only transactions changed since the stored
+      watermark, and apply registration changes via the delta query.
+    - Full reconcile (first run, projection change, or periodic): pull
+      every transaction and drop the rows, and the registrations, that no
+      longer exist upstream.
+
+    Registrations are NOT fetched here: the batch pipeline fetches the ones
+    missing from the mirror (new, or dropped below), in parallel with the
+    photo downloads. A new or changed transaction does not make its
+    registration stale; only the delta query does. When the projection
+    changed, or there is no delta query to catch up with (so a changed
+    match value could otherwise be served stale for a day), every
+    registration is dropped and fetched again. Call store_mirror() once
+    the pipeline has filled them back in.
+    """
+    program_id = ctx.program_id
+    projection = sorted(
+        set(ctx.field_keys)
+        | ({ctx.match_key} if ctx.match_key else set())
+        | ({ctx.scope_attribute} if ctx.scope_attribute else set())
+    )
+    mirror = load_mirror(program_id)
+    now = datetime.utcnow()
+    full = needs_full_reconcile(mirror, projection, now)
+    watermarks = mirror["watermarks"]
+
+    registrations = mirror["registrations"]
+    if sorted(mirror.get("projection") or []) != projection:
+        # Mirrored entries lack (or carry extra) fields: fetch them all again
+        registrations.clear()
+        watermarks["registrations"] = None
+
+    # 1) Transactions. A full reconcile rebuilds the set, so rows that
+    #    vanished upstream are dropped.
+    tx_since = None if full else watermarks.get("transactions")
+    fetched = get_all_transactions(program_id, since=tx_since)
+    if full:
+        mirror["transactions"] = {}
+
+    for t in fetched:
+        if not isinstance(t, dict):
+            continue
+        ts = row_timestamp(t)
+        if tx_since and ts and ts <= tx_since:
+            continue
+        mirror["transactions"][transaction_key(t)] = t
+        if ts > (watermarks.get("transactions") or ""):
+            watermarks["transactions"] = ts
+
+    logger.info(
+        f"[INFO] Program {program_id} mirror {'full reconcile' if full else 'incremental'}: "
+        f"{len(fetched)} transaction rows fetched, {len(mirror['transactions'])} mirrored"
+    )
+
+    # 2) Registrations changed upstream since the watermark. Without a delta
+    #    query (or a watermark to ask it from) nothing tells which mirrored
+    #    registrations are stale, so they are all fetched again.
+    reg_since = watermarks.get("registrations")
+    if registrations:
+        changed = get_registrations_changed_since(program_id, reg_since, projection) if reg_since else None
+        if changed is None:
+            logger.info(
+                f"[WARN] Program {program_id}: no changed-registrations query, "
+                f"re-fetching all {len(registrations)} mirrored registrations"
+            )
+            registrations.clear()
+            watermarks["registrations"] = None
+        for reg in changed or []:
+            rid = str(reg.get("id"))
+            if rid in registrations:
+                registrations[rid] = _project_registration(ctx, reg)
+
+    # 3) Drop registrations nothing points to any more (deleted upstream, or
+    #    their transactions vanished in a full reconcile)
+    referenced = {
+        str(t["registrationId"])
+        for t in mirror["transactions"].values()
+        if t.get("registrationId")
+    }
+    for rid in set(registrations) - referenced:
+        del registrations[rid]
+
+    mirror["projection"] = projection
+    if full:
+        mirror["lastFullReconcile"] = now.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    save_mirror(program_id, mirror)
+    return mirror
+
+
+def store_mirror(program_id, mirror, fetched_registrations):
+    """Merge registrations fetched by the pipeline into the mirror and save it."""
+    registrations = mirror["registrations"]
+    registrations.update(fetched_registrations)
+
+    watermarks = mirror["watermarks"]
+    for entry in registrations.values():
+        if entry.get("updated", "") > (watermarks.get("registrations") or ""):
+            watermarks["registrations"] = entry["updated"]
+
+    save_mirror(program_id, mirror)
+    logger.info(
+        f"[INFO] Program {program_id} mirror saved: {len(fetched_registrations)} registrations fetched, "
+        f"{len(registrations)} mirrored"
+    )
 
 
 # ----------------------------------------------------------------------
 # KOBO HELPERS
 # ----------------------------------------------------------------------
 
-def get_kobo_submission(uuid):
+def get_kobo_submission(asset_id, uuid):
     """
     Fetch a single Kobo submission by _uuid.
-    Keeps behaviour identical but now all photo optimisations
-    are handled in download_and_encrypt_photo.
+    Photo URLs are resolved from it by resolve_photo_urls.
     """
     # Keep it simple & safe: full submission (no fields filter),
     # since we rely on photo field, *_URL, _attachments, and _id.
-    url = f"{KOBO_BASE}/api/v2/assets/{ASSET_ID}/data.json?query={{\"_uuid\":\"{uuid}\"}}"
-    response = requests.get(url, headers=HEADERS_KOBO)
+    url = f"{KOBO_BASE}/api/v2/assets/{asset_id}/data.json?query={{\"_uuid\":\"{uuid}\"}}"
+    response = HTTP_KOBO.get(url)
     response.raise_for_status()
     results = response.json().get("results", [])
     return results[0] if results else None
 
 
-def download_and_encrypt_photo(uuid, save_path):
+class PhotoUnavailable(Exception):
+    """A photo could not be resolved or downloaded; str(e) is the reason."""
+
+
+def resolve_photo_urls(ctx, uuid, submission):
     """
-    Download and encrypt the photo for a given submission UUID.
-    Saves the encrypted image bytes to save_path.
+    Work out where the photo for a Kobo submission can be downloaded from.
+    Returns a list of URLs to try in order; raises PhotoUnavailable if
+    there is no usable photo.
     Handles:
     - Kobo's direct *_URL field (photo_URL)
     - Kobo _attachments list
     - IFRC Kobo /attachments/<uid>/ format
-    Uses a smaller 'medium' view to speed up sync.
+    Prefers the smaller 'medium' view to speed up sync.
     """
-
-    # If photo already exists and is non-empty, you *could* skip.
-    # For now, we always refresh since each batch dir is unique.
-    # if os.path.exists(save_path) and os.path.getsize(save_path) > 0:
-    #     print(f"[SKIP] Photo already exists for UUID {uuid}")
-    #     return
-
-    # --- 1) Fetch Kobo submission ---
-    submission = get_kobo_submission(uuid)
-    if not submission:
-        logger.warning(f"[!] No Kobo submission found for UUID {uuid}")
-        return
-
-    photo_field = PHOTO_FIELD_NAME  # e.g. "photo"
+    photo_field = ctx.photo_field_name  # e.g. "photo"
     photo_filename = submission.get(photo_field)
 
-    # --- 2) New Kobo way: direct photo URL (BEST METHOD) ---
+    # --- 1) New Kobo way: direct photo URL (BEST METHOD) ---
     photo_url_field = f"{photo_field}_URL"  # e.g. "photo_URL"
     photo_url = submission.get(photo_url_field)
 
@@ -250,29 +478,15 @@ def download_and_encrypt_photo(uuid, save_path):
         logger.info(f"[OK] Direct Kobo photo URL found for UUID {uuid}: {photo_url}")
 
         # Use smaller 'medium' image instead of original
-        photo_url = photo_url.replace("/original/", "/medium/")
+        return [photo_url.replace("/original/", "/medium/")]
 
-        res = requests.get(photo_url, headers=HEADERS_KOBO)
-        if res.status_code != 200:
-            logger.warning(f"[!] Direct photo download failed for UUID {uuid}: {res.status_code}")
-            return
-
-        encrypted_bytes = encrypt_photo(res.content)
-        with open(save_path, "wb") as f:
-            f.write(encrypted_bytes)
-
-        logger.info(f"[OK] Photo downloaded & encrypted (direct URL) for UUID {uuid}")
-        return
-
-    # --- 3) Fallback: match against _attachments (older Kobo submissions) ---
+    # --- 2) Fallback: match against _attachments (older Kobo submissions) ---
     if not photo_filename:
-        logger.warning(f"[!] No '{photo_field}' value for UUID {uuid}")
-        return
+        raise PhotoUnavailable(f"no '{photo_field}' value")
 
     attachments = submission.get("_attachments", [])
     if not attachments:
-        logger.warning(f"[!] No attachments in submission for UUID {uuid}")
-        return
+        raise PhotoUnavailable("no attachments in submission")
 
     from urllib.parse import unquote
 
@@ -290,15 +504,14 @@ def download_and_encrypt_photo(uuid, save_path):
 
     if not matching:
         fnames = [a.get("filename", "") for a in attachments]
-        logger.warning(f"[!] No matching attachment for '{photo_filename}' (UUID {uuid})")
         logger.debug(f"[DEBUG] Available filenames: {fnames}")
-        return
+        raise PhotoUnavailable(f"no matching attachment for '{photo_filename}'")
 
     att = matching[0]
     attach_uid = att.get("uid")
     submission_id = submission["_id"]
 
-    # --- 4) Try direct download_url first, then construct IFRC URL ---
+    # --- 3) Try direct download_url first, then construct IFRC URL ---
     direct_url = att.get("download_url") or att.get("download_medium_url")
 
     if direct_url:
@@ -306,105 +519,563 @@ def download_and_encrypt_photo(uuid, save_path):
         logger.info(f"[OK] Using direct download_url for UUID {uuid}: {file_url[:80]}")
     elif attach_uid:
         file_url = (
-            f"{KOBO_BASE}/api/v2/assets/{ASSET_ID}/data/"
+            f"{KOBO_BASE}/api/v2/assets/{ctx.asset_id}/data/"
             f"{submission_id}/attachments/{attach_uid}/?view=medium"
         )
         logger.info(f"[OK] Using constructed IFRC URL for UUID {uuid}: {file_url[:80]}")
     else:
-        logger.warning(f"[!] No download URL or UID for attachment (UUID {uuid})")
-        return
-
-    # --- 5) Download (retry without medium if it fails) ---
-    res = requests.get(file_url, headers=HEADERS_KOBO)
-    if res.status_code != 200:
-        fallback = file_url.replace("/medium/", "/original/").replace("?view=medium", "")
-        logger.warning(f"[!] Medium download failed ({res.status_code}), retrying: {fallback[:80]}")
-        res = requests.get(fallback, headers=HEADERS_KOBO)
-    if res.status_code != 200:
-        logger.warning(f"[!] Failed to download attachment for UUID {uuid}: {res.status_code}")
-        return
-
-    # --- 6) Encrypt & save ---
-    encrypted_bytes = encrypt_photo(res.content)
-    with open(save_path, "wb") as f:
-        f.write(encrypted_bytes)
+        raise PhotoUnavailable("no download URL or UID for attachment")
 
-    logger.info(f"[OK] Photo downloaded & encrypted for UUID {uuid}")
+    # Retry without medium if the medium view fails
+    fallback = file_url.replace("/medium/", "/original/").replace("?view=medium", "")
+    return [file_url] if fallback == file_url else [file_url, fallback]
 
 
-def download_photos_bulk(records, photos_dir):
+def download_photo(uuid, urls, save_path):
     """
-    Download & encrypt photos for all records in parallel.
-    Each record should have 'uuid' and 'photo_filename'.
+    Download the first of `urls` that succeeds, encrypt it and save it to
+    save_path. Raises PhotoUnavailable if none of them works.
     """
-    if not records:
-        return
+    res = None
+    for url in urls:
+        res = HTTP_KOBO.get(url)
+        if res.status_code == 200:
+            break
+        logger.warning(f"[!] Photo download failed ({res.status_code}) for UUID {uuid}: {url[:80]}")
+    if res is None or res.status_code != 200:
+        raise PhotoUnavailable(f"download failed (HTTP {res.status_code if res is not None else '-'})")
 
-    os.makedirs(photos_dir, exist_ok=True)
-
-    def worker(rec):
-        uuid = rec["uuid"]
-        photo_filename = rec["photo_filename"]
-        save_path = os.path.join(photos_dir, photo_filename)
-        download_and_encrypt_photo(uuid, save_path)
+    encrypted_bytes = encrypt_photo(res.content)
+    with open(save_path, "wb") as f:
+        f.write(encrypted_bytes)
 
-    max_workers = min(MAX_WORKERS, len(records)) or 1
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = [executor.submit(worker, rec) for rec in records]
-        for _ in as_completed(futures):
-            # We don't need the result; download_and_encrypt_photo handles logging
-            pass
+    logger.info(f"[OK] Photo downloaded & encrypted for UUID {uuid}")
 
 
 # ----------------------------------------------------------------------
 # BATCH DIRECTORY HELPERS
 # ----------------------------------------------------------------------
 
-def get_next_batch_dir(base_path, payment_id):
+def publish_batch_dir(staging_dir, base_path, payment_id):
     """
-    Create a unique batch directory for a given payment or "recent",
-    with a 'photos' subfolder.
+    Move a finished staging directory into place as the next numbered batch.
+    os.rename() onto a name that already exists fails, so concurrent
+    publishers can never claim the same number.
     """
+    os.makedirs(base_path, exist_ok=True)
     batch_number = 1
     while True:
         batch_path = os.path.join(base_path, f"payment-{payment_id}-batch-{batch_number}")
         if not os.path.exists(batch_path):
-            os.makedirs(os.path.join(batch_path, "photos"), exist_ok=True)
-            return batch_path
+            try:
+                os.rename(staging_dir, batch_path)
+                return batch_path
+            except OSError:
+                if not os.path.exists(batch_path):
+                    raise
         batch_number += 1
 
 
 # ----------------------------------------------------------------------
-# MAIN: SPECIFIC PAYMENT BATCH
+# CHECKPOINTED RUNS
+#
+# A run builds its batch in offline-staging/run-<id>/ and appends every
+# completed registration and photo to journal.jsonl. If the process dies,
+# the next run for the same program + batch type (or an explicit
+# SYNC_RUN_ID) picks the staging directory up again, replays the journal
+# and only does the work that is left. The batch only appears in
+# offline-cache/ once it is complete.
 # ----------------------------------------------------------------------
 
-def download_cache(program_id, payment_id):
-    """
-    Original behaviour: download cache for a single paymentId.
+STAGING_BASE = os.getenv("OFFLINE_STAGING_DIR", "offline-staging")
+
+# Unfinished runs older than this are stale (their transactions snapshot no
+# longer reflects 121) and are discarded instead of resumed.
+RESUME_MAX_AGE_HOURS = float(os.getenv("SYNC_RESUME_MAX_AGE_HOURS", "12"))
+
+
+class SyncRun:
+    """Staging directory + checkpoint journal for one sync run."""
+
+    def __init__(self, run_id, program_id, kind, run_dir=None):
+        self.run_id = str(run_id)
+        self.program_id = str(program_id)
+        self.kind = str(kind)
+        self.dir = run_dir or os.path.join(STAGING_BASE, f"run-{self.run_id}")
+        self.photos_dir = os.path.join(self.dir, "photos")
+        self.journal_path = os.path.join(self.dir, "journal.jsonl")
+        self._lock = threading.Lock()
+        self._journal = None
+        self.locators = {}  # uuid -> photo URLs, for lazy photos
+        self.batch_dir = None  # the published batch a repair works on
+
+    @classmethod
+    def open(cls, program_id, kind):
+        """
+        Start or resume a run. SYNC_RUN_ID wins; otherwise the newest
+        unfinished run for this program + kind is resumed if it is recent
+        enough, and a new run is started if there is none.
+        """
+        run_id = os.environ.get("SYNC_RUN_ID")
+        if not run_id:
+            run_id = cls._find_resumable(program_id, kind)
+        if not run_id:
+            run_id = f"{program_id}-{kind}-{datetime.utcnow().strftime('%Y%m%d%H%M%S%f')}"
+
+        run = cls(run_id, program_id, kind)
+        resuming = os.path.exists(run.journal_path)
+        os.makedirs(run.photos_dir, exist_ok=True)
+        if not os.path.exists(os.path.join(run.dir, "run_info.json")):
+            run.save_snapshot("run_info.json", {
+                "runId": run.run_id,
+                "programId": run.program_id,
+                "kind": run.kind,
+                "startedAt": datetime.utcnow().isoformat() + "Z",
+            })
+        logger.info(f"[INFO] Sync run {run.run_id} ({'resuming' if resuming else 'new'})")
+        return run
+
+    @classmethod
+    def for_batch(cls, program_id, batch_dir):
+        """
+        A repair of an already published batch. Its journal, new photos and
+        updated snapshots are staged like any run and only copied into the
+        batch by publish_repair(), so a device never downloads a half-repaired
+        batch (or its journal).
+        """
+        run = cls(f"repair-{os.path.basename(batch_dir)}", program_id, "repair")
+        run.batch_dir = batch_dir
+        os.makedirs(run.photos_dir, exist_ok=True)
+        return run
+
+    @staticmethod
+    def _find_resumable(program_id, kind):
+        if not os.path.isdir(STAGING_BASE):
+            return None
+        cutoff = datetime.utcnow() - timedelta(hours=RESUME_MAX_AGE_HOURS)
+        candidates = []
+        for d in os.listdir(STAGING_BASE):
+            info_path = os.path.join(STAGING_BASE, d, "run_info.json")
+            try:
+                with open(info_path, "r", encoding="utf-8") as f:
+                    info = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if info.get("programId") != str(program_id) or info.get("kind") != str(kind):
+                continue
+            journal_path = os.path.join(STAGING_BASE, d, "journal.jsonl")
+            last_activity = os.path.getmtime(
+                journal_path if os.path.exists(journal_path) else info_path
+            )
+            if datetime.utcfromtimestamp(last_activity) < cutoff:
+                logger.info(f"[INFO] Discarding stale sync run {info.get('runId')}")
+                shutil.rmtree(os.path.join(STAGING_BASE, d), ignore_errors=True)
+                continue
+            candidates.append((last_activity, info.get("runId")))
+        return max(candidates)[1] if candidates else None
+
+    def load_snapshot(self, name):
+        path = os.path.join(self.dir, name)
+        if not os.path.exists(path) and self.batch_dir:
+            path = os.path.join(self.batch_dir, name)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def save_snapshot(self, name, data):
+        path = os.path.join(self.dir, name)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp_path, path)
+
+    def load_journal(self):
+        """
+        Return ({registrationId: entry}, {uuid}) of completed work. Journaled
+        photo locators are added to self.locators.
+        """
+        registrations, photos = {}, set()
+        if not os.path.exists(self.journal_path):
+            return registrations, photos
+        with open(self.journal_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    continue  # torn last line from a killed process
+                if item.get("type") == "registration":
+                    registrations[item["registrationId"]] = item["entry"]
+                elif item.get("type") == "photo":
+                    if os.path.exists(os.path.join(self.photos_dir, f"{item['uuid']}.enc")):
+                        photos.add(item["uuid"])
+                elif item.get("type") == "locator":
+                    self.locators[item["uuid"]] = item["urls"]
+        logger.info(
+            f"[INFO] Journal: {len(registrations)} registrations, {len(photos)} photos, "
+            f"{len(self.locators)} photo locators already done"
+        )
+        return registrations, photos
+
+    def _append(self, item):
+        with self._lock:
+            if self._journal is None:
+                self._journal = open(self.journal_path, "a", encoding="utf-8")
+            self._journal.write(json.dumps(item) + "\n")
+            self._journal.flush()
+
+    def record_registration(self, registration_id, entry):
+        self._append({"type": "registration", "registrationId": registration_id, "entry": entry})
+
+    def record_photo(self, uuid):
+        self._append({"type": "photo", "uuid": uuid})
+
+    def record_locator(self, uuid, urls):
+        self.locators[uuid] = urls
+        self._append({"type": "locator", "uuid": uuid, "urls": urls})
+
+    def close(self):
+        """Close and drop the journal once the run's results are saved."""
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+
+    def finalise(self, base_path, payment_id):
+        """Drop the journal and publish the staging dir as a batch."""
+        self.close()
+        info_path = os.path.join(self.dir, "run_info.json")
+        if os.path.exists(info_path):
+            os.remove(info_path)
+        return publish_batch_dir(self.dir, base_path, payment_id)
+
+    def publish_repair(self):
+        """
+        Move a repair's staged photos and snapshots into its batch, then drop
+        the staging dir. batch_info.json goes last: its mtime tells the
+        server caches (scoped archives, verify index) the batch changed.
+        """
+        self.close()
+        batch_photos = os.path.join(self.batch_dir, "photos")
+        os.makedirs(batch_photos, exist_ok=True)
+        for fname in os.listdir(self.photos_dir):
+            if fname.endswith(".enc"):
+                os.replace(os.path.join(self.photos_dir, fname), os.path.join(batch_photos, fname))
+        snapshots = sorted(
+            (f for f in os.listdir(self.dir) if f.endswith(".json")),
+            key=lambda f: f == "batch_info.json",
+        )
+        for fname in snapshots:
+            os.replace(os.path.join(self.dir, fname), os.path.join(self.batch_dir, fname))
+        shutil.rmtree(self.dir, ignore_errors=True)
 
-    - Fetch transactions for this payment
-    - Fetch registrations (now in parallel)
-    - Fetch + encrypt photos (now in parallel, medium-size)
-    - Save registrations_cache.json and transactions.json
+
+# ----------------------------------------------------------------------
+# SYNC PIPELINE
+#
+# Stages run concurrently, each as a small pool of threads, connected by
+# bounded queues:
+#
+#   transactions ──┬─> registration fetch + encrypt ──────────────┐
+#                  └─> Kobo resolve ──> photo download + encrypt ──┴─> writer
+#
+# The photo branch only needs the uuid, which is known straight from the
+# transaction, so Kobo work starts immediately instead of waiting for all
+# registrations. Total time approaches the slower upstream, not the sum.
+# For a lazy-photo job the photo stage only passes the resolved URLs on to
+# the writer, which journals them as the batch's photo locators.
+#
+# Several programmes can share one pipeline (and so one worker budget):
+# the source feeds their transactions round-robin, so a large programme
+# does not hold the others back.
+# ----------------------------------------------------------------------
+
+_DONE = object()
+QUEUE_SIZE = MAX_WORKERS * 4
+
+
+def start_stage(name, fn, inbox, outbox, workers):
     """
-    base_path = "offline-cache"
-    os.makedirs(base_path, exist_ok=True)
-    batch_dir = get_next_batch_dir(base_path, payment_id)
-    photos_dir = os.path.join(batch_dir, "photos")
+    Start `workers` threads applying fn to every item from inbox and putting
+    non-None results on outbox. When the last worker sees the end marker it
+    is forwarded to outbox, so stages shut down in order.
+    """
+    alive = [workers]
+    lock = threading.Lock()
+
+    def loop():
+        while True:
+            item = inbox.get()
+            if item is _DONE:
+                inbox.put(_DONE)  # let sibling workers see it too
+                break
+            try:
+                result = fn(item)
+            except Exception as e:
+                logger.warning(f"[!] {name} failed: {e}")
+                result = None
+            if result is not None:
+                outbox.put(result)
+        with lock:
+            alive[0] -= 1
+            last = alive[0] == 0
+        if last:
+            outbox.put(_DONE)
+
+    threads = [
+        threading.Thread(target=loop, name=f"{name}-{i}", daemon=True)
+        for i in range(max(1, workers))
+    ]
+    for t in threads:
+        t.start()
+    return threads
 
-    transactions = get_transactions(program_id, payment_id)
-    cache_data = []
 
-    # 1) Collect registrationIds & uuids from transactions
-    reg_ids = []
+def _job_feed(index, transactions, done_photos, tx_queue, uuid_queue):
+    """Yield (queue, item) pairs for one job's transactions."""
+    seen_regs, seen_uuids = set(), set()
     for t in transactions:
-        if "registrationId" in t and "registrationReferenceId" in t:
-            reg_ids.append(t["registrationId"])
+        rid = t.get("registrationId")
+        uuid = t.get("registrationReferenceId")
+        if rid and str(rid) not in seen_regs:
+            seen_regs.add(str(rid))
+            yield tx_queue, (index, t)
+        if uuid and uuid not in seen_uuids and uuid not in done_photos:
+            seen_uuids.add(uuid)
+            yield uuid_queue, (index, uuid)
 
-    # 2) Fetch registrations in bulk (parallel)
-    registrations_map = fetch_registrations_bulk(program_id, reg_ids)
 
-    # 3) Build records (encryption, validity checks)
+def run_batch_pipeline(jobs):
+    """
+    Fetch registrations and photos for one or more batches concurrently,
+    into the staging area of each job's run (a SyncRun). Work already in a
+    run's journal is skipped; everything completed now is journaled.
+
+    Each job is a dict with:
+      ctx:           the ProgramContext
+      transactions:  the transactions to fetch for
+      run:           the SyncRun
+      registrations: optional {registrationId: projected entry} (the
+                     mirror); only the ones missing from it are fetched
+      skip_photos:   optional set of uuids whose photo is already in place
+      lazy_photos:   optional; resolve photo URLs into run.locators instead
+                     of downloading the photos
+
+    Returns one (registration_entries, photo_uuids, fetched, failures) tuple
+    per job, in order:
+      registration_entries: {registrationId: projected entry} for all txs
+      photo_uuids:          set of uuids whose photo was saved
+      fetched:              the subset of entries fetched from 121 by this
+                            run (including before a resume)
+      failures:             [{"type", "uuid", "registrationId", "reason"}]
+                            for every registration/photo that failed
+    """
+    states = []
+    for job in jobs:
+        run = job["run"]
+        journaled_regs, journaled_photos = run.load_journal()
+        os.makedirs(run.photos_dir, exist_ok=True)
+        photo_uuids = set(journaled_photos) | set(job.get("skip_photos") or ())
+        lazy = bool(job.get("lazy_photos"))
+        states.append({
+            "ctx": job["ctx"],
+            "run": run,
+            "registrations": {**(job.get("registrations") or {}), **journaled_regs},
+            "done_photos": photo_uuids | set(run.locators) if lazy else photo_uuids,
+            "lazy": lazy,
+            "entries": {},
+            "fetched": dict(journaled_regs),
+            "photo_uuids": set(photo_uuids),
+            "failures": [],
+        })
+
+    tx_queue = queue.Queue(QUEUE_SIZE)
+    uuid_queue = queue.Queue(QUEUE_SIZE)
+    photo_queue = queue.Queue(QUEUE_SIZE)
+    writer_queue = queue.Queue(QUEUE_SIZE)
+
+    failures_lock = threading.Lock()
+
+    def record_failure(index, kind, uuid, registration_id, reason):
+        logger.warning(
+            f"[!] {kind} failed for program {states[index]['ctx'].program_id}, "
+            f"UUID {uuid} / registration {registration_id}: {reason}"
+        )
+        with failures_lock:
+            states[index]["failures"].append({
+                "type": kind,
+                "uuid": uuid,
+                "registrationId": registration_id,
+                "reason": str(reason),
+            })
+
+    def registration_stage(item):
+        index, t = item
+        state = states[index]
+        rid = str(t["registrationId"])
+        entry = state["registrations"].get(rid)
+        if entry is not None:
+            return ("registration", index, rid, entry, False)
+        try:
+            reg = get_registration(state["ctx"].program_id, t["registrationId"])
+        except Exception as e:
+            record_failure(index, "registration", t.get("registrationReferenceId"), rid, e)
+            return None
+        return ("registration", index, rid, _project_registration(state["ctx"], reg), True)
+
+    def kobo_resolve_stage(item):
+        index, uuid = item
+        ctx = states[index]["ctx"]
+        try:
+            submission = get_kobo_submission(ctx.asset_id, uuid)
+            if not submission:
+                raise PhotoUnavailable("no Kobo submission found")
+            return (index, uuid, resolve_photo_urls(ctx, uuid, submission))
+        except Exception as e:
+            record_failure(index, "photo", uuid, None, e)
+            return None
+
+    def photo_stage(item):
+        index, uuid, urls = item
+        if states[index]["lazy"]:
+            return ("locator", index, uuid, urls)
+        save_path = os.path.join(states[index]["run"].photos_dir, f"{uuid}.enc")
+        try:
+            download_photo(uuid, urls, save_path)
+        except Exception as e:
+            record_failure(index, "photo", uuid, None, e)
+            return None
+        return ("photo", index, uuid)
+
+    start_stage("registrations", registration_stage, tx_queue, writer_queue, MAX_WORKERS)
+    start_stage("kobo-resolve", kobo_resolve_stage, uuid_queue, photo_queue, MAX_WORKERS)
+    start_stage("photos", photo_stage, photo_queue, writer_queue, MAX_WORKERS)
+
+    # Source stage: feed both branches, taking one item from each job in turn
+    def source():
+        feeds = [
+            _job_feed(i, job["transactions"], states[i]["done_photos"], tx_queue, uuid_queue)
+            for i, job in enumerate(jobs)
+        ]
+        while feeds:
+            for feed in list(feeds):
+                nxt = next(feed, None)
+                if nxt is None:
+                    feeds.remove(feed)
+                    continue
+                target, item = nxt
+                target.put(item)
+        tx_queue.put(_DONE)
+        uuid_queue.put(_DONE)
+
+    threading.Thread(target=source, name="transactions", daemon=True).start()
+
+    # Writer: both branches end here; wait for the end marker from each.
+    pending = 2
+    while pending:
+        item = writer_queue.get()
+        if item is _DONE:
+            pending -= 1
+            continue
+        state = states[item[1]]
+        if item[0] == "registration":
+            _, _, rid, entry, was_fetched = item
+            state["entries"][rid] = entry
+            if was_fetched:
+                state["fetched"][rid] = entry
+                state["run"].record_registration(rid, entry)
+        elif item[0] == "locator":
+            state["run"].record_locator(item[2], item[3])
+        else:
+            state["photo_uuids"].add(item[2])
+            state["run"].record_photo(item[2])
+
+    results = []
+    for state in states:
+        logger.info(
+            f"[INFO] Pipeline done for program {state['ctx'].program_id}: "
+            f"{len(state['entries'])} registrations ({len(state['fetched'])} fetched), "
+            f"{len(state['photo_uuids'])} photos, {len(state['run'].locators)} photo locators, "
+            f"{len(state['failures'])} failures"
+        )
+        results.append(
+            (state["entries"], state["photo_uuids"], state["fetched"], state["failures"])
+        )
+    return results
+
+
+def _discard_orphan_photos(photos_dir, cache_data):
+    """Remove photos downloaded for transactions that produced no record."""
+    keep = {rec["photo_filename"] for rec in cache_data}
+    for fname in os.listdir(photos_dir):
+        if fname not in keep:
+            os.remove(os.path.join(photos_dir, fname))
+
+
+def _save_locators(run, cache_data):
+    """Save the lazy-photo locators of the batch's records, in batch order."""
+    locators = {r["uuid"]: run.locators[r["uuid"]] for r in cache_data if r["uuid"] in run.locators}
+    run.save_snapshot(LOCATORS_FILENAME, locators)
+    return len(locators)
+
+
+# ----------------------------------------------------------------------
+# MAIN: SPECIFIC PAYMENT BATCH
+# ----------------------------------------------------------------------
+
+def parse_timestamp(value):
+    """Parse a 121 / batch_info ISO timestamp ("...Z"); None if invalid."""
+    for fmt in ("%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%SZ"):
+        try:
+            return datetime.strptime(value, fmt)
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+def build_record(t, entry, window_start=None):
+    """
+    Build one registrations_cache.json record from a transaction and its
+    projected (encrypted) registration entry. If window_start is given, a
+    transaction created before it is marked invalid ("too_old").
+    """
+    uuid = t.get("registrationReferenceId")
+    status = (t.get("status") or t.get("transactionStatus") or "").lower()
+    deleted = (t.get("registrationStatus") or "").lower() == "deleted"
+
+    too_old = False
+    if window_start is not None:
+        created_dt = parse_timestamp(t.get("created", "")) or datetime.min
+        too_old = created_dt < window_start
+
+    is_valid = status == "waiting" and not deleted and not too_old
+
+    reason = "ok"
+    if not is_valid:
+        if status != "waiting":
+            reason = f"status={status}"
+        elif deleted:
+            reason = "deleted"
+        elif too_old:
+            reason = "too_old"
+
+    return {
+        "uuid": uuid,
+        "registrationId": t.get("registrationId"),
+        "photo_filename": f"{uuid}.enc",
+        "paymentId": t.get("paymentId"),
+        "amount": t.get("amount", 0),
+        "data": entry["data"],
+        "valid": is_valid,
+        "reason": reason,
+    }
+
+
+def build_records(transactions, registrations_map, window_start=None):
+    """Build records for every transaction that has registration data."""
+    cache_data = []
     for t in transactions:
         reg_id = t.get("registrationId")
         uuid = t.get("registrationReferenceId")
@@ -413,58 +1084,64 @@ def download_cache(program_id, payment_id):
             logger.info("[SKIP] Missing reg_id or uuid in transaction")
             continue
 
-        reg = registrations_map.get(reg_id)
-        if not reg:
+        entry = registrations_map.get(str(reg_id))
+        if not entry:
             logger.warning(f"[!] No registration data for {reg_id}")
             continue
 
-        filtered_data = {key: reg.get(key) for key in FIELD_KEYS}
-        per_program_columns = config.get("COLUMN_TO_MATCH_PER_PROGRAM", {})
-        match_key = per_program_columns.get(str(PROGRAM_ID)) or config.get("COLUMN_TO_MATCH")
-        if match_key:
-            filtered_data[match_key] = reg.get(match_key)
-
-        encrypted_data = encrypt_data(filtered_data)
+        cache_data.append(build_record(t, entry, window_start))
+    return cache_data
 
-        photo_filename = f"{uuid}.enc"
 
-        status = (t.get("status") or t.get("transactionStatus") or "").lower()
-        deleted = (t.get("registrationStatus") or "").lower() == "deleted"
-
-        is_valid = status == "waiting" and not deleted
-        reason = "ok"
-        if not is_valid:
-            if status != "waiting":
-                reason = f"status={status}"
-            elif deleted:
-                reason = "deleted"
-
-        record = {
-            "uuid": uuid,
-            "registrationId": reg_id,
-            "photo_filename": photo_filename,
-            "paymentId": t.get("paymentId"),
-            "amount": t.get("amount", 0),
-            "data": encrypted_data,
-            "valid": is_valid,
-            "reason": reason,
-        }
-
-        cache_data.append(record)
-
-    # 4) Download & encrypt all photos in parallel
-    download_photos_bulk(cache_data, photos_dir)
-
-    # 5) Save encrypted registration data & transactions
-    json_path = os.path.join(batch_dir, "registrations_cache.json")
-    with open(json_path, "w", encoding="utf-8") as f:
-        json.dump(cache_data, f, indent=2)
+def download_cache(program_id, payment_id):
+    """
+    Original behaviour: download cache for a single paymentId.
 
-    tx_path = os.path.join(batch_dir, "transactions.json")
-    with open(tx_path, "w", encoding="utf-8") as f:
-        json.dump(transactions, f, indent=2)
+    - Fetch transactions for this payment
+    - Fetch registrations and photos concurrently (run_batch_pipeline)
+    - Save registrations_cache.json, transactions.json and batch_info.json
+      (with any registration/photo failures, for a later repair run)
+    Checkpointed in a SyncRun like the recent batch.
+    """
+    base_path = "offline-cache"
+    ctx = ProgramContext(program_id)
+    run = SyncRun.open(program_id, f"payment-{payment_id}")
+
+    transactions = run.load_snapshot("transactions.json")
+    if transactions is None:
+        transactions = get_transactions(program_id, payment_id)
+        run.save_snapshot("transactions.json", transactions)
+
+    # 1) Fetch registrations & photos (pipelined)
+    usable = [
+        t for t in transactions
+        if "registrationId" in t and "registrationReferenceId" in t
+    ]
+    registrations_map, photo_uuids, _, failures = run_batch_pipeline(
+        [{"ctx": ctx, "transactions": usable, "run": run}]
+    )[0]
+
+    # 2) Build records (validity checks; data is already encrypted)
+    cache_data = build_records(transactions, registrations_map)
+    _discard_orphan_photos(run.photos_dir, cache_data)
+
+    # 3) Save encrypted registration data (transactions.json is the snapshot)
+    run.save_snapshot("registrations_cache.json", cache_data)
+    run.save_snapshot(INDEX_FILENAME, build_match_index(ctx, cache_data, registrations_map))
+    run.save_snapshot("batch_info.json", {
+        "batchType": f"payment-{payment_id}",
+        "programId": program_id,
+        "paymentId": payment_id,
+        "recordCount": len(cache_data),
+        "photoCount": len(photo_uuids & {r["uuid"] for r in cache_data}),
+        "failures": failures,
+        "generatedAt": datetime.utcnow().isoformat() + "Z",
+    })
+    batch_dir = run.finalise(base_path, payment_id)
 
     logger.info(f"\n[OK] Done. Batch saved to: {batch_dir}")
+    if failures:
+        logger.info(f"[WARN] {len(failures)} failures recorded in batch_info.json")
     logger.info(f"{len(cache_data)} beneficiaries ready for offline validation.")
     return len(cache_data)
 
@@ -473,28 +1150,12 @@ def download_cache(program_id, payment_id):
 # MAIN: RECENT PAYMENTS BATCH (last 14 days)
 # ----------------------------------------------------------------------
 
-def download_recent_payments_cache(program_id):
+def select_recent_transactions(all_transactions, fourteen_days_ago):
     """
-    Build a "recent" offline batch:
-    - Get ALL transactions for a program
-    - Filter to status=waiting, not deleted, created in last 14 days
-    - Keep only the latest transaction per UUID
-    - Fetch registrations in bulk (parallel)
-    - Download & encrypt photos in parallel (medium-size)
-    - Save:
-        - registrations_cache.json
-        - transactions.json (latest transactions per uuid)
-        - batch_info.json
+    Filter to status=waiting, not deleted, created after fourteen_days_ago,
+    and keep only the latest transaction per UUID.
+    Returns {uuid: transaction}.
     """
-    base_path = "offline-cache"
-    os.makedirs(base_path, exist_ok=True)
-    batch_dir = get_next_batch_dir(base_path, "recent")
-    photos_dir = os.path.join(batch_dir, "photos")
-
-    all_transactions = get_all_transactions(program_id)
-    logger.info(f"[INFO] Total transactions fetched: {len(all_transactions)}")
-
-    fourteen_days_ago = datetime.utcnow() - timedelta(days=14)
     filtered = []
 
     counts = {
@@ -562,109 +1223,329 @@ def download_recent_payments_cache(program_id):
             latest_by_uuid[uuid] = t
 
     logger.info(f"[INFO] Final unique transactions to cache: {len(latest_by_uuid)}")
+    return latest_by_uuid
 
-    # 3) Fetch registrations in bulk (parallel)
-    reg_ids = [
-        t.get("registrationId")
-        for t in latest_by_uuid.values()
-        if t.get("registrationId")
-    ]
-    registrations_map = fetch_registrations_bulk(program_id, reg_ids)
-
-    cache_data = []
-
-    # 4) Build records
-    for t in latest_by_uuid.values():
-        reg_id = t.get("registrationId")
-        uuid = t.get("registrationReferenceId")
 
-        if not reg_id or not uuid:
-            logger.info("[SKIP] Missing reg_id or uuid")
+def select_paid_transactions(all_transactions, since):
+    """
+    {"uuid", "paymentId"} for every transaction 121 reports as successful
+    and created after `since`, for the batch's paid.json (the paid-set feed
+    the scan page checks against, see paid_feed.py).
+    """
+    paid = []
+    for t in all_transactions:
+        if not isinstance(t, dict):
             continue
-
         status = (t.get("status") or t.get("transactionStatus") or "").lower()
-        deleted = (t.get("registrationStatus") or "").lower() == "deleted"
-        created = t.get("created", "")
-
-        try:
-            try:
-                created_dt = datetime.strptime(created, "%Y-%m-%dT%H:%M:%S.%fZ")
-            except ValueError:
-                created_dt = datetime.strptime(created, "%Y-%m-%dT%H:%M:%SZ")
-        except Exception:
-            created_dt = datetime.min
-
-        reg = registrations_map.get(reg_id)
-        if not reg:
-            logger.warning(f"[!] Failed registration fetch for {reg_id}")
+        uuid = t.get("registrationReferenceId")
+        if status != "success" or not uuid:
             continue
+        created_dt = parse_timestamp(t.get("created", ""))
+        if created_dt is None or created_dt < since:
+            continue
+        paid.append({"uuid": uuid, "paymentId": t.get("paymentId")})
+    return paid
 
-        filtered_data = {key: reg.get(key) for key in FIELD_KEYS}
-        per_program_columns = config.get("COLUMN_TO_MATCH_PER_PROGRAM", {})
-        match_key = per_program_columns.get(str(PROGRAM_ID)) or config.get("COLUMN_TO_MATCH")
-        if match_key:
-            filtered_data[match_key] = reg.get(match_key)
-        encrypted_data = encrypt_data(filtered_data)
-
-        photo_filename = f"{uuid}.enc"
-
-        is_valid = status == "waiting" and not deleted and created_dt >= fourteen_days_ago
-
-        reason = "ok"
-        if not is_valid:
-            if status != "waiting":
-                reason = f"status={status}"
-            elif deleted:
-                reason = "deleted"
-            elif created_dt < fourteen_days_ago:
-                reason = "too_old"
-
-        record = {
-            "uuid": uuid,
-            "registrationId": reg_id,
-            "photo_filename": photo_filename,
-            "paymentId": t.get("paymentId"),
-            "amount": t.get("amount", 0),
-            "data": encrypted_data,
-            "valid": is_valid,
-            "reason": reason,
-        }
-
-        cache_data.append(record)
 
-    # 5) Download & encrypt photos in parallel
-    download_photos_bulk(cache_data, photos_dir)
+def prepare_recent_batch(ctx):
+    """
+    First half of a "recent" batch: open (or resume) the run and work out
+    its transactions. Returns the pipeline job for the batch, plus what
+    finish_recent_batch() needs afterwards.
+    """
+    program_id = ctx.program_id
+    run = SyncRun.open(program_id, "recent")
 
-    # 6) Save encrypted registration data
-    json_path = os.path.join(batch_dir, "registrations_cache.json")
-    with open(json_path, "w", encoding="utf-8") as f:
-        json.dump(cache_data, f, indent=2)
+    # Transactions: the run's snapshot when resuming, else refresh the mirror
+    fourteen_days_ago = datetime.utcnow() - timedelta(days=14)
+    snapshot = run.load_snapshot("transactions.json")
+    if snapshot is None:
+        mirror = refresh_mirror(ctx)
+        all_transactions = list(mirror["transactions"].values())
+        logger.info(f"[INFO] Total transactions in mirror for program {program_id}: {len(all_transactions)}")
+        latest_by_uuid = select_recent_transactions(all_transactions, fourteen_days_ago)
+        run.save_snapshot("transactions.json", list(latest_by_uuid.values()))
+    else:
+        mirror = load_mirror(program_id)
+        latest_by_uuid = {t["registrationReferenceId"]: t for t in snapshot}
+        logger.info(f"[INFO] Resuming with {len(latest_by_uuid)} snapshotted transactions")
+
+    return {
+        "ctx": ctx,
+        "run": run,
+        "transactions": [t for t in latest_by_uuid.values() if t.get("registrationId")],
+        "registrations": mirror["registrations"],
+        "mirror": mirror,
+        "latest_by_uuid": latest_by_uuid,
+        "window_start": fourteen_days_ago,
+        "lazy_photos": ctx.photo_mode == LAZY,
+    }
 
-    # Save filtered latest transactions
-    tx_path = os.path.join(batch_dir, "transactions.json")
-    with open(tx_path, "w", encoding="utf-8") as f:
-        json.dump(list(latest_by_uuid.values()), f, indent=2)
 
-    logger.info(f"\n[OK] Batch saved to: {batch_dir}")
-    logger.info(f"{len(cache_data)} beneficiaries ready.")
+def finish_recent_batch(job, result):
+    """
+    Second half of a "recent" batch: given the pipeline result for the job,
+    update the mirror, build and save the records, and publish the batch.
+    """
+    base_path = "offline-cache"
+    program_id = job["ctx"].program_id
+    run = job["run"]
+    registrations_map, photo_uuids, fetched, failures = result
+    store_mirror(program_id, job["mirror"], fetched)
+
+    # Build records
+    cache_data = build_records(
+        job["latest_by_uuid"].values(), registrations_map, job["window_start"]
+    )
+    _discard_orphan_photos(run.photos_dir, cache_data)
+
+    # Save encrypted registration data into the staging area
+    # (transactions.json, the latest transactions per uuid, is already
+    # there as the run's snapshot)
+    run.save_snapshot("registrations_cache.json", cache_data)
+    run.save_snapshot(
+        INDEX_FILENAME, build_match_index(job["ctx"], cache_data, registrations_map)
+    )
+    run.save_snapshot(
+        PAID_FILENAME,
+        select_paid_transactions(job["mirror"]["transactions"].values(), job["window_start"]),
+    )
+    if job["ctx"].scope_attribute:
+        run.save_snapshot(
+            SCOPES_FILENAME, build_scope_index(job["ctx"], cache_data, registrations_map)
+        )
 
     batch_info = {
         "batchType": "payment-recent",
         "programId": program_id,
         "recordCount": len(cache_data),
+        "photoMode": job["ctx"].photo_mode,
+        "photoCount": len(photo_uuids & {r["uuid"] for r in cache_data}),
+        "failures": failures,
         "generatedAt": datetime.utcnow().isoformat() + "Z",
     }
+    if job["lazy_photos"]:
+        batch_info["photoLocatorCount"] = _save_locators(run, cache_data)
+    run.save_snapshot("batch_info.json", batch_info)
+
+    # Publish the finished batch
+    batch_dir = run.finalise(base_path, "recent")
 
-    with open(os.path.join(batch_dir, "batch_info.json"), "w", encoding="utf-8") as f:
-        json.dump(batch_info, f, indent=2)
+    logger.info(f"\n[OK] Batch saved to: {batch_dir}")
+    if failures:
+        logger.info(f"[WARN] {len(failures)} failures recorded in batch_info.json")
+    logger.info(f"{len(cache_data)} beneficiaries ready.")
 
     return len(cache_data)
 
 
+def sync_recent_batches(program_ids):
+    """
+    Build "recent" batches for several programmes in one run.
+
+    They share this process's 121 login, the pooled HTTP sessions and one
+    pipeline (so one MAX_WORKERS budget, fed round-robin). A programme that
+    fails does not stop the others.
+
+    Returns ({programId: record count}, {programId: exception}).
+    """
+    counts, errors = {}, {}
+
+    contexts = []
+    for pid in program_ids:
+        try:
+            contexts.append(ProgramContext(pid))
+        except Exception as e:
+            errors[str(pid)] = e
+
+    def prepare(ctx):
+        try:
+            return prepare_recent_batch(ctx)
+        except Exception as e:
+            logger.error(f"[ERROR] Could not prepare program {ctx.program_id}: {e}")
+            errors[ctx.program_id] = e
+            return None
+
+    # Mirror refreshes are independent per programme: run them side by side
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(contexts)) or 1) as executor:
+        jobs = [job for job in executor.map(prepare, contexts) if job is not None]
+
+    results = run_batch_pipeline(jobs) if jobs else []
+
+    for job, result in zip(jobs, results):
+        program_id = job["ctx"].program_id
+        try:
+            counts[program_id] = finish_recent_batch(job, result)
+        except Exception as e:
+            logger.error(f"[ERROR] Could not save batch for program {program_id}: {e}")
+            errors[program_id] = e
+
+    return counts, errors
+
+
+def download_recent_payments_cache(program_id):
+    """
+    Build a "recent" offline batch:
+    - Refresh the local mirror (incremental pull of transactions/registrations)
+    - Filter to status=waiting, not deleted, created in last 14 days
+    - Keep only the latest transaction per UUID
+    - Fetch registrations missing from the mirror and download & encrypt
+      photos (medium-size), concurrently (run_batch_pipeline); with
+      photoMode "lazy" only resolve the photo URLs
+    - Checkpoint all of it in a SyncRun, so an interrupted run resumes
+    - Save:
+        - registrations_cache.json
+        - transactions.json (latest transactions per uuid)
+        - batch_info.json
+        - photo_locators.json (lazy photos; server-side only)
+        - scopes.json (with a scopeAttribute; server-side only)
+    """
+    ctx = ProgramContext(program_id)
+    job = prepare_recent_batch(ctx)
+    result = run_batch_pipeline([job])[0]
+    return finish_recent_batch(job, result)
+
+
+# ----------------------------------------------------------------------
+# REPAIR: RETRY FAILED / MISSING ITEMS OF AN EXISTING BATCH
+# ----------------------------------------------------------------------
+
+def repair_batch(program_id, batch_dir=None):
+    """
+    Re-fetch only what an existing batch is missing, and update it in place:
+    - registrations that failed (or otherwise have no record)
+    - photos that failed (or are otherwise missing from photos/), or for a
+      lazy-photo batch, photo locators that could not be resolved
+    The batch manifest's failure list is replaced with whatever still fails.
+    The work is staged (SyncRun.for_batch) with the same checkpoint journal,
+    so an interrupted repair resumes and leaves the batch untouched.
+    """
+    base_path = "offline-cache"
+    if not batch_dir:
+        latest = latest_recent_batch(program_id, base_path)
+        batch_dir = latest[0] if latest else None
+    if not batch_dir or not os.path.isdir(batch_dir):
+        raise RuntimeError(f"No batch to repair for programId={program_id}")
+
+    logger.info(f"[INFO] Repairing batch: {batch_dir}")
+    ctx = ProgramContext(program_id)
+    run = SyncRun.for_batch(program_id, batch_dir)
+    batch_info = run.load_snapshot("batch_info.json") or {}
+    cache_data = run.load_snapshot("registrations_cache.json") or []
+    transactions = run.load_snapshot("transactions.json") or []
+
+    window_start = None
+    if batch_info.get("batchType") == "payment-recent":
+        generated = parse_timestamp(batch_info.get("generatedAt", ""))
+        window_start = (generated or datetime.utcnow()) - timedelta(days=14)
+
+    have_records = {r["uuid"] for r in cache_data}
+    batch_photos = os.path.join(batch_dir, "photos")
+    have_photos = {
+        f[:-4] for f in (os.listdir(batch_photos) if os.path.isdir(batch_photos) else [])
+        if f.endswith(".enc")
+    }
+    lazy = batch_info.get("photoMode") == LAZY
+    if lazy:
+        run.locators = run.load_snapshot(LOCATORS_FILENAME) or {}
+    photo_done = have_photos | set(run.locators)
+
+    todo = [
+        t for t in transactions
+        if t.get("registrationId") and t.get("registrationReferenceId")
+        and (
+            t["registrationReferenceId"] not in have_records
+            or t["registrationReferenceId"] not in photo_done
+        )
+    ]
+    logger.info(f"[INFO] {len(todo)} beneficiaries need a registration and/or photo")
+
+    registrations = {str(r["registrationId"]): {"data": r["data"]} for r in cache_data}
+    registrations_map, photo_uuids, fetched, failures = run_batch_pipeline([{
+        "ctx": ctx,
+        "transactions": todo,
+        "run": run,
+        "registrations": registrations,
+        "skip_photos": have_photos,
+        "lazy_photos": lazy,
+    }])[0]
+
+    new_records = build_records(
+        [t for t in todo if t["registrationReferenceId"] not in have_records],
+        registrations_map,
+        window_start,
+    )
+    cache_data.extend(new_records)
+    _discard_orphan_photos(run.photos_dir, cache_data)
+
+    run.save_snapshot("registrations_cache.json", cache_data)
+    run.save_snapshot(INDEX_FILENAME, build_match_index(ctx, cache_data, registrations_map))
+    if ctx.scope_attribute:
+        run.save_snapshot(SCOPES_FILENAME, build_scope_index(
+            ctx, cache_data, registrations_map, previous=run.load_snapshot(SCOPES_FILENAME)
+        ))
+    batch_info.update({
+        "recordCount": len(cache_data),
+        "photoCount": len(photo_uuids & {r["uuid"] for r in cache_data}),
+        "failures": failures,
+        "repairedAt": datetime.utcnow().isoformat() + "Z",
+    })
+    if lazy:
+        batch_info["photoLocatorCount"] = _save_locators(run, cache_data)
+    run.save_snapshot("batch_info.json", batch_info)
+    run.publish_repair()
+
+    if fetched:
+        store_mirror(program_id, load_mirror(program_id), fetched)
+
+    logger.info(f"\n[OK] Repaired batch: {batch_dir} ({len(new_records)} records added)")
+    if failures:
+        logger.info(f"[WARN] {len(failures)} failures still recorded in batch_info.json")
+    logger.info(f"{len(cache_data)} beneficiaries ready.")
+    return len(cache_data)
+
+
 # ----------------------------------------------------------------------
 # CLI ENTRY
 # ----------------------------------------------------------------------
 
+def resolve_program_ids():
+    """
+    Programmes to sync: PROGRAM_IDS (comma-separated, or "all" for every
+    programme in PROGRAMS), else the single PROGRAM_ID.
+    """
+    ids = os.environ.get("PROGRAM_IDS", "").strip()
+    if ids.lower() == "all":
+        return [str(p["programId"]) for p in PROGRAMS if p.get("programId")]
+    if ids:
+        return [pid.strip() for pid in ids.split(",") if pid.strip()]
+
+    program_id = os.environ.get("PROGRAM_ID")
+    if not program_id:
+        raise RuntimeError("PROGRAM_ID not provided to offline_sync.py")
+    return [str(program_id)]
+
+
 if __name__ == "__main__":
-    # Default behaviour: generate the "recent" batch
-    download_recent_payments_cache(PROGRAM_ID)
\ No newline at end of file
+    program_ids = resolve_program_ids()
+
+    if os.environ.get("SYNC_MODE") == "repair":
+        # Retry failed/missing items of the latest (or BATCH_DIR) batch
+        for pid in program_ids:
+            repair_batch(pid, os.environ.get("BATCH_DIR"))
+    elif len(program_ids) == 1:
+        # Default behaviour: generate the "recent" batch
+        download_recent_payments_cache(program_ids[0])
+    else:
+        # One run id cannot name several programmes' staging directories
+        if os.environ.pop("SYNC_RUN_ID", None):
+            logger.warning("[WARN] SYNC_RUN_ID is ignored when syncing several programs")
+        counts, errors = sync_recent_batches(program_ids)
+        logger.info(
+            f"[INFO] Synced {len(counts)} of {len(program_ids)} programs: "
+            + ", ".join(f"{pid}={n}" for pid, n in counts.items())
+        )
+        for pid, e in errors.items():
+            logger.error(f"[ERROR] Program {pid} failed: {e}")
+        if errors:
+            sys.exit(1)
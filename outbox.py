@@ -0,0 +1,451 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import api121
+from upstream import CircuitOpen
+
+
+# ---------------------------------------------------------------------------
+# Durable outbox for payment reconciliation uploads.
+#
+# /submit-payments and /api/submit-decisions no longer upload to 121 while
+# the device waits. They store the reconciliation CSV chunks in a SQLite
+# database and answer at once with a submission id. A background
+# dispatcher delivers the chunks and retries transient failures
+# (network errors, timeouts, 429/5xx) with exponential backoff for up to
+# OUTBOX_RETRY_WINDOW_HOURS; while 121's circuit is open (upstream.py) a
+# chunk just waits for it to close, without using up its retries. The device
+# polls GET /api/submissions/<id> for the outcome per paymentId.
+#
+# Each chunk is keyed by an idempotency key (a hash of programme,
+# paymentId and CSV content), also sent to 121 as an Idempotency-Key
+# header. Submitting the same decisions again (a device retry, a double
+# tap) joins the existing chunk instead of uploading it twice. A chunk
+# being sent holds a lease; if the process dies mid-upload, the lease
+# expires and another dispatcher picks the chunk up again.
+# ---------------------------------------------------------------------------
+
+OUTBOX_DB_PATH = os.getenv("OUTBOX_DB_PATH", os.path.join("outbox", "submissions.sqlite3"))
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "2"))
+# A chunk whose transient failures go on for longer than this fails for good
+OUTBOX_RETRY_WINDOW_HOURS = float(os.getenv("OUTBOX_RETRY_WINDOW_HOURS", "24"))
+OUTBOX_RETRY_BASE_SECONDS = float(os.getenv("OUTBOX_RETRY_BASE_SECONDS", "5"))
+OUTBOX_RETRY_MAX_SECONDS = float(os.getenv("OUTBOX_RETRY_MAX_SECONDS", "600"))
+OUTBOX_RETENTION_DAYS = float(os.getenv("OUTBOX_RETENTION_DAYS", "7"))
+
+# Decision status recorded for the rows of a chunk that failed for good, so
+# followers of decisions_since() stop treating those payments as made
+UNDELIVERED_STATUS = "undelivered"
+
+# Uploads to 121 running at once (per process), and the size of the
+# connection pool they share
+RECONCILIATION_MAX_PARALLEL = int(os.getenv("RECONCILIATION_MAX_PARALLEL", "4"))
+RECONCILIATION_TIMEOUT_SECONDS = int(os.getenv("RECONCILIATION_TIMEOUT_SECONDS", "30"))
+
+# A chunk being sent is re-claimed after this long (the process died)
+LEASE_SECONDS = RECONCILIATION_TIMEOUT_SECONDS * 3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS submissions (
+    id          TEXT PRIMARY KEY,
+    program_id  TEXT NOT NULL,
+    source      TEXT,
+    created_at  REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    key              TEXT PRIMARY KEY,   -- idempotency key
+    program_id       TEXT NOT NULL,
+    payment_id       TEXT NOT NULL,
+    rows             INTEGER NOT NULL,
+    content          TEXT NOT NULL,
+    status           TEXT NOT NULL,      -- pending | sending | done | failed
+    attempts         INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at  REAL NOT NULL,
+    queued_at        REAL,               -- start of the current retry window
+    lease_until      REAL,
+    last_error       TEXT,
+    updated_at       REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chunks_due ON chunks (status, next_attempt_at);
+CREATE TABLE IF NOT EXISTS submission_chunks (
+    submission_id  TEXT NOT NULL,
+    chunk_key      TEXT NOT NULL,
+    chunk_no       INTEGER NOT NULL,
+    refs           TEXT,                 -- JSON list (e.g. uuids), may be empty
+    PRIMARY KEY (submission_id, chunk_key)
+);
+CREATE TABLE IF NOT EXISTS decisions (
+    id             INTEGER PRIMARY KEY AUTOINCREMENT,
+    submission_id  TEXT NOT NULL,
+    program_id     TEXT NOT NULL,
+    uuid           TEXT NOT NULL,
+    payment_id     TEXT NOT NULL,
+    status         TEXT NOT NULL,
+    created_at     REAL NOT NULL
+);
+"""
+
+_schema_lock = threading.Lock()
+_schema_ready = set()
+
+_session = api121.pooled_session(RECONCILIATION_MAX_PARALLEL)
+
+
+def _connect():
+    directory = os.path.dirname(OUTBOX_DB_PATH)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(OUTBOX_DB_PATH, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    with _schema_lock:
+        if OUTBOX_DB_PATH not in _schema_ready:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            # Databases created before queued_at existed
+            columns = {r["name"] for r in conn.execute("PRAGMA table_info(chunks)")}
+            if "queued_at" not in columns:
+                conn.execute("ALTER TABLE chunks ADD COLUMN queued_at REAL")
+                conn.execute("UPDATE chunks SET queued_at = updated_at")
+            _schema_ready.add(OUTBOX_DB_PATH)
+    return conn
+
+
+def idempotency_key(program_id, payment_id, content):
+    return hashlib.sha256(f"{program_id}|{payment_id}|{content}".encode()).hexdigest()
+
+
+def enqueue(program_id, chunks, source=None, decisions=()):
+    """
+    Store a submission and return its id.
+    chunks: iterable of (payment_id, chunk_no, rows, content, refs).
+    decisions: (uuid, payment_id, status) per row whose uuid is known;
+    recorded as soon as the submission is accepted (see decisions_since),
+    and followed by an UNDELIVERED_STATUS row if their chunk fails for good.
+    A chunk already in the outbox is joined rather than added again; one
+    that had failed for good is given a fresh set of attempts.
+    """
+    submission_id = uuid.uuid4().hex
+    now = time.time()
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute(
+            "INSERT INTO submissions (id, program_id, source, created_at) VALUES (?, ?, ?, ?)",
+            (submission_id, str(program_id), source, now),
+        )
+        for payment_id, chunk_no, rows, content, refs in chunks:
+            key = idempotency_key(program_id, payment_id, content)
+            conn.execute(
+                "INSERT OR IGNORE INTO chunks "
+                "(key, program_id, payment_id, rows, content, status, next_attempt_at, queued_at, "
+                "updated_at) VALUES (?, ?, ?, ?, ?, 'pending', ?, ?, ?)",
+                (key, str(program_id), str(payment_id), rows, content, now, now, now),
+            )
+            conn.execute(
+                "UPDATE chunks SET status = 'pending', attempts = 0, next_attempt_at = ?, "
+                "queued_at = ?, last_error = NULL, updated_at = ? WHERE key = ? AND status = 'failed'",
+                (now, now, now, key),
+            )
+            conn.execute(
+                "INSERT OR IGNORE INTO submission_chunks (submission_id, chunk_key, chunk_no, refs) "
+                "VALUES (?, ?, ?, ?)",
+                (submission_id, key, chunk_no, json.dumps(list(refs or []))),
+            )
+        conn.executemany(
+            "INSERT INTO decisions (submission_id, program_id, uuid, payment_id, status, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [(submission_id, str(program_id), str(u), str(pid), status, now) for u, pid, status in decisions],
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    _wake.set()
+    return submission_id
+
+
+def submission_status(submission_id):
+    """
+    {"id", "programId", "status", "payments": [...]} or None if unknown.
+    status: pending (still being delivered), done, failed or partial.
+    Each payment lists its chunks with their status, attempts, last error
+    and, for failed chunks, the refs (uuids) they carried.
+    """
+    conn = _connect()
+    try:
+        submission = conn.execute(
+            "SELECT * FROM submissions WHERE id = ?", (submission_id,)
+        ).fetchone()
+        if not submission:
+            return None
+        rows = conn.execute(
+            "SELECT c.payment_id, c.rows, c.status, c.attempts, c.last_error, "
+            "s.chunk_no, s.refs FROM submission_chunks s JOIN chunks c ON c.key = s.chunk_key "
+            "WHERE s.submission_id = ? ORDER BY c.payment_id, s.chunk_no",
+            (submission_id,),
+        ).fetchall()
+    finally:
+        conn.close()
+
+    payments = {}
+    for r in rows:
+        status = "pending" if r["status"] == "sending" else r["status"]
+        chunk = {
+            "chunk": r["chunk_no"],
+            "rows": r["rows"],
+            "status": status,
+            "attempts": r["attempts"],
+            "error": r["last_error"],
+        }
+        if status == "failed":
+            chunk["uuids"] = json.loads(r["refs"] or "[]")
+        payments.setdefault(r["payment_id"], []).append(chunk)
+
+    result = []
+    for payment_id, chunks in payments.items():
+        states = {c["status"] for c in chunks}
+        result.append({
+            "paymentId": payment_id,
+            "status": _combine(states),
+            "chunks": chunks,
+        })
+
+    return {
+        "id": submission_id,
+        "programId": submission["program_id"],
+        "status": _combine({p["status"] for p in result}),
+        "payments": result,
+    }
+
+
+def decisions_since(after_id=0, limit=5000):
+    """
+    Decisions recorded after id `after_id`, oldest first, as dicts with
+    id, programId, uuid, paymentId, status and createdAt. Lets other
+    processes follow submissions incrementally (see verify_index.py). A
+    decision whose chunk failed for good is followed by a row with status
+    UNDELIVERED_STATUS for the same uuid and paymentId.
+    """
+    conn = _connect()
+    try:
+        rows = conn.execute(
+            "SELECT id, program_id, uuid, payment_id, status, created_at FROM decisions "
+            "WHERE id > ? ORDER BY id LIMIT ?",
+            (after_id, limit),
+        ).fetchall()
+    finally:
+        conn.close()
+    return [
+        {
+            "id": r["id"], "programId": r["program_id"], "uuid": r["uuid"],
+            "paymentId": r["payment_id"], "status": r["status"], "createdAt": r["created_at"],
+        }
+        for r in rows
+    ]
+
+
+def _combine(states):
+    if "pending" in states:
+        return "pending"
+    if states == {"done"}:
+        return "done"
+    if states == {"failed"}:
+        return "failed"
+    return "partial"
+
+
+# ---------------------------------------------------------------------------
+# Dispatcher
+# ---------------------------------------------------------------------------
+
+_wake = threading.Event()
+_dispatcher_started = False
+_dispatcher_lock = threading.Lock()
+
+
+def _claim(limit):
+    """Atomically lease up to `limit` due chunks; returns their rows."""
+    now = time.time()
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        rows = conn.execute(
+            "SELECT key, program_id, payment_id, content, attempts, queued_at FROM chunks "
+            "WHERE (status = 'pending' AND next_attempt_at <= ?) "
+            "OR (status = 'sending' AND lease_until < ?) "
+            "ORDER BY next_attempt_at LIMIT ?",
+            (now, now, limit),
+        ).fetchall()
+        for r in rows:
+            conn.execute(
+                "UPDATE chunks SET status = 'sending', lease_until = ?, updated_at = ? WHERE key = ?",
+                (now + LEASE_SECONDS, now, r["key"]),
+            )
+        conn.execute("COMMIT")
+        return rows
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+
+def _deliver(chunk):
+    """Upload one chunk. Returns (outcome, detail): done, retry, wait or failed."""
+    label = f"paymentId {chunk['payment_id']}"
+    try:
+        resp = api121.post(
+            f"/api/programs/{chunk['program_id']}/payments/{chunk['payment_id']}/excel-reconciliation",
+            session=_session,
+            files={"file": ("reconciliation.csv", chunk["content"], "text/csv")},
+            headers={"Idempotency-Key": chunk["key"]},
+            timeout=RECONCILIATION_TIMEOUT_SECONDS,
+        )
+    except CircuitOpen as e:
+        return "wait", f"121 unreachable — {e}"
+    except (requests.RequestException, api121.LoginError) as e:
+        print(f"[OUTBOX] Network error submitting {label}: {e}")
+        return "retry", f"network error — {e}"
+
+    if resp.status_code == 201:
+        print(f"[OUTBOX] Submitted {label}")
+        return "done", None
+
+    detail = f"HTTP {resp.status_code} — {(resp.text or '')[:300]}"
+    print(f"[OUTBOX] Failed to submit {label}: {detail}")
+    if resp.status_code == 429 or resp.status_code >= 500:
+        return "retry", detail
+    return "failed", detail
+
+
+def _record(chunk, outcome, detail):
+    now = time.time()
+    attempts = chunk["attempts"]
+    if outcome == "wait":
+        # Not sent at all: not an attempt; try again once the circuit may have closed
+        status, next_attempt_at = "pending", now + api121.breaker.reset_seconds
+    else:
+        attempts += 1
+        if outcome == "retry" and now - (chunk["queued_at"] or now) >= OUTBOX_RETRY_WINDOW_HOURS * 3600:
+            outcome = "failed"
+        if outcome == "retry":
+            delay = min(OUTBOX_RETRY_BASE_SECONDS * 2 ** (attempts - 1), OUTBOX_RETRY_MAX_SECONDS)
+            status, next_attempt_at = "pending", now + delay
+        else:
+            status, next_attempt_at = outcome, now
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute(
+            "UPDATE chunks SET status = ?, attempts = ?, next_attempt_at = ?, lease_until = NULL, "
+            "last_error = ?, updated_at = ? WHERE key = ?",
+            (status, attempts, next_attempt_at, detail, now, chunk["key"]),
+        )
+        if status == "failed":
+            _record_undelivered(conn, chunk, now)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+
+def _record_undelivered(conn, chunk, now):
+    """Reverse the decisions carried by a chunk that 121 never received."""
+    rows = []
+    for link in conn.execute(
+        "SELECT submission_id, refs FROM submission_chunks WHERE chunk_key = ?", (chunk["key"],)
+    ).fetchall():
+        refs = set(json.loads(link["refs"] or "[]"))
+        for d in conn.execute(
+            "SELECT DISTINCT uuid FROM decisions WHERE submission_id = ? AND payment_id = ?",
+            (link["submission_id"], chunk["payment_id"]),
+        ).fetchall():
+            if d["uuid"] in refs:
+                rows.append((link["submission_id"], chunk["program_id"], d["uuid"], chunk["payment_id"]))
+    conn.executemany(
+        "INSERT INTO decisions (submission_id, program_id, uuid, payment_id, status, created_at) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        [row + (UNDELIVERED_STATUS, now) for row in rows],
+    )
+
+
+def _process(chunk):
+    try:
+        outcome, detail = _deliver(chunk)
+    except Exception as e:
+        outcome, detail = "retry", f"{type(e).__name__}: {e}"
+    _record(chunk, outcome, detail)
+
+
+def _purge_old():
+    cutoff = time.time() - OUTBOX_RETENTION_DAYS * 86400
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM submissions WHERE created_at < ?", (cutoff,))
+        conn.execute(
+            "DELETE FROM submission_chunks WHERE submission_id NOT IN (SELECT id FROM submissions)"
+        )
+        conn.execute("DELETE FROM decisions WHERE submission_id NOT IN (SELECT id FROM submissions)")
+        conn.execute(
+            "DELETE FROM chunks WHERE status IN ('done', 'failed') AND updated_at < ? "
+            "AND key NOT IN (SELECT chunk_key FROM submission_chunks)",
+            (cutoff,),
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+
+def dispatch_once(executor):
+    """Deliver whatever is due, RECONCILIATION_MAX_PARALLEL at a time."""
+    chunks = _claim(RECONCILIATION_MAX_PARALLEL)
+    if chunks:
+        list(executor.map(_process, [dict(c) for c in chunks]))
+    return len(chunks)
+
+
+def start_dispatcher():
+    """Start the background dispatcher thread (once per process)."""
+    global _dispatcher_started
+    with _dispatcher_lock:
+        if _dispatcher_started:
+            return
+        _dispatcher_started = True
+
+    def loop():
+        executor = ThreadPoolExecutor(
+            max_workers=RECONCILIATION_MAX_PARALLEL, thread_name_prefix="outbox"
+        )
+        last_purge = 0
+        while True:
+            try:
+                if time.time() - last_purge > 3600:
+                    _purge_old()
+                    last_purge = time.time()
+                # Keep going while there is work; otherwise wait for a
+                # new submission or the next retry to come due
+                if dispatch_once(executor):
+                    continue
+            except Exception as e:
+                print(f"[OUTBOX] Dispatcher error: {e}")
+            _wake.wait(OUTBOX_POLL_SECONDS)
+            _wake.clear()
+
+    threading.Thread(target=loop, name="outbox-dispatcher", daemon=True).start()
+    print("[OUTBOX] Dispatcher started")
@@ -0,0 +1,236 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import outbox
+from sync_runner import latest_recent_batch
+
+
+# ---------------------------------------------------------------------------
+# Versioned feed of paid uuids per programme, for cross-device duplicate
+# detection on the scan page.
+#
+# Every (programme, paymentId, uuid) known to be paid gets a row with an
+# increasing sequence number; the newest sequence number is the feed's
+# version. A device keeps the set it has and asks for the rows after its
+# version (GET /api/paid-set?since=<version>), which is a few KB per
+# refresh instead of a full resync.
+#
+# Two sources feed it:
+#   - decisions with status "success" queued in the submission outbox
+#     (followed by row id, so every worker sees every device's payments);
+#   - transactions 121 already reports as successful, which offline_sync.py
+#     writes to paid.json in each recent batch (server-side only).
+# Entries are scoped to the paymentId, so a beneficiary paid in an earlier
+# payment round can still be scanned for the next one.
+#
+# When the outbox gives up delivering a payment to 121 (an "undelivered"
+# decision), its outbox entry is withdrawn: the row is re-sequenced as
+# removed, so devices drop the uuid with their next delta and the FSP can
+# resend it. Entries 121 itself reported paid are never withdrawn.
+# ---------------------------------------------------------------------------
+
+PAID_FILENAME = "paid.json"
+
+PAID_FEED_DB_PATH = os.getenv("PAID_FEED_DB_PATH", os.path.join("outbox", "paid_feed.sqlite3"))
+PAID_FEED_BATCH_CHECK_SECONDS = float(os.getenv("PAID_FEED_BATCH_CHECK_SECONDS", "30"))
+PAID_FEED_RETENTION_DAYS = float(os.getenv("PAID_FEED_RETENTION_DAYS", "60"))
+
+PAID_STATUS = "success"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS paid (
+    seq         INTEGER PRIMARY KEY AUTOINCREMENT,
+    program_id  TEXT NOT NULL,
+    payment_id  TEXT NOT NULL,
+    uuid        TEXT NOT NULL,
+    source      TEXT NOT NULL,      -- outbox | 121
+    removed     INTEGER NOT NULL DEFAULT 0,
+    created_at  REAL NOT NULL,
+    UNIQUE (program_id, payment_id, uuid)
+);
+CREATE INDEX IF NOT EXISTS paid_program_seq ON paid (program_id, seq);
+CREATE TABLE IF NOT EXISTS state (
+    key    TEXT PRIMARY KEY,
+    value  TEXT
+);
+"""
+
+_schema_lock = threading.Lock()
+_schema_ready = set()
+
+_batch_checked_at = {}   # programId -> monotonic time of the last batch check
+_last_purge = 0
+
+
+def _connect():
+    directory = os.path.dirname(PAID_FEED_DB_PATH)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(PAID_FEED_DB_PATH, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    with _schema_lock:
+        if PAID_FEED_DB_PATH not in _schema_ready:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            # Feeds created before entries could be withdrawn
+            columns = {r["name"] for r in conn.execute("PRAGMA table_info(paid)")}
+            if "removed" not in columns:
+                conn.execute("ALTER TABLE paid ADD COLUMN removed INTEGER NOT NULL DEFAULT 0")
+            _schema_ready.add(PAID_FEED_DB_PATH)
+    return conn
+
+
+def _get_state(conn, key, default=None):
+    row = conn.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+    return row["value"] if row else default
+
+
+def _set_state(conn, key, value):
+    conn.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, str(value)))
+
+
+def _resequence(conn, key, source, removed):
+    """Replace an entry with one under a new sequence number (a new version)."""
+    conn.execute("DELETE FROM paid WHERE program_id = ? AND payment_id = ? AND uuid = ?", key)
+    conn.execute(
+        "INSERT INTO paid (program_id, payment_id, uuid, source, removed, created_at) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        key + (source, int(removed), time.time()),
+    )
+
+
+def _add(conn, rows, source):
+    for pid, payment_id, uuid in rows:
+        key = (str(pid), str(payment_id), str(uuid))
+        row = conn.execute(
+            "SELECT removed FROM paid WHERE program_id = ? AND payment_id = ? AND uuid = ?", key
+        ).fetchone()
+        if row is None or row["removed"]:
+            _resequence(conn, key, source, removed=False)
+        elif source == "121":
+            # Confirmed by 121: no longer withdrawn by an outbox failure
+            conn.execute(
+                "UPDATE paid SET source = ? WHERE program_id = ? AND payment_id = ? AND uuid = ?",
+                (source,) + key,
+            )
+
+
+def _withdraw(conn, rows):
+    """Mark outbox entries removed (121 never received those payments)."""
+    for pid, payment_id, uuid in rows:
+        key = (str(pid), str(payment_id), str(uuid))
+        row = conn.execute(
+            "SELECT source, removed FROM paid WHERE program_id = ? AND payment_id = ? AND uuid = ?", key
+        ).fetchone()
+        if row is not None and row["source"] == "outbox" and not row["removed"]:
+            _resequence(conn, key, "outbox", removed=True)
+
+
+def _ingest_outbox(conn):
+    """Apply the outbox's paid and undelivered decisions since the stored cursor."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        cursor = int(_get_state(conn, "outbox_cursor", 0))
+        while True:
+            decisions = outbox.decisions_since(cursor)
+            if not decisions:
+                break
+            for d in decisions:  # in order: a resend after a failure is paid again
+                row = (d["programId"], d["paymentId"], d["uuid"])
+                if d["status"] == PAID_STATUS:
+                    _add(conn, [row], "outbox")
+                elif d["status"] == outbox.UNDELIVERED_STATUS:
+                    _withdraw(conn, [row])
+            cursor = decisions[-1]["id"]
+        _set_state(conn, "outbox_cursor", cursor)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def _ingest_batch(conn, program_id):
+    """Add 121's successful transactions from a newly published batch."""
+    key = str(program_id)
+    if time.monotonic() - _batch_checked_at.get(key, 0) < PAID_FEED_BATCH_CHECK_SECONDS:
+        return
+    _batch_checked_at[key] = time.monotonic()
+
+    latest = latest_recent_batch(program_id)
+    if not latest:
+        return
+    batch_dir = latest[0]
+    batch = os.path.basename(batch_dir)
+    if _get_state(conn, f"batch:{key}") == batch:
+        return
+
+    path = os.path.join(batch_dir, PAID_FILENAME)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            paid = json.load(f)
+    except FileNotFoundError:
+        paid = []  # batch synced before paid.json existed
+    except (OSError, ValueError) as e:
+        print(f"[PAID] Could not read {path}: {e}")
+        return
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        _add(conn, [(key, p.get("paymentId"), p.get("uuid")) for p in paid if p.get("uuid")], "121")
+        _set_state(conn, f"batch:{key}", batch)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def _purge_old(conn):
+    global _last_purge
+    if time.time() - _last_purge < 3600:
+        return
+    _last_purge = time.time()
+    cutoff = time.time() - PAID_FEED_RETENTION_DAYS * 86400
+    conn.execute("DELETE FROM paid WHERE created_at < ?", (cutoff,))
+
+
+def changes(program_id, since=0):
+    """
+    Paid uuids added and withdrawn after version `since`:
+    {"programId", "version", "reset", "paid": {paymentId: [sorted uuids]},
+    "removed": {paymentId: [sorted uuids]}}.
+    reset=True (with the whole set) when `since` is ahead of the feed,
+    e.g. after the server's feed was recreated; the device then replaces
+    its copy instead of merging.
+    """
+    program_id = str(program_id)
+    conn = _connect()
+    try:
+        _ingest_outbox(conn)
+        _ingest_batch(conn, program_id)
+        _purge_old(conn)
+
+        version = conn.execute(
+            "SELECT COALESCE(MAX(seq), 0) FROM paid WHERE program_id = ?", (program_id,)
+        ).fetchone()[0]
+        reset = since > version
+        if reset:
+            since = 0
+        rows = conn.execute(
+            "SELECT payment_id, uuid, removed FROM paid WHERE program_id = ? AND seq > ? AND seq <= ?",
+            (program_id, since, version),
+        ).fetchall()
+    finally:
+        conn.close()
+
+    paid, removed = {}, {}
+    for r in rows:
+        if not r["removed"]:
+            paid.setdefault(r["payment_id"], []).append(r["uuid"])
+        elif since:
+            removed.setdefault(r["payment_id"], []).append(r["uuid"])
+    for uuids in list(paid.values()) + list(removed.values()):
+        uuids.sort()
+    return {"programId": program_id, "version": version, "reset": reset, "paid": paid, "removed": removed}
@@ -0,0 +1,226 @@
+import itertools
+import json
+import os
+import threading
+import time
+
+import kobo_api
+from config_loader import load_config
+from sync_runner import latest_recent_batch
+
+
+# ---------------------------------------------------------------------------
+# Encrypted photos on demand, for programmes whose photos are "lazy".
+#
+# With photoMode "lazy" on a PROGRAMS entry, offline_sync.py still resolves
+# every beneficiary's Kobo photo URLs but does not download them: the batch
+# ships records only, and the URLs are saved as photo_locators.json in the
+# batch (server-side only, in expected queue order, i.e. batch order).
+#
+# GET /api/photos/<uuid> answers with the same Fernet-encrypted bytes a
+# batch's photos/<uuid>.enc holds, so the device stores and decrypts them
+# exactly like an imported photo. A photo is downloaded from Kobo the first
+# time it is asked for and kept in PHOTO_STORE_DIR/<programId>/<uuid>.enc,
+# so every later device (and later batch) gets it from disk, until it has
+# not been asked for in PHOTO_STORE_RETENTION_DAYS. Photos of "eager"
+# batches are served straight from the batch.
+# ---------------------------------------------------------------------------
+
+LOCATORS_FILENAME = "photo_locators.json"
+LAZY = "lazy"
+
+PHOTO_STORE_DIR = os.getenv("PHOTO_STORE_DIR", "offline-photos")
+PHOTO_PREFETCH_COUNT = int(os.getenv("PHOTO_PREFETCH_COUNT", "10"))
+PHOTO_BATCH_CHECK_SECONDS = float(os.getenv("PHOTO_BATCH_CHECK_SECONDS", "10"))
+PHOTO_DOWNLOAD_TIMEOUT_SECONDS = float(os.getenv("PHOTO_DOWNLOAD_TIMEOUT_SECONDS", "30"))
+PHOTO_STORE_RETENTION_DAYS = float(os.getenv("PHOTO_STORE_RETENTION_DAYS", "30"))
+
+
+class PhotoUnavailable(Exception):
+    """The photo could not be downloaded from Kobo; str(e) is the reason."""
+
+
+class _Locators:
+    def __init__(self, batch_dir, mtime, locators):
+        self.batch_dir = batch_dir
+        self.mtime = mtime                        # of photo_locators.json (repair rewrites it)
+        self.urls = locators                      # uuid -> [urls to try in order]
+        self.order = list(locators)               # batch order
+        self.position = {u: i for i, u in enumerate(self.order)}
+
+
+_lock = threading.Lock()
+_batches = {}        # programId -> _Locators
+_checked_at = {}     # programId -> monotonic time of the last batch check
+
+_download_locks = {}  # (programId, uuid) -> [Lock, threads using it]
+_last_prune = 0
+
+_fernet = None
+
+
+def _load_locators(program_id):
+    latest = latest_recent_batch(program_id)
+    if not latest:
+        return None
+    batch_dir = latest[0]
+    path = os.path.join(batch_dir, LOCATORS_FILENAME)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        mtime = None  # eager batch: its photos are in photos/
+    current = _batches.get(str(program_id))
+    if current and current.batch_dir == batch_dir and current.mtime == mtime:
+        return current
+
+    locators = {}
+    if mtime is not None:
+        with open(path, "r", encoding="utf-8") as f:
+            locators = json.load(f)
+    return _Locators(batch_dir, mtime, locators)
+
+
+def _locators(program_id):
+    key = str(program_id)
+    with _lock:
+        current = _batches.get(key)
+        if current and time.monotonic() - _checked_at.get(key, 0) < PHOTO_BATCH_CHECK_SECONDS:
+            return current
+        _checked_at[key] = time.monotonic()
+    loaded = _load_locators(program_id)
+    with _lock:
+        if loaded is not None:
+            _batches[key] = loaded
+        return _batches.get(key)
+
+
+def _encrypt(data):
+    global _fernet
+    if _fernet is None:
+        from cryptography.fernet import Fernet
+
+        _fernet = Fernet(load_config()["ENCRYPTION_KEY"].encode())
+    return _fernet.encrypt(data)
+
+
+def _read(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def _download(uuid, urls):
+    """The first of `urls` that downloads, as Fernet-encrypted bytes."""
+    config = load_config()
+    headers = {"Authorization": f"Token {config.get('KOBO_TOKEN', '')}"}
+    status = "-"
+    for url in urls:
+        res = kobo_api.breaker.call(
+            kobo_api.SESSION.get, url, headers=headers, timeout=PHOTO_DOWNLOAD_TIMEOUT_SECONDS
+        )
+        if res.status_code == 200:
+            return _encrypt(res.content)
+        status = res.status_code
+        print(f"[PHOTO] Download failed ({status}) for UUID {uuid}: {url[:80]}")
+    raise PhotoUnavailable(f"download failed (HTTP {status})")
+
+
+def _store_path(program_id, uuid):
+    return os.path.join(PHOTO_STORE_DIR, str(program_id), f"{uuid}.enc")
+
+
+def _prune():
+    """Drop stored photos not asked for in PHOTO_STORE_RETENTION_DAYS."""
+    global _last_prune
+    with _lock:
+        if time.time() - _last_prune < 3600 or not os.path.isdir(PHOTO_STORE_DIR):
+            return
+        _last_prune = time.time()
+    cutoff = time.time() - PHOTO_STORE_RETENTION_DAYS * 86400
+    removed = 0
+    for program_dir in os.listdir(PHOTO_STORE_DIR):
+        program_path = os.path.join(PHOTO_STORE_DIR, program_dir)
+        if not os.path.isdir(program_path):
+            continue
+        for fname in os.listdir(program_path):
+            path = os.path.join(program_path, fname)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                continue  # served or removed meanwhile
+    if removed:
+        print(f"[PHOTO] Removed {removed} stored photos older than {PHOTO_STORE_RETENTION_DAYS:g} days")
+
+
+def get_photo(program_id, uuid):
+    """
+    Encrypted photo bytes for a beneficiary, or None if the latest batch
+    has neither the photo nor a locator for it. Raises PhotoUnavailable
+    (or a requests error) when Kobo cannot provide it right now.
+    """
+    if not uuid or os.path.basename(uuid) != uuid:
+        return None
+    locators = _locators(program_id)
+    if locators is None:
+        return None
+
+    data = _read(os.path.join(locators.batch_dir, "photos", f"{uuid}.enc"))
+    if data is not None:
+        return data
+
+    path = _store_path(program_id, uuid)
+    data = _read(path)
+    if data is not None:
+        try:
+            os.utime(path)  # still in use: keep it past the retention cut-off
+        except OSError:
+            pass
+        return data
+
+    urls = locators.urls.get(uuid)
+    if not urls:
+        return None
+    _prune()
+
+    # One download per photo, however many devices ask for it at once. The
+    # lock is shared until its last user is done, so a thread arriving
+    # after the first download failed cannot race one still retrying.
+    key = (str(program_id), uuid)
+    with _lock:
+        entry = _download_locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            data = _read(path)
+            if data is None:
+                data = _download(uuid, urls)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f"{path}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+                print(f"[PHOTO] Stored photo for UUID {uuid} (program {program_id})")
+    finally:
+        with _lock:
+            entry[1] -= 1
+            if not entry[1]:
+                _download_locks.pop(key, None)
+    return data
+
+
+def next_uuids(program_id, uuid, count=PHOTO_PREFETCH_COUNT, allowed=None):
+    """
+    The `count` lazy-photo uuids after `uuid` in batch order, optionally
+    only those in `allowed` (a per-site batch's uuids).
+    """
+    locators = _locators(program_id)
+    if locators is None or uuid not in locators.position:
+        return []
+    following = locators.order[locators.position[uuid] + 1:]
+    if allowed is not None:
+        following = (u for u in following if u in allowed)
+    return list(itertools.islice(following, count))
@@ -0,0 +1,490 @@
+import json
+import os
+import re
+import subprocess
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from datetime import datetime, timedelta, timezone
+
+from api121 import export_token
+from config_loader import load_config
+
+
+# ---------------------------------------------------------------------------
+# Running offline_sync.py, and pre-building batches on a schedule.
+#
+# Each programme in PROGRAMS may carry a "syncSchedule", either an interval
+# ("every 30m", "every 6h", "every 1d") or a 5-field cron expression
+# ("0 5 * * 1-5" = 05:00 on weekdays, server local time). A background
+# thread in the web app runs offline_sync.py for every programme that is
+# due, so the batch is already built when an FSP presses "Sync".
+#
+# /sync-fsp then serves the newest "recent" batch straight away when it is
+# younger than SYNC_FRESHNESS_MINUTES, instead of building a new one, and
+# otherwise goes through sync_program() so concurrent requests share a run.
+# ---------------------------------------------------------------------------
+BATCH_BASE = "offline-cache"
+SYNC_COMMAND = ["python", "offline_sync.py"]
+
+DEFAULT_FRESHNESS_MINUTES = 60
+SCHEDULER_TICK_SECONDS = int(os.getenv("SYNC_SCHEDULER_TICK_SECONDS", "30"))
+
+LOCK_DIR = os.path.join(os.getenv("OFFLINE_STAGING_DIR", "offline-staging"), "locks")
+
+# Only one process (gunicorn worker, Flask reloader child, ...) schedules.
+SCHEDULER_LOCK_PATH = os.path.join(LOCK_DIR, "scheduler.lock")
+
+# A successful sync result is handed to requests arriving this soon after it
+# finished, instead of starting another sync.
+RESULT_CACHE_SECONDS = float(os.getenv("SYNC_RESULT_CACHE_SECONDS", "30"))
+
+
+def run_sync(program_ids, mode=None):
+    """
+    Run offline_sync.py for one or more programmes and return the
+    subprocess.CompletedProcess (stdout/stderr captured as text).
+    """
+    env = os.environ.copy()
+    program_ids = [str(pid) for pid in program_ids]
+    if len(program_ids) == 1:
+        env["PROGRAM_ID"] = program_ids[0]
+    else:
+        env["PROGRAM_IDS"] = ",".join(program_ids)
+    if mode:
+        env["SYNC_MODE"] = mode
+    # Hand over the web app's 121 token so the sync skips its own login
+    export_token(env)
+
+    return subprocess.run(
+        SYNC_COMMAND,
+        capture_output=True,
+        text=True,
+        encoding="utf-8",
+        errors="replace",
+        env=env,
+    )
+
+
+# ---------------------------------------------------------------------------
+# Single-flight syncs
+#
+# Concurrent sync requests for the same programme (several FSP devices
+# pressing "Sync" at once, or the scheduler) share one offline_sync.py run:
+# the first caller runs it, everyone else waits for and receives the same
+# result. A finished result is kept for RESULT_CACHE_SECONDS for stragglers.
+#
+# Across processes, a per-programme file lock serialises the runs; a caller
+# that had to wait for another process's run gets that run's batch. A flight
+# landed with neither result nor error means its leader stood down (the
+# scheduler does not wait for locks): waiters then sync themselves.
+# ---------------------------------------------------------------------------
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_flights = {}          # (programId, mode) -> _Flight in progress
+_recent_results = {}   # (programId, mode) -> (finished monotonic time, result)
+_flights_lock = threading.Lock()
+
+
+def _flight_key(program_id, mode):
+    return (str(program_id), mode or "recent")
+
+
+def _join_flight(key):
+    """Return (flight, is_leader, cached_result) for a sync key."""
+    with _flights_lock:
+        cached = _recent_results.get(key)
+        if cached and time.monotonic() - cached[0] < RESULT_CACHE_SECONDS:
+            return None, False, cached[1]
+        flight = _flights.get(key)
+        if flight is not None:
+            return flight, False, None
+        flight = _flights[key] = _Flight()
+        return flight, True, None
+
+
+def _land_flight(key, flight, result=None, error=None):
+    flight.result, flight.error = result, error
+    with _flights_lock:
+        _flights.pop(key, None)
+        if error is None and result is not None and result.returncode == 0:
+            _recent_results[key] = (time.monotonic(), result)
+    flight.done.set()
+
+
+@contextmanager
+def _program_lock(program_id, blocking=True):
+    """
+    Exclusive per-programme file lock, shared by every process on this
+    instance. Yields (acquired, waited).
+    """
+    try:
+        import fcntl
+    except ImportError:
+        yield True, False  # no flock (Windows dev box): single process assumed
+        return
+    os.makedirs(LOCK_DIR, exist_ok=True)
+    with open(os.path.join(LOCK_DIR, f"program-{program_id}.lock"), "w") as f:
+        waited = False
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            if not blocking:
+                yield False, False
+                return
+            waited = True
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield True, waited
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _batch_result(info):
+    """A CompletedProcess describing an already published batch."""
+    return subprocess.CompletedProcess(
+        SYNC_COMMAND, 0,
+        stdout=f"{info.get('recordCount', 0)} beneficiaries ready.\n",
+        stderr="",
+    )
+
+
+def sync_program(program_id, mode=None):
+    """
+    Run (or join) the sync for one programme; see "Single-flight syncs".
+    Returns a subprocess.CompletedProcess like run_sync().
+    """
+    key = _flight_key(program_id, mode)
+    flight, leader, cached = _join_flight(key)
+    if cached is not None:
+        return cached
+    if not leader:
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        if flight.result is None:
+            # The leader stood down: wait for the other process's run ourselves
+            return sync_program(program_id, mode=mode)
+        return flight.result
+
+    try:
+        started = datetime.utcnow()
+        with _program_lock(program_id) as (_, waited):
+            latest = latest_recent_batch(program_id) if waited and not mode else None
+            if latest and latest[2] >= started:
+                # Another process built a batch while we waited for the lock
+                result = _batch_result(latest[1])
+            else:
+                result = run_sync([program_id], mode=mode)
+    except Exception as e:
+        _land_flight(key, flight, error=e)
+        raise
+    _land_flight(key, flight, result=result)
+    return result
+
+
+# ---------------------------------------------------------------------------
+# Batch freshness
+# ---------------------------------------------------------------------------
+
+def _parse_utc(value):
+    for fmt in ("%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%SZ"):
+        try:
+            return datetime.strptime(value, fmt)
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+def latest_recent_batch(program_id, base_dir=BATCH_BASE):
+    """
+    Newest published "recent" batch for a programme, as
+    (batch_dir, batch_info, generated_at_utc), or None.
+    """
+    if not os.path.isdir(base_dir):
+        return None
+    newest = None
+    for d in os.listdir(base_dir):
+        info_path = os.path.join(base_dir, d, "batch_info.json")
+        try:
+            with open(info_path, "r", encoding="utf-8") as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if str(info.get("programId")) != str(program_id):
+            continue
+        if info.get("batchType") != "payment-recent":
+            continue
+        generated = _parse_utc(info.get("generatedAt"))
+        if generated and (newest is None or generated > newest[2]):
+            newest = (os.path.join(base_dir, d), info, generated)
+    return newest
+
+
+def freshness_minutes(config=None):
+    config = config or load_config()
+    try:
+        return float(config.get("SYNC_FRESHNESS_MINUTES", DEFAULT_FRESHNESS_MINUTES))
+    except (TypeError, ValueError):
+        return DEFAULT_FRESHNESS_MINUTES
+
+
+def find_fresh_batch(program_id, max_age_minutes=None):
+    """
+    The newest "recent" batch for a programme if it is younger than
+    max_age_minutes (default: SYNC_FRESHNESS_MINUTES), else None.
+    Returns (batch_dir, batch_info, age_minutes).
+    """
+    if max_age_minutes is None:
+        max_age_minutes = freshness_minutes()
+    if max_age_minutes <= 0:
+        return None
+    latest = latest_recent_batch(program_id)
+    if not latest:
+        return None
+    batch_dir, info, generated = latest
+    age = (datetime.utcnow() - generated).total_seconds() / 60
+    if age > max_age_minutes:
+        return None
+    return batch_dir, info, age
+
+
+# ---------------------------------------------------------------------------
+# Schedule expressions
+# ---------------------------------------------------------------------------
+
+_INTERVAL_RE = re.compile(r"^(?:every\s+)?(\d+)\s*([mhd])$", re.IGNORECASE)
+_INTERVAL_UNITS = {"m": "minutes", "h": "hours", "d": "days"}
+
+# (min, max) for minute, hour, day of month, month, day of week (0 = Sunday)
+_CRON_RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 6)]
+
+
+def _parse_cron_field(field, low, high):
+    values = set()
+    for part in field.split(","):
+        step = 1
+        if "/" in part:
+            part, step = part.split("/", 1)
+            step = int(step)
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start, end = (int(x) for x in part.split("-", 1))
+        else:
+            start = end = int(part)
+            if step != 1:
+                end = high
+        if start < low or end > high or start > end or step < 1:
+            raise ValueError(f"cron field out of range: {field}")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+def parse_schedule(expr):
+    """
+    Parse a schedule expression. Returns a function mapping a (local, naive)
+    datetime to the next run time strictly after it. Raises ValueError for
+    an invalid expression.
+    """
+    expr = (expr or "").strip()
+    match = _INTERVAL_RE.match(expr)
+    if match:
+        delta = timedelta(**{_INTERVAL_UNITS[match.group(2).lower()]: int(match.group(1))})
+        if delta <= timedelta(0):
+            raise ValueError("interval must be positive")
+        return lambda after: after + delta
+
+    fields = expr.split()
+    if len(fields) != 5:
+        raise ValueError(f"not an interval or 5-field cron expression: {expr!r}")
+    minutes, hours, days, months, weekdays = (
+        _parse_cron_field(f, low, high) for f, (low, high) in zip(fields, _CRON_RANGES)
+    )
+    # Like cron: if both day fields are restricted, either may match
+    any_day = fields[2] == "*"
+    any_weekday = fields[4] == "*"
+
+    def day_matches(dt):
+        dom = dt.day in days
+        dow = (dt.weekday() + 1) % 7 in weekdays
+        if any_day or any_weekday:
+            return dom and dow
+        return dom or dow
+
+    def next_run(after):
+        dt = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = dt + timedelta(days=366 * 4)
+        while dt < limit:
+            if dt.month not in months:
+                dt = (dt.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not day_matches(dt):
+                dt = dt.replace(hour=0, minute=0) + timedelta(days=1)
+            elif dt.hour not in hours:
+                dt = dt.replace(minute=0) + timedelta(hours=1)
+            elif dt.minute not in minutes:
+                dt += timedelta(minutes=1)
+            else:
+                return dt
+        raise ValueError(f"cron expression never fires: {expr!r}")
+
+    return next_run
+
+
+# ---------------------------------------------------------------------------
+# Scheduler
+# ---------------------------------------------------------------------------
+
+_scheduler_lock_file = None
+_last_attempt = {}   # programId -> local datetime of the last scheduled run
+_started_at = None
+
+
+def _utc_to_local(dt):
+    return dt.replace(tzinfo=timezone.utc).astimezone().replace(tzinfo=None)
+
+
+def due_programs(config=None, now=None):
+    """Programme ids whose syncSchedule says a new batch is due."""
+    config = config or load_config()
+    now = now or datetime.now()
+    due = []
+    for program in config.get("PROGRAMS", []):
+        pid = str(program.get("programId") or "")
+        expr = program.get("syncSchedule")
+        if not pid or not expr:
+            continue
+        try:
+            next_run = parse_schedule(expr)
+        except ValueError as e:
+            print(f"[SCHEDULER] Ignoring schedule for program {pid}: {e}")
+            continue
+
+        # Last run: newest recent batch (so restarts don't re-run), or the
+        # last attempt (so a failing sync isn't retried every tick)
+        candidates = [t for t in (_last_attempt.get(pid),) if t]
+        latest = latest_recent_batch(pid)
+        if latest:
+            candidates.append(_utc_to_local(latest[2]))
+        if not candidates:
+            # Never built: intervals run now, cron waits for its next slot
+            if _INTERVAL_RE.match(expr.strip()):
+                due.append(pid)
+                continue
+            candidates.append(_started_at or now)
+
+        if next_run(max(candidates)) <= now:
+            due.append(pid)
+    return due
+
+
+def run_scheduled_syncs(now=None):
+    """Run one scheduler tick: sync every due programme in a single run."""
+    now = now or datetime.now()
+    due = due_programs(now=now)
+    if not due:
+        return None
+    for pid in due:
+        _last_attempt[pid] = now
+
+    # Lead the flight for every due programme, so FSP syncs arriving in the
+    # meantime wait for this run; skip programmes that are already syncing.
+    flights = {}
+    with ExitStack() as locks:
+        for pid in due:
+            key = _flight_key(pid, None)
+            flight, leader, _ = _join_flight(key)
+            if not leader:
+                continue
+            acquired, _ = locks.enter_context(_program_lock(pid, blocking=False))
+            if not acquired:
+                # Syncing in another process: stand down, so any waiters
+                # take the (blocking) lock path in sync_program() instead
+                _land_flight(key, flight)
+                continue
+            flights[key] = flight
+
+        if not flights:
+            return None
+        pids = [pid for pid, _ in flights]
+
+        print(f"[SCHEDULER] Pre-building batches for programs: {', '.join(pids)}")
+        started = datetime.utcnow()
+        try:
+            result = run_sync(pids)
+        except Exception as e:
+            for key, flight in flights.items():
+                _land_flight(key, flight, error=e)
+            raise
+
+    # Each waiter gets the outcome for its own programme: one programme
+    # failing makes the run exit non-zero, but the others still published
+    # a batch (and a zero exit does not prove every programme did)
+    built, failed = [], []
+    for key, flight in flights.items():
+        latest = latest_recent_batch(key[0])
+        if latest and latest[2] >= started:
+            built.append(key[0])
+            _land_flight(key, flight, result=_batch_result(latest[1]))
+        else:
+            failed.append(key[0])
+            _land_flight(key, flight, result=subprocess.CompletedProcess(
+                result.args, result.returncode or 1, stdout=result.stdout, stderr=result.stderr,
+            ))
+
+    if built:
+        print(f"[SCHEDULER] Sync finished for programs: {', '.join(built)}")
+    if failed:
+        print(f"[SCHEDULER] Sync failed for programs {', '.join(failed)}:\n{result.stderr or result.stdout}")
+    return result
+
+
+def _acquire_scheduler_lock():
+    """Take an exclusive, non-blocking lock so only one process schedules."""
+    global _scheduler_lock_file
+    try:
+        import fcntl
+    except ImportError:
+        return True  # no flock (Windows dev box): single process assumed
+    os.makedirs(os.path.dirname(SCHEDULER_LOCK_PATH), exist_ok=True)
+    f = open(SCHEDULER_LOCK_PATH, "w")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return False
+    _scheduler_lock_file = f  # keep it open for the life of the process
+    return True
+
+
+def start_scheduler():
+    """
+    Start the background scheduler thread, unless disabled with
+    SYNC_SCHEDULER=0 or already running in another process.
+    Returns True if this process is the scheduler.
+    """
+    global _started_at
+    if os.getenv("SYNC_SCHEDULER", "1") == "0":
+        return False
+    if not _acquire_scheduler_lock():
+        return False
+
+    _started_at = datetime.now()
+
+    def loop():
+        while True:
+            try:
+                run_scheduled_syncs()
+            except Exception as e:
+                print(f"[SCHEDULER] Tick failed: {e}")
+            time.sleep(SCHEDULER_TICK_SECONDS)
+
+    threading.Thread(target=loop, name="sync-scheduler", daemon=True).start()
+    print(f"[SCHEDULER] Started (every {SCHEDULER_TICK_SECONDS}s)")
+    return True
@@ -0,0 +1,139 @@
+import json
+import os
+import threading
+import time
+
+
+# ---------------------------------------------------------------------------
+# Small TTL cache for upstream metadata (121 programme details, ...).
+#
+# - An entry is fresh for `ttl` seconds and returned straight from memory.
+# - For a further `stale_ttl` seconds it is still returned immediately, while
+#   a background thread reloads it (stale-while-revalidate).
+# - If loading fails, the last known value is returned, however old, and
+#   the error is only raised when there is nothing cached at all.
+# - Entries can be invalidated by key or by key prefix.
+# - With a persist_path, entries are written to a JSON file and read back
+#   on start, so a restart does not mean a cold cache. Values must
+#   therefore be JSON-serialisable.
+# ---------------------------------------------------------------------------
+
+
+class TTLCache:
+    def __init__(self, ttl, stale_ttl=0, persist_path=None):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.persist_path = persist_path
+        self._lock = threading.Lock()
+        self._entries = {}        # key -> {"value": ..., "stored": epoch seconds}
+        self._loading = {}        # key -> threading.Lock (one loader per key)
+        self._refreshing = set()  # keys with a background reload running
+        self._load_persisted()
+
+    # -- persistence -------------------------------------------------------
+
+    def _load_persisted(self):
+        if not self.persist_path or not os.path.exists(self.persist_path):
+            return
+        try:
+            with open(self.persist_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return  # a corrupt cache file is just a cold cache
+        if isinstance(data, dict):
+            self._entries = {
+                k: v for k, v in data.items()
+                if isinstance(v, dict) and "value" in v and "stored" in v
+            }
+
+    def _persist(self):
+        if not self.persist_path:
+            return
+        with self._lock:
+            snapshot = dict(self._entries)
+        directory = os.path.dirname(self.persist_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.persist_path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_path, self.persist_path)
+        except (OSError, TypeError, ValueError) as e:
+            print(f"[cache] Could not persist {self.persist_path}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    # -- access ------------------------------------------------------------
+
+    def peek(self, key):
+        """The cached value for key regardless of age, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+        return entry["value"] if entry else None
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = {"value": value, "stored": time.time()}
+        self._persist()
+
+    def invalidate(self, key=None, prefix=None):
+        """Drop one key, every key starting with prefix, or (no args) all."""
+        with self._lock:
+            if key is not None:
+                self._entries.pop(key, None)
+            elif prefix is not None:
+                for k in [k for k in self._entries if k.startswith(prefix)]:
+                    del self._entries[k]
+            else:
+                self._entries.clear()
+        self._persist()
+
+    def _load(self, key, loader):
+        """Run loader for key, one caller at a time; others reuse its value."""
+        with self._lock:
+            key_lock = self._loading.setdefault(key, threading.Lock())
+        with key_lock:
+            with self._lock:
+                entry = self._entries.get(key)
+            if entry and time.time() - entry["stored"] < self.ttl:
+                return entry["value"]  # loaded by whoever held the lock
+            value = loader()
+            self.set(key, value)
+            return value
+
+    def _refresh_in_background(self, key, loader):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def run():
+            try:
+                self._load(key, loader)
+            except Exception as e:
+                print(f"[cache] Background refresh of {key} failed: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=run, name=f"cache-refresh-{key}", daemon=True).start()
+
+    def get(self, key, loader):
+        """Return the value for key, calling loader() when it must be (re)loaded."""
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry:
+            age = time.time() - entry["stored"]
+            if age < self.ttl:
+                return entry["value"]
+            if age < self.ttl + self.stale_ttl:
+                self._refresh_in_background(key, loader)
+                return entry["value"]
+
+        try:
+            return self._load(key, loader)
+        except Exception:
+            if entry:
+                return entry["value"]  # upstream down: serve what we have
+            raise
@@ -0,0 +1,145 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import requests
+
+
+# ---------------------------------------------------------------------------
+# Concurrent upstream calls for page rendering.
+#
+# A page that needs several independent 121/Kobo lookups (programme titles,
+# fsp-configurations, the Kobo schema, ...) hands them to fan_out() as
+# named zero-argument callables. They run in parallel on one shared thread
+# pool, and fan_out() returns when they are all done or the deadline has
+# passed. Anything that failed or is still running gets its fallback, so
+# the page renders with what it has. Calls still running carry on in the
+# background and, through the caches, help the next render.
+# ---------------------------------------------------------------------------
+
+UPSTREAM_POOL_SIZE = int(os.getenv("UPSTREAM_POOL_SIZE", "16"))
+UPSTREAM_DEADLINE_SECONDS = float(os.getenv("UPSTREAM_DEADLINE_SECONDS", "8"))
+
+_pool = ThreadPoolExecutor(max_workers=UPSTREAM_POOL_SIZE, thread_name_prefix="upstream")
+
+
+def fan_out(calls, deadline=None, defaults=None, default=None):
+    """
+    Run calls ({name: callable}) concurrently and return {name: result}.
+
+    deadline: seconds to wait overall (default UPSTREAM_DEADLINE_SECONDS).
+    defaults: optional {name: fallback}; other names fall back to `default`.
+    """
+    deadline = UPSTREAM_DEADLINE_SECONDS if deadline is None else deadline
+    defaults = defaults or {}
+    futures = {name: _pool.submit(fn) for name, fn in calls.items()}
+    wait(futures.values(), timeout=deadline)
+
+    results = {}
+    for name, future in futures.items():
+        fallback = defaults.get(name, default)
+        if not future.done():
+            print(f"[upstream] {name} not done within {deadline}s, using fallback")
+            results[name] = fallback
+            continue
+        try:
+            results[name] = future.result()
+        except Exception as e:
+            print(f"[upstream] {name} failed: {e}")
+            results[name] = fallback
+    return results
+
+
+# ---------------------------------------------------------------------------
+# Circuit breaker per upstream (121, Kobo).
+#
+# After CIRCUIT_FAILURE_THRESHOLD consecutive failures (connection errors,
+# timeouts, 5xx) the circuit opens: calls raise CircuitOpen at once instead
+# of waiting for their timeouts, and callers fall back to cached data or
+# their defaults. A background thread probes the upstream every
+# CIRCUIT_RESET_SECONDS (half-open) and closes the circuit once it answers.
+# ---------------------------------------------------------------------------
+
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_SECONDS = float(os.getenv("CIRCUIT_RESET_SECONDS", "30"))
+
+
+class CircuitOpen(requests.ConnectionError):
+    """The upstream's circuit is open; the request was not sent."""
+
+
+class CircuitBreaker:
+    def __init__(self, name, probe, failure_threshold=None, reset_seconds=None):
+        """
+        probe: zero-argument callable returning True when the upstream is
+        reachable again (used while the circuit is open).
+        """
+        self.name = name
+        self.probe = probe
+        self.failure_threshold = failure_threshold or CIRCUIT_FAILURE_THRESHOLD
+        self.reset_seconds = reset_seconds or CIRCUIT_RESET_SECONDS
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def status(self):
+        with self._lock:
+            return {
+                "name": self.name,
+                "state": "open" if self._opened_at is not None else "closed",
+                "failures": self._failures,
+                "openedAt": self._opened_at,
+            }
+
+    def call(self, fn, *args, **kwargs):
+        """
+        Call fn unless the circuit is open (then raise CircuitOpen). Request
+        errors and 5xx responses count as failures, anything else as success.
+        """
+        if self.is_open:
+            raise CircuitOpen(f"{self.name} unavailable (circuit open)")
+        try:
+            result = fn(*args, **kwargs)
+        except requests.RequestException:
+            self.record_failure()
+            raise
+        if getattr(result, "status_code", 0) >= 500:
+            self.record_failure()
+        else:
+            self.record_success()
+        return result
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._opened_at is not None or self._failures < self.failure_threshold:
+                return
+            self._opened_at = time.time()
+        print(f"[upstream] {self.name}: {self._failures} failures in a row, circuit open")
+        threading.Thread(
+            target=self._probe_until_closed, name=f"circuit-probe-{self.name}", daemon=True
+        ).start()
+
+    def _probe_until_closed(self):
+        while True:
+            time.sleep(self.reset_seconds)
+            try:
+                healthy = self.probe()
+            except Exception as e:
+                print(f"[upstream] {self.name}: probe failed: {e}")
+                healthy = False
+            if healthy:
+                with self._lock:
+                    self._failures = 0
+                    self._opened_at = None
+                print(f"[upstream] {self.name}: reachable again, circuit closed")
+                return
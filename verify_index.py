@@ -0,0 +1,186 @@
+import json
+import os
+import threading
+import time
+
+import outbox
+from sync_runner import latest_recent_batch
+
+
+# ---------------------------------------------------------------------------
+# In-memory index for online voucher verification (/api/verify/<uuid>).
+#
+# Per programme, the records of the latest "recent" batch
+# (registrations_cache.json) are held in memory by uuid. Lookups never
+# touch the batch files: at most every VERIFY_BATCH_CHECK_SECONDS a lookup
+# starts a background check for a newer batch, and only that programme's
+# index is rebuilt, while the old one keeps answering until the new one
+# replaces it. refresh() does the same straight after a sync.
+#
+# Payments already made come from the submission outbox: every decision
+# with status "success" is followed incrementally (by row id), at most every
+# VERIFY_PAID_SYNC_SECONDS, so a voucher paid on another device (or through
+# another worker) shows as already paid shortly after that device has sent
+# it, before 121 has processed it and a new batch has been built. If its
+# delivery to 121 then fails for good, the outbox's "undelivered" row clears
+# it again. Payments for uuids or paymentIds that are not in a programme's
+# latest batch can no longer match a lookup and are dropped when that
+# batch is indexed.
+# ---------------------------------------------------------------------------
+
+VERIFY_BATCH_CHECK_SECONDS = float(os.getenv("VERIFY_BATCH_CHECK_SECONDS", "10"))
+VERIFY_PAID_SYNC_SECONDS = float(os.getenv("VERIFY_PAID_SYNC_SECONDS", "1"))
+
+PAID_STATUS = "success"
+
+
+class _BatchIndex:
+    def __init__(self, batch_dir, info, records):
+        self.batch = os.path.basename(batch_dir)
+        self.generated_at = info.get("generatedAt")
+        self.records = records   # uuid -> registrations_cache.json record
+
+
+_lock = threading.Lock()
+_batches = {}        # programId -> _BatchIndex
+_checked_at = {}     # programId -> monotonic time of the last batch check
+_rebuilding = set()
+
+_paid_lock = threading.Lock()
+_paid = {}           # (programId, uuid, paymentId) -> submitted at (epoch seconds)
+_paid_cursor = 0     # last outbox decision id applied
+_paid_synced_at = 0  # monotonic time of the last outbox read
+
+
+def _load_batch(program_id):
+    """Index of the programme's latest batch, or None if it has none."""
+    latest = latest_recent_batch(program_id)
+    if not latest:
+        return None
+    batch_dir, info, _ = latest
+    current = _batches.get(str(program_id))
+    if current and current.batch == os.path.basename(batch_dir):
+        return current
+
+    with open(os.path.join(batch_dir, "registrations_cache.json"), "r", encoding="utf-8") as f:
+        records = {r["uuid"]: r for r in json.load(f) if r.get("uuid")}
+    print(f"[VERIFY] Indexed {len(records)} records of {os.path.basename(batch_dir)} for program {program_id}")
+    return _BatchIndex(batch_dir, info, records)
+
+
+def _prune_paid(program_id, index):
+    """Drop the programme's payments that are not for a record of `index`."""
+    key = str(program_id)
+    with _paid_lock:
+        stale = [
+            k for k in _paid
+            if k[0] == key and str((index.records.get(k[1]) or {}).get("paymentId")) != k[2]
+        ]
+        for k in stale:
+            del _paid[k]
+
+
+def _rebuild(program_id):
+    key = str(program_id)
+    try:
+        index = _load_batch(program_id)
+        with _lock:
+            replaced = index is not None and _batches.get(key) is not index
+            if index is not None:
+                _batches[key] = index
+            _checked_at[key] = time.monotonic()
+        if replaced:
+            _prune_paid(program_id, index)
+    except Exception as e:
+        print(f"[VERIFY] Failed to index program {program_id}: {e}")
+    finally:
+        with _lock:
+            _rebuilding.discard(key)
+
+
+def refresh(program_id):
+    """Check for a newer batch now, in the background."""
+    key = str(program_id)
+    with _lock:
+        if key in _rebuilding:
+            return
+        _rebuilding.add(key)
+    threading.Thread(target=_rebuild, args=(program_id,), name="verify-index", daemon=True).start()
+
+
+def _batch_index(program_id):
+    key = str(program_id)
+    index = _batches.get(key)
+    if index is None:
+        # Cold start for this programme: build it in the request
+        index = _load_batch(program_id)
+        with _lock:
+            if index is not None:
+                index = _batches.setdefault(key, index)
+            _checked_at[key] = time.monotonic()
+        if index is not None:
+            _prune_paid(program_id, index)
+        return index
+    if time.monotonic() - _checked_at.get(key, 0) > VERIFY_BATCH_CHECK_SECONDS:
+        refresh(program_id)
+    return index
+
+
+def _sync_paid():
+    """
+    Apply decisions added to the outbox since the last read, unless it was
+    read less than VERIFY_PAID_SYNC_SECONDS ago.
+    """
+    global _paid_cursor, _paid_synced_at
+    with _paid_lock:
+        now = time.monotonic()
+        if _paid_synced_at and now - _paid_synced_at < VERIFY_PAID_SYNC_SECONDS:
+            return
+        _paid_synced_at = now
+        while True:
+            rows = outbox.decisions_since(_paid_cursor)
+            if not rows:
+                return
+            for d in rows:
+                key = (d["programId"], d["uuid"], str(d["paymentId"]))
+                if d["status"] == PAID_STATUS:
+                    _paid[key] = d["createdAt"]
+                else:
+                    _paid.pop(key, None)
+            _paid_cursor = rows[-1]["id"]
+
+
+def lookup(program_id, uuid):
+    """
+    Verification result for a uuid, or None if it is not in the latest
+    batch: {"uuid", "programId", "valid", "reason", "paidAt", "batch",
+    "generatedAt", "record"}. reason is "ok", "already_paid" or the
+    batch's own reason (e.g. "status=success", "deleted", "too_old").
+    record is the batch record with its display fields still encrypted.
+    """
+    index = _batch_index(program_id)
+    if index is None:
+        return None
+    record = index.records.get(uuid)
+    if record is None:
+        return None
+
+    _sync_paid()
+    paid_at = _paid.get((str(program_id), uuid, str(record.get("paymentId"))))
+
+    valid = bool(record.get("valid")) and paid_at is None
+    if paid_at is not None:
+        reason = "already_paid"
+    else:
+        reason = record.get("reason") or ("ok" if valid else "invalid")
+
+    return {
+        "uuid": uuid,
+        "programId": str(program_id),
+        "valid": valid,
+        "reason": reason,
+        "paidAt": paid_at,
+        "batch": index.batch,
+        "generatedAt": index.generated_at,
+        "record": record,
+    }
@@ -0,0 +1,146 @@
+import base64
+import hashlib
+import os
+import threading
+
+from config_loader import config_dir, load_display_config, save_display_config, update_lock
+
+
+# ---------------------------------------------------------------------------
+# Signed voucher QR payloads.
+#
+# With "signed QR" enabled in a programme's voucher design, the QR holds
+#
+#   S1.<kid>.<programId>.<paymentId>.<referenceId>.<signature>
+#
+# instead of the bare reference id. The signature is Ed25519 over
+# everything before the last dot (base64url, no padding), and kid names the
+# signing key (first 4 bytes of the SHA-256 of its public key, hex).
+# paymentId 0 means the voucher is not tied to a payment round.
+#
+# The scan page verifies the signature itself with the public key from
+# /api/vouchers/public-key and checks the programme's revocation list, so a
+# device only needs those two small downloads to recognise genuine
+# vouchers. The offline record cache then only adds the beneficiary's
+# details and photo.
+#
+# The private key comes from VOUCHER_SIGNING_KEY (base64url of the 32-byte
+# Ed25519 seed). Without it, one is generated once and kept in the config
+# folder (voucher_signing_key, shared by all instances on Azure). Public
+# keys of earlier keys can be listed in VOUCHER_PREVIOUS_PUBLIC_KEYS
+# (comma-separated base64url) so vouchers printed before a rotation still
+# verify.
+# ---------------------------------------------------------------------------
+
+PAYLOAD_PREFIX = "S1"
+ANY_PAYMENT = "0"
+
+KEY_FILENAME = "voucher_signing_key"
+
+_key_lock = threading.Lock()
+_private_key = None
+
+
+def b64url(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64url_decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _load_private_key():
+    from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+
+    seed = os.getenv("VOUCHER_SIGNING_KEY")
+    if seed:
+        return Ed25519PrivateKey.from_private_bytes(_b64url_decode(seed.strip()))
+
+    path = os.path.join(config_dir(), KEY_FILENAME)
+    if not os.path.exists(path):
+        # O_EXCL: if another worker creates it first, use theirs
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            pass
+        else:
+            with os.fdopen(fd, "w") as f:
+                f.write(b64url(os.urandom(32)))
+            print(f"[VOUCHER] Generated a voucher signing key at {path}")
+    with open(path, "r") as f:
+        return Ed25519PrivateKey.from_private_bytes(_b64url_decode(f.read().strip()))
+
+
+def _signing_key():
+    global _private_key
+    with _key_lock:
+        if _private_key is None:
+            _private_key = _load_private_key()
+        return _private_key
+
+
+def _raw_public_key(private_key):
+    from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+
+    return private_key.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+
+
+def key_id(public_key_bytes):
+    return hashlib.sha256(public_key_bytes).hexdigest()[:8]
+
+
+def public_keys():
+    """[{"kid", "publicKey"}] for the current key and any previous ones."""
+    current = _raw_public_key(_signing_key())
+    keys = [{"kid": key_id(current), "publicKey": b64url(current)}]
+    for text in os.getenv("VOUCHER_PREVIOUS_PUBLIC_KEYS", "").split(","):
+        text = text.strip()
+        if text:
+            keys.append({"kid": key_id(_b64url_decode(text)), "publicKey": text})
+    return keys
+
+
+def sign_voucher(program_id, reference_id, payment_id=None):
+    """The signed QR payload for a voucher."""
+    private_key = _signing_key()
+    kid = key_id(_raw_public_key(private_key))
+    message = ".".join([
+        PAYLOAD_PREFIX, kid, str(program_id), str(payment_id or ANY_PAYMENT), str(reference_id),
+    ])
+    return f"{message}.{b64url(private_key.sign(message.encode()))}"
+
+
+def is_signed_payload(text):
+    return str(text).startswith(PAYLOAD_PREFIX + ".")
+
+
+# ---------------------------------------------------------------------------
+# Revocation lists (display_config.json, per programme)
+# ---------------------------------------------------------------------------
+
+def revocations(program_id):
+    """{"programId", "version", "referenceIds": [sorted]} for a programme."""
+    entry = (load_display_config().get("voucher_revocations") or {}).get(str(program_id)) or {}
+    return {
+        "programId": str(program_id),
+        "version": entry.get("version", 0),
+        "referenceIds": sorted(entry.get("referenceIds", [])),
+    }
+
+
+def update_revocations(program_id, reference_ids, restore=False):
+    """Revoke (or, with restore=True, reinstate) reference ids. Returns the list."""
+    changed = {str(r).strip() for r in reference_ids if str(r).strip()}
+    # Under the lock, so a concurrent display_config save cannot drop a revocation
+    with update_lock():
+        cfg = load_display_config() or {}
+        all_lists = cfg.setdefault("voucher_revocations", {})
+        entry = all_lists.setdefault(str(program_id), {"version": 0, "referenceIds": []})
+
+        revoked = set(entry["referenceIds"])
+        revoked = revoked - changed if restore else revoked | changed
+        if revoked != set(entry["referenceIds"]):
+            entry["referenceIds"] = sorted(revoked)
+            entry["version"] += 1
+            save_display_config(cfg)
+    return revocations(program_id)
@@ -0,0 +1,128 @@
+import os
+import threading
+from datetime import datetime
+
+import api121
+import kobo_api
+from config_loader import load_config, save_config
+from upstream import fan_out
+
+
+# ---------------------------------------------------------------------------
+# Cache warm-up at app start.
+#
+# A fresh instance (deploy, App Service recycle) would otherwise make its
+# first users wait for the 121 login, programme title and fsp-configurations
+# lookups and the Kobo schema requests. warm_up() does all of that
+# concurrently in the background: it logs in, fills the programme metadata
+# and Kobo schema caches (opening connections in the shared HTTP pools on
+# the way), and refreshes COLUMN_TO_MATCH_PER_PROGRAM in system_config.json.
+#
+# is_ready() turns True once the first warm-up has finished (whatever
+# failed is just fetched on demand later) and stays True through later
+# warm-ups started from the admin endpoint, so a health check on /ready can
+# wait for a warm instance. WARMUP_ON_START=0 skips it; the app is then
+# ready at once.
+# ---------------------------------------------------------------------------
+
+WARMUP_DEADLINE_SECONDS = float(os.getenv("WARMUP_DEADLINE_SECONDS", "60"))
+
+_FAILED = object()
+
+_lock = threading.Lock()
+_state = {
+    "ready": False,
+    "status": "idle",       # idle | warming | done
+    "startedAt": None,
+    "finishedAt": None,
+    "failed": [],
+}
+
+
+def is_ready():
+    return _state["ready"]
+
+
+def status():
+    with _lock:
+        return dict(_state, failed=list(_state["failed"]))
+
+
+def _warm_calls(config):
+    calls = {}
+    if config.get("url121"):
+        calls["token"] = api121.token_provider.get
+        for p in config.get("PROGRAMS", []):
+            pid = p.get("programId")
+            calls[f"program:{pid}"] = lambda pid=pid: api121.get_program(pid)
+            calls[f"column-to-match:{pid}"] = lambda pid=pid: api121.column_to_match(pid)
+
+    kobo_token = config.get("KOBO_TOKEN")
+    kobo_server = config.get("KOBO_SERVER") or kobo_api.DEFAULT_KOBO_SERVER
+    if kobo_token:
+        for asset_id in {p.get("koboAssetId") for p in config.get("PROGRAMS", [])}:
+            if asset_id:
+                calls[f"kobo:{asset_id}"] = (
+                    lambda asset_id=asset_id: kobo_api.get_asset_schema(asset_id, kobo_server, kobo_token)
+                )
+    return calls
+
+
+def _store_columns_to_match(results):
+    """Write the fetched columnToMatch values back when they changed."""
+    columns = {
+        name.split(":", 1)[1]: value
+        for name, value in results.items()
+        if name.startswith("column-to-match:") and value and value is not _FAILED
+    }
+    if not columns:
+        return
+    config = load_config()
+    per_program = config.setdefault("COLUMN_TO_MATCH_PER_PROGRAM", {})
+    if all(per_program.get(pid) == column for pid, column in columns.items()):
+        return
+    per_program.update(columns)
+    save_config(config)
+
+
+def warm_up():
+    """Fill the token, metadata and Kobo schema caches. Returns the state."""
+    with _lock:
+        _state.update(status="warming", startedAt=datetime.now().isoformat(), finishedAt=None, failed=[])
+
+    failed = []
+    try:
+        calls = _warm_calls(load_config())
+        results = fan_out(calls, deadline=WARMUP_DEADLINE_SECONDS, default=_FAILED)
+        failed = sorted(name for name, value in results.items() if value is _FAILED)
+        _store_columns_to_match(results)
+    except Exception as e:
+        print(f"[WARMUP] Failed: {e}")
+        failed.append("warm-up")
+
+    with _lock:
+        _state.update(ready=True, status="done", finishedAt=datetime.now().isoformat(), failed=failed)
+    print(f"[WARMUP] Done ({len(failed)} lookups failed)" if failed else "[WARMUP] Done")
+    return status()
+
+
+def start_warm_up():
+    """
+    Run warm_up() in a background thread, unless one is already running.
+    Returns False if it was already running.
+    """
+    with _lock:
+        if _state["status"] == "warming":
+            return False
+        _state["status"] = "warming"
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+    return True
+
+
+def start_on_boot():
+    """Warm up at app start unless WARMUP_ON_START=0 (then ready at once)."""
+    if os.getenv("WARMUP_ON_START", "1") == "0":
+        with _lock:
+            _state["ready"] = True
+        return
+    start_warm_up()